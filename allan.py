@@ -0,0 +1,163 @@
+'''allan.py - Allan deviation curves of per-shot quantities
+
+Every function here takes a series with one value per shot (atom number,
+position, ...) and returns the Allan deviation over a range of averaging
+times tau, as an AllanCurve of arrays
+
+    taus    - averaging time, in shots (or seconds, with times)
+    adev    - Allan deviation
+    lower, upper - confidence interval of adev
+    num     - number of differences averaged at each tau
+
+The overlapping and modified deviations are computed from cumulative sums,
+so each tau costs O(n) and the default octave-spaced taus O(n log n) in
+all. Unevenly spaced shots (times in seconds, e.g. from the file name
+timestamps) are averaged into consecutive bins of length tau instead.
+
+Confidence intervals come from the chi-squared distribution with the
+equivalent degrees of freedom for white noise, the usual case for shot to
+shot fluctuations.'''
+
+from collections import namedtuple
+import numpy as np
+from scipy import stats
+
+CONFIDENCE = 0.683      #default confidence level of the intervals, 1 sigma
+
+AllanCurve = namedtuple('AllanCurve', ['taus', 'adev', 'lower', 'upper', 'num'])
+
+def octave_taus(max_tau):
+    '''1, 2, 4, ... up to max_tau'''
+    if max_tau < 1:
+        return np.array([], dtype=int)
+    return 2**np.arange(int(np.floor(np.log2(max_tau))) + 1)
+
+def _taus(taus, max_tau):
+    if taus is None or (isinstance(taus, str) and taus == 'octave'):
+        return octave_taus(max_tau)
+    if isinstance(taus, str) and taus == 'all':
+        return np.arange(1, max_tau + 1)
+    taus = np.unique(np.asarray(taus, dtype=int))
+    return taus[(taus >= 1) & (taus <= max_tau)]
+
+def white_noise_edf(num_values, taus):
+    '''equivalent degrees of freedom of the overlapping Allan variance of
+    num_values shots with white noise, averaged over taus shots'''
+    num = float(num_values)
+    taus = np.asarray(taus, dtype=float)
+    edf = ((3 * (num - 1) / (2 * taus) - 2 * (num - 2) / num)
+            * 4 * taus**2 / (4 * taus**2 + 5))
+    return np.maximum(edf, 1.0)
+
+def confidence_interval(adev, edf, confidence=CONFIDENCE):
+    '''lower and upper bounds of adev with edf degrees of freedom'''
+    edf = np.asarray(edf, dtype=float)
+    alpha = 1 - confidence
+    lower = adev * np.sqrt(edf / stats.chi2.ppf(1 - alpha / 2, edf))
+    upper = adev * np.sqrt(edf / stats.chi2.ppf(alpha / 2, edf))
+    return lower, upper
+
+def _cumulative(values):
+    '''cumulative sum with a leading zero, so that sums of any run of values
+    are differences of two entries'''
+    values = np.asarray(values, dtype=float)
+    cumulative = np.zeros(len(values) + 1)
+    np.cumsum(values, out=cumulative[1:])
+    return cumulative
+
+def overlapping_adev(values, taus=None, confidence=CONFIDENCE):
+    '''Overlapping Allan deviation of evenly spaced shots at taus (in
+    shots: None or 'octave' for 1, 2, 4, ..., 'all', or a list). At tau=1
+    this is sqrt(<(x[i+1] - x[i])**2> / 2).'''
+    cumulative = _cumulative(values)
+    num_values = len(cumulative) - 1
+    taus = _taus(taus, num_values // 2)
+    avar = np.empty(len(taus))
+    num = np.empty(len(taus), dtype=int)
+    for index, tau in enumerate(taus):
+        # difference of the means of adjacent runs of tau values
+        diffs = (cumulative[2 * tau:] - 2 * cumulative[tau:-tau]
+                    + cumulative[:-2 * tau]) / tau
+        avar[index] = 0.5 * np.mean(diffs**2)
+        num[index] = len(diffs)
+    adev = np.sqrt(avar)
+    lower, upper = confidence_interval(adev, white_noise_edf(num_values, taus),
+                                       confidence)
+    return AllanCurve(taus, adev, lower, upper, num)
+
+def modified_adev(values, taus=None, confidence=CONFIDENCE):
+    '''Modified Allan deviation of evenly spaced shots, which also averages
+    over the position of the runs and so separates white from flicker
+    noise. Equal to overlapping_adev at tau=1.'''
+    cumulative = _cumulative(values)
+    num_values = len(cumulative) - 1
+    taus = _taus(taus, num_values // 3)
+    avar = np.empty(len(taus))
+    num = np.empty(len(taus), dtype=int)
+    for index, tau in enumerate(taus):
+        second_diffs = (cumulative[2 * tau:] - 2 * cumulative[tau:-tau]
+                            + cumulative[:-2 * tau])
+        sums = _cumulative(second_diffs)
+        runs = sums[tau:] - sums[:-tau]
+        avar[index] = 0.5 * np.mean(runs**2) / float(tau)**4
+        num[index] = len(runs)
+    adev = np.sqrt(avar)
+    # white noise edf of the overlapping variance; a slight underestimate
+    lower, upper = confidence_interval(adev, white_noise_edf(num_values, taus),
+                                       confidence)
+    return AllanCurve(taus, adev, lower, upper, num)
+
+def binned_adev(values, times, taus=None, confidence=CONFIDENCE):
+    '''Allan deviation of unevenly spaced shots taken at times (seconds).
+    Shots are averaged in consecutive bins of tau seconds; empty bins are
+    skipped, and differences are taken between adjacent non-empty bins.
+    taus default to octave multiples of the median shot spacing.'''
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype=float)
+    order = np.argsort(times, kind='mergesort')
+    values = values[order]
+    times = times[order] - times[order[0]]
+    span = times[-1] if len(times) else 0.0
+    if taus is None or (isinstance(taus, str) and taus == 'octave'):
+        spacing = np.median(np.diff(times)) if len(times) > 1 else 0.0
+        if spacing <= 0:
+            taus = np.array([])
+        else:
+            taus = spacing * octave_taus(span / spacing / 2)
+    taus = np.asarray(taus, dtype=float)
+    adev = np.full(len(taus), np.nan)
+    num = np.zeros(len(taus), dtype=int)
+    for index, tau in enumerate(taus):
+        bins = np.floor(times / tau).astype(int)
+        counts = np.bincount(bins)
+        filled = counts > 0
+        means = np.bincount(bins, values)[filled] / counts[filled]
+        adjacent = np.diff(np.flatnonzero(filled)) == 1
+        diffs = np.diff(means)[adjacent]
+        num[index] = len(diffs)
+        if len(diffs):
+            adev[index] = np.sqrt(0.5 * np.mean(diffs**2))
+    # non-overlapping differences: about one degree of freedom each
+    lower, upper = confidence_interval(adev, np.maximum(num, 1), confidence)
+    return AllanCurve(taus, adev, lower, upper, num)
+
+def allan_deviation(values, taus=None, times=None, modified=False,
+                    confidence=CONFIDENCE):
+    '''Allan deviation curve of values; see overlapping_adev, modified_adev
+    and binned_adev (used when times are given)'''
+    if times is not None:
+        if modified:
+            raise ValueError('Modified Allan deviation needs evenly spaced shots')
+        return binned_adev(values, times, taus, confidence)
+    if modified:
+        return modified_adev(values, taus, confidence)
+    return overlapping_adev(values, taus, confidence)
+
+def timestamp_seconds(timestamps):
+    '''seconds since the first shot from hhmmss file name timestamps,
+    counting a day forward each time the clock goes past midnight'''
+    stamps = np.asarray(timestamps, dtype=int)
+    seconds = (stamps // 10000) * 3600 + (stamps // 100 % 100) * 60 + stamps % 100
+    days = np.concatenate([[0], np.cumsum(np.diff(seconds) < 0)])
+    seconds = seconds + 86400 * days
+    return seconds - seconds[0] if len(seconds) else seconds.astype(float)
@@ -0,0 +1,217 @@
+'''benchmarks.py - timing and memory benchmarks of the analysis pipeline
+
+Each benchmark runs on synthetic datasets (see synthetic_data) of increasing
+size, in a fresh process so that peak memory is measured per benchmark.
+Results are written as JSON keyed by the current git commit, and two result
+files can be compared to spot regressions:
+
+    python benchmarks.py --sizes 10 100 1000 --output before.json
+    ... change code ...
+    python benchmarks.py --sizes 10 100 1000 --output after.json --compare before.json
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'misc'))
+
+import synthetic_data
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+DEFAULT_SHAPE = (128, 256) #rows, cols of synthetic frames
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_data')
+
+def _timed_loop(filelist, stage):
+    '''load every file and time only stage(img)'''
+    import cloud_image
+    elapsed = 0.0
+    for ff in filelist:
+        img = cloud_image.CloudImage(ff)
+        start = time.time()
+        stage(img)
+        elapsed += time.time() - start
+    return elapsed
+
+def bench_load_mat_file(filelist):
+    import cloud_image
+    start = time.time()
+    for ff in filelist:
+        cloud_image.CloudImage(ff)
+    return time.time() - start
+
+def bench_get_od_image(filelist):
+    return _timed_loop(filelist, lambda img: img.get_od_image())
+
+def bench_get_gaussian_fit_params(filelist):
+    return _timed_loop(filelist, lambda img: img.get_gaussian_fit_params())
+
+def bench_gpe_bfield(filelist):
+    import gpe_bfield
+    return _timed_loop(filelist, gpe_bfield.gpe_bfield)
+
+def _distribution(filelist):
+    import cloud_distribution
+    # synthetic frames are smaller than the lab's custom fit window
+    cloud_distribution.CUSTOM_FIT_SWITCH = False
+    return cloud_distribution.CloudDistribution(os.path.dirname(filelist[0]) + os.sep,
+                                                False)
+
+def bench_initialize_gaussian_params(filelist):
+    dist = _distribution(filelist)
+    start = time.time()
+    dist.initialize_gaussian_params(**dist.gaussian_fit_options)
+    return time.time() - start
+
+def bench_get_average_image(filelist):
+    dist = _distribution(filelist)
+    start = time.time()
+    dist.get_average_image()
+    return time.time() - start
+
+def bench_psf_alignment(filelist):
+    import psf
+    dist = _distribution(filelist)
+    start = time.time()
+    psf.get_aligned_line_densities(dist)
+    return time.time() - start
+
+BENCHMARKS = OrderedDict([
+    ('load_mat_file', bench_load_mat_file),
+    ('get_od_image', bench_get_od_image),
+    ('get_gaussian_fit_params', bench_get_gaussian_fit_params),
+    ('initialize_gaussian_params', bench_initialize_gaussian_params),
+    ('get_average_image', bench_get_average_image),
+    ('psf_alignment', bench_psf_alignment),
+    ('gpe_bfield', bench_gpe_bfield),
+    ])
+
+def peak_memory_mb():
+    '''peak resident memory of this process in MB'''
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        return peak / 1024.0**2 #bytes
+    return peak / 1024.0 #kB
+
+def _run_in_child(name, filelist, queue):
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull #the pipeline prints per-file progress
+    try:
+        baseline = peak_memory_mb()
+        elapsed = BENCHMARKS[name](filelist)
+        queue.put((elapsed, peak_memory_mb(), baseline, None))
+    except Exception as err:
+        queue.put((None, peak_memory_mb(), None, repr(err)))
+    finally:
+        sys.stdout = sys.__stdout__
+        devnull.close()
+
+def run_benchmark(name, filelist):
+    '''Run one benchmark in a fresh process and return a result dictionary'''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_in_child, args=(name, filelist, queue))
+    proc.start()
+    elapsed, peak, baseline, error = queue.get()
+    proc.join()
+    result = {'benchmark': name,
+              'num_shots': len(filelist),
+              'seconds': elapsed,
+              'shots_per_sec': (len(filelist) / elapsed if elapsed else None),
+              'peak_memory_mb': peak,
+              'memory_growth_mb': (peak - baseline if baseline is not None else None)}
+    if error is not None:
+        result['error'] = error
+    return result
+
+def dataset(num_shots, data_dir=DEFAULT_DATA_DIR, shape=DEFAULT_SHAPE):
+    '''Return the files of a synthetic dataset of num_shots, making it if needed'''
+    directory = os.path.join(data_dir, '%dx%dx%d'%((num_shots,) + tuple(shape)))
+    filelist = (sorted(os.path.join(directory, ff) for ff in os.listdir(directory)
+                    if ff.endswith('.mat'))
+                if os.path.isdir(directory) else [])
+    if len(filelist) != num_shots:
+        filelist = synthetic_data.make_dataset(directory, num_shots, shape=shape)
+    return filelist
+
+def git_commit():
+    '''current commit hash, or None outside a git checkout'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__))).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(sizes=DEFAULT_SIZES, names=None, data_dir=DEFAULT_DATA_DIR,
+                shape=DEFAULT_SHAPE):
+    '''Run the selected benchmarks at each dataset size; returns a report dict'''
+    names = names or list(BENCHMARKS.keys())
+    results = []
+    for num_shots in sizes:
+        filelist = dataset(num_shots, data_dir, shape)
+        for name in names:
+            result = run_benchmark(name, filelist)
+            results.append(result)
+            print(format_result(result))
+    return {'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'frame_shape': list(shape),
+            'results': results}
+
+def format_result(result):
+    if result.get('error'):
+        return '%-28s %6d shots  FAILED: %s'%(result['benchmark'],
+                                            result['num_shots'], result['error'])
+    return '%-28s %6d shots %9.3f s %9.1f shots/s %8.1f MB peak'%(
+                result['benchmark'], result['num_shots'], result['seconds'],
+                result['shots_per_sec'], result['peak_memory_mb'])
+
+def save_report(report, filename):
+    with open(filename, 'w') as ff:
+        json.dump(report, ff, indent=2, sort_keys=True)
+
+def load_report(filename):
+    with open(filename) as ff:
+        return json.load(ff)
+
+def compare(old_report, new_report):
+    '''Print the throughput and memory ratio new/old for each common result'''
+    old = dict(((rr['benchmark'], rr['num_shots']), rr)
+                    for rr in old_report['results'] if not rr.get('error'))
+    print('%-28s %6s %10s %10s'%('benchmark', 'shots', 'speedup', 'memory'))
+    for rr in new_report['results']:
+        key = (rr['benchmark'], rr['num_shots'])
+        if key not in old or rr.get('error'):
+            continue
+        print('%-28s %6d %9.2fx %9.2fx'%(key[0], key[1],
+                    rr['shots_per_sec'] / old[key]['shots_per_sec'],
+                    rr['peak_memory_mb'] / old[key]['peak_memory_mb']))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--shape', type=int, nargs=2, default=list(DEFAULT_SHAPE),
+                        metavar=('ROWS', 'COLS'))
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results (default bench_<commit>.json)')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+    report = run_suite(args.sizes, args.benchmarks, args.data_dir, tuple(args.shape))
+    output = args.output or 'bench_%s.json'%(report['commit'] or 'results')[:10]
+    save_report(report, output)
+    print('Results written to %s'%output)
+    if args.compare:
+        compare(load_report(args.compare), report)
@@ -0,0 +1,253 @@
+'''camera_calibration.py - per-pixel camera calibration maps
+
+A CameraCalibration holds, for one camera, per-pixel maps of
+    bias       - dark level at zero exposure (counts)
+    dark       - dark current (counts/sec)
+    gain       - conversion gain (photoelectrons per count)
+    hot_pixels - pixels whose dark level or dark noise is anomalous
+built from NoAtomImage datasets. Maps are stored in the same (rotated) frame
+as CloudImage.atom_image, so ROIs are plain slices of them.
+
+Calibrations are cached as one compressed .npz per camera in
+CALIBRATION_DIR and looked up through a small in-memory registry, so each
+file is read once per session.'''
+
+import os
+import numpy as np
+from running_stats import RunningStats
+import intensity_noise
+
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'calibrations')
+HOT_PIXEL_NMADM = 6     #threshold for hot pixels, in median absolute deviations
+MIN_SHOTS_FOR_GAIN = 10 #below this, per-pixel gains are replaced by the global fit
+
+_REGISTRY = {}
+
+class CalibrationError(Exception):
+    '''Raised when a calibration cannot be built, found or applied'''
+    def __init__(self, statement="Calibration Error"):
+        self.statement = statement
+
+    def __str__(self):
+        return self.statement
+
+def _outliers(arr, nmadm):
+    '''boolean map of pixels more than nmadm MADs above the median'''
+    median = np.median(arr)
+    madm = np.median(np.abs(arr - median))
+    return arr - median > nmadm * max(madm, np.finfo(float).tiny)
+
+class CameraCalibration(object):
+    '''Per-pixel calibration maps for a single camera'''
+    def __init__(self, camera, bias, dark, gain, hot_pixels,
+                    image_rotation=0, quantum_efficiency=None, num_shots=0):
+        self.camera = camera
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.dark = np.asarray(dark, dtype=np.float32)
+        self.gain = np.asarray(gain, dtype=np.float32)
+        self.hot_pixels = np.asarray(hot_pixels, dtype=bool)
+        self.image_rotation = image_rotation
+        self.quantum_efficiency = quantum_efficiency
+        self.num_shots = num_shots
+        self.shape = self.bias.shape
+        self.median_gain = float(np.median(self.gain[~self.hot_pixels]))
+
+    @classmethod
+    def from_images(cls, images, camera=None, quantum_efficiency=None,
+                        hot_nmadm=HOT_PIXEL_NMADM,
+                        min_shots_for_gain=MIN_SHOTS_FOR_GAIN):
+        '''Build calibration maps from an iterable of NoAtomImages.
+
+        Dark frames are grouped by exposure time; with more than one exposure
+        time the bias and dark current are a per-pixel linear fit, otherwise
+        the bias is the mean dark frame and the dark current is zero.
+        The per-pixel gain comes from the variance of the difference of the
+        two light frames across shots, less twice the read noise.
+        quantum_efficiency is photoelectrons per photon; without it the
+        maps are used for dark subtraction only and intensities keep the
+        CloudImage conversion.'''
+        dark_stats = {}
+        diff_stats = RunningStats()
+        signal_stats = RunningStats()
+        ptc_moments = None
+        ptc_edges = None
+        image_rotation = None
+        for img in images:
+            if camera is None:
+                camera = img.cameratype
+            elif img.cameratype != camera:
+                raise CalibrationError('Image %s is from camera %s, not %s'
+                                        %(img.filename, img.cameratype, camera))
+            if image_rotation is None:
+                image_rotation = img.image_rotation
+            elif img.image_rotation != image_rotation:
+                raise CalibrationError('Mixed image rotations in calibration data')
+            img.rotate_frames() # the maps cover whole frames
+            image_time = img.get_image_time()
+            dark_stats.setdefault(image_time, RunningStats()).push(img.dark_image)
+            first = img.atom_image.astype(float)
+            second = img.light_image.astype(float)
+            diff_stats.push(first - second)
+            signal_stats.push(0.5 * (first + second) - img.dark_image)
+            signal = np.ravel(0.5 * (first + second) - img.dark_image)
+            if ptc_edges is None:
+                ptc_edges = intensity_noise.signal_bin_edges(signal)
+            moments = intensity_noise.binned_moments(signal,
+                                np.ravel(first - second), ptc_edges)
+            ptc_moments = (moments if ptc_moments is None else
+                           intensity_noise.combine_moments(ptc_moments, moments))
+        if not dark_stats:
+            raise CalibrationError('No images to build a calibration from')
+
+        # bias and dark current from a per-pixel linear fit in exposure time
+        exposures = sorted(dark_stats.keys())
+        times = np.array(exposures, dtype=float)
+        means = np.array([dark_stats[t].mean for t in exposures])
+        weights = np.array([dark_stats[t].count for t in exposures], dtype=float)
+        if len(times) > 1:
+            wsum = np.sum(weights)
+            tbar = np.sum(weights * times) / wsum
+            ybar = np.tensordot(weights, means, axes=1) / wsum
+            dt = times - tbar
+            dark = (np.tensordot(weights * dt, means, axes=1)
+                        / np.sum(weights * dt**2))
+            bias = ybar - dark * tbar
+        else:
+            bias = means[0]
+            dark = np.zeros_like(bias)
+        read_var = sum(s.variance() * s.count for s in dark_stats.values()) / \
+                    sum(s.count for s in dark_stats.values())
+
+        # per-pixel gains where there are enough shots; a global photon
+        # transfer fit, or failing that the median pixel gain, fills the rest
+        good = np.zeros(bias.shape, dtype=bool)
+        if diff_stats.count >= min_shots_for_gain:
+            shot_var = diff_stats.variance(ddof=1) - 2.0 * read_var
+            with np.errstate(invalid='ignore', divide='ignore'):
+                pixel_gain = 2.0 * signal_stats.mean / shot_var
+            good = np.isfinite(pixel_gain) & (pixel_gain > 0)
+        counts, sum_signal, _, sum_dev2 = ptc_moments[:, 1:-1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ptc_signal = sum_signal / counts
+        ptc_var = intensity_noise.binned_variance(counts, sum_dev2)
+        try:
+            global_gain = intensity_noise.fit_photon_transfer(ptc_signal, ptc_var,
+                                                              counts)[0]
+        except ValueError:
+            if not good.any():
+                raise CalibrationError('Photon transfer fit failed; not enough '
+                                       'signal levels or shots for per-pixel gains')
+            global_gain = np.median(pixel_gain[good])
+        gain = np.full(bias.shape, global_gain)
+        gain[good] = pixel_gain[good]
+
+        hot_pixels = _outliers(bias, hot_nmadm) | \
+                     _outliers(np.sqrt(read_var), hot_nmadm)
+        return cls(camera, bias, dark, gain, hot_pixels,
+                    image_rotation=image_rotation,
+                    quantum_efficiency=quantum_efficiency,
+                    num_shots=diff_stats.count)
+
+    @classmethod
+    def from_distributions(cls, dists, **kwargs):
+        '''Build calibration maps from one or more CloudDistributionNoAtoms'''
+        if not isinstance(dists, (list, tuple)):
+            dists = [dists]
+        images = (dist.makeimage(ff) for dist in dists for ff in dist.filelist)
+        return cls.from_images(images, **kwargs)
+
+    def save(self, filename=None):
+        '''Write the maps to a compressed .npz; returns the filename'''
+        if filename is None:
+            filename = calibration_path(self.camera)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez_compressed(filename,
+                camera=self.camera,
+                bias=self.bias,
+                dark=self.dark,
+                gain=self.gain,
+                hot_pixels=np.packbits(self.hot_pixels.ravel()),
+                image_rotation=self.image_rotation,
+                quantum_efficiency=(np.nan if self.quantum_efficiency is None
+                                        else self.quantum_efficiency),
+                num_shots=self.num_shots)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        '''Read maps written by save'''
+        with np.load(filename) as data:
+            shape = data['bias'].shape
+            hot_pixels = np.unpackbits(data['hot_pixels'])[:np.prod(shape)]
+            quantum_efficiency = float(data['quantum_efficiency'])
+            return cls(str(data['camera']),
+                        data['bias'], data['dark'], data['gain'],
+                        hot_pixels.reshape(shape).astype(bool),
+                        image_rotation=float(data['image_rotation']),
+                        quantum_efficiency=(None if np.isnan(quantum_efficiency)
+                                                else quantum_efficiency),
+                        num_shots=int(data['num_shots']))
+
+    def check_image(self, img):
+        '''Raise CalibrationError if img cannot use these maps'''
+        if img.atom_image.shape != self.shape:
+            raise CalibrationError('Image shape %s does not match calibration %s'
+                                    %(img.atom_image.shape, self.shape))
+        if img.image_rotation != self.image_rotation:
+            raise CalibrationError('Image rotation %s does not match calibration %s'
+                                    %(img.image_rotation, self.image_rotation))
+
+    def master_dark(self, image_time, window=None):
+        '''Low-noise dark frame for the given exposure, optionally cropped
+        to window = (x1, x2, y1, y2)'''
+        return self.roi(self.bias, window) + self.roi(self.dark, window) * image_time
+
+    def roi(self, cal_map, window=None):
+        '''Crop a calibration map to window = (x1, x2, y1, y2)'''
+        if window is None:
+            return cal_map
+        x1, x2, y1, y2 = window
+        return cal_map[y1:y2, x1:x2]
+
+    def counts2photoelectrons(self, counts, window=None):
+        '''Convert dark-subtracted counts to photoelectrons pixel by pixel.
+        counts is either cropped to window = (x1, x2, y1, y2) or a whole
+        frame; CalibrationError is raised for any other shape.'''
+        if np.shape(counts) == self.shape:
+            return counts * self.gain
+        gain = self.roi(self.gain, window)
+        if np.shape(counts) != gain.shape:
+            raise CalibrationError('Array shape %s matches neither window %s of '
+                                   'the calibration nor its frame %s'
+                                   %(np.shape(counts), window, self.shape))
+        return counts * gain
+
+def calibration_path(camera, calibration_dir=None):
+    '''Location of the cached calibration file for a camera'''
+    if calibration_dir is None:
+        calibration_dir = CALIBRATION_DIR
+    return os.path.join(calibration_dir, '%s.npz'%camera)
+
+def register_calibration(calibration, save=False, calibration_dir=None):
+    '''Make a calibration available to get_calibration, optionally caching it'''
+    _REGISTRY[calibration.camera] = calibration
+    if save:
+        calibration.save(calibration_path(calibration.camera, calibration_dir))
+    return calibration
+
+def get_calibration(camera, calibration_dir=None):
+    '''Return the calibration for a camera, loading it on first use'''
+    if camera not in _REGISTRY:
+        filename = calibration_path(camera, calibration_dir)
+        if not os.path.exists(filename):
+            raise CalibrationError('No calibration for camera %s at %s'
+                                    %(camera, filename))
+        _REGISTRY[camera] = CameraCalibration.load(filename)
+    return _REGISTRY[camera]
+
+def clear_registry():
+    '''Forget all loaded calibrations'''
+    _REGISTRY.clear()
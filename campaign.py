@@ -0,0 +1,215 @@
+'''campaign.py - shots from many data directories as one dataset
+
+A Campaign indexes every .mat file under a list of directories (searched
+recursively by default, and accepting glob patterns like
+'Z:\\Data\\2014-10-*'), sorted by the time the shot was taken. The index is
+lazy: building it only lists file names, and the control parameter and
+variables of a shot are read (runData only, not the frames) the first time
+a query needs them.
+
+    camp = Campaign(['Z:\\Data\\2014-10-15', 'Z:\\Data\\2014-10-16'])
+    hold = camp.select(start='2014-10-15 18:00', HoldTime=[0.1, 0.2])
+    dist = hold.distribution(workers=4)     #CloudDistribution of the union
+
+Shot times come from the ImagingGUI file names (2014-10-15_192124.mat), or
+from a dated directory name and the time in the file name, or failing that
+the file modification time.'''
+
+import os
+import re
+import glob
+import datetime
+import multiprocessing
+import numpy as np
+import scipy.io
+import instrumentation
+import cloud_image
+import cloud_distribution
+from cloud_image import FitError, FILE_RE
+
+DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+SHOT_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})_(\d{2})(\d{2})(\d{2})\.mat$')
+WORKERS = multiprocessing.cpu_count()   #default processes for per-shot work
+
+def shot_time(filename):
+    '''datetime at which the shot in filename was taken'''
+    match = SHOT_RE.search(os.path.basename(filename))
+    if match:
+        return datetime.datetime(*[int(field) for field in match.groups()])
+    dates = DATE_RE.findall(os.path.dirname(os.path.abspath(filename)))
+    clock = FILE_RE.search(os.path.basename(filename))
+    if dates and clock:
+        hhmmss = clock.group(1)
+        return datetime.datetime(*([int(field) for field in dates[-1]] +
+                        [int(hhmmss[:2]), int(hhmmss[2:4]), int(hhmmss[4:])]))
+    return datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+
+def to_datetime(when):
+    '''datetime from a datetime or a 'YYYY-MM-DD[ HH:MM[:SS]]' string'''
+    if when is None or isinstance(when, datetime.datetime):
+        return when
+    for form in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(when, form)
+        except ValueError:
+            pass
+    raise ValueError('Cannot read the time %r'%when)
+
+def find_mat_files(directories, recursive=True):
+    '''.mat files in directories (glob patterns allowed), and in their
+    subdirectories if recursive'''
+    files = []
+    for pattern in directories:
+        for directory in sorted(glob.glob(pattern)) or [pattern]:
+            if recursive:
+                for root, subdirectories, names in os.walk(directory):
+                    subdirectories.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names)
+                                    if name.lower().endswith('.mat'))
+            else:
+                files.extend(cloud_distribution.find_files(directory))
+    return files
+
+def read_metadata(filename):
+    '''control parameter and variables of a shot, read without the frames'''
+    mat_file = scipy.io.loadmat(filename, variable_names=['runData'],
+                                squeeze_me=True, struct_as_record=False)
+    run_data = mat_file['runData']
+    metadata = {}
+    try:
+        for variable in np.atleast_1d(run_data.vars):
+            metadata[variable.name] = variable.value
+    except AttributeError:
+        pass #data too old to have saved variables
+    metadata['cont_par_name'] = run_data.ContParName
+    metadata['cont_par'] = run_data.CurrContPar
+    return metadata
+
+def _shot_gaussian_params(args):
+    '''gaussian fit results and metadata of one file, None on a fit error;
+    run in worker processes'''
+    this_file, custom_fit_window, fit_options = args
+    this_img = cloud_image.CloudImage(this_file)
+    try:
+        params = cloud_distribution.gaussian_params(this_img, custom_fit_window,
+                                                    **fit_options)
+    except FitError:
+        return None
+    params['metadata'] = cloud_distribution.image_metadata(this_img)
+    return params
+
+class Campaign(object):
+    '''Time-ordered index of the shots in many directories'''
+    def __init__(self, directories=None, recursive=True, files=None):
+        if files is None:
+            if isinstance(directories, basestring):
+                directories = [directories]
+            files = find_mat_files(directories, recursive)
+        times = [shot_time(this_file) for this_file in files]
+        order = sorted(range(len(files)), key=lambda index: (times[index], files[index]))
+        self.filelist = [files[index] for index in order]
+        self.times = [times[index] for index in order]
+        self._metadata = {}
+
+    def __len__(self):
+        return len(self.filelist)
+
+    def metadata(self, this_file):
+        '''control parameter and variables of a file, read once'''
+        if this_file not in self._metadata:
+            self._metadata[this_file] = read_metadata(this_file)
+        return self._metadata[this_file]
+
+    def dates(self):
+        '''days on which shots were taken'''
+        return sorted(set(this_time.date() for this_time in self.times))
+
+    def select(self, start=None, end=None, **values):
+        '''Campaign of the shots taken from start up to (not including) end
+        whose variables or control parameter (by name, or 'cont_par') take
+        the given values; a list or tuple allows any of several values'''
+        start = to_datetime(start)
+        end = to_datetime(end)
+        chosen = []
+        for this_file, this_time in zip(self.filelist, self.times):
+            if start is not None and this_time < start:
+                continue
+            if end is not None and this_time >= end:
+                continue
+            if values and not self._matches(self.metadata(this_file), values):
+                continue
+            chosen.append((this_file, this_time))
+        subset = Campaign(files=[])
+        subset.filelist = [this_file for this_file, this_time in chosen]
+        subset.times = [this_time for this_file, this_time in chosen]
+        subset._metadata = self._metadata
+        return subset
+
+    @staticmethod
+    def _matches(metadata, values):
+        for name, wanted in values.items():
+            if name in metadata:
+                value = metadata[name]
+            elif metadata.get('cont_par_name') == name:
+                value = metadata['cont_par']
+            else:
+                return False
+            if not isinstance(wanted, (list, tuple, set)):
+                wanted = [wanted]
+            if not any(np.all(value == choice) for choice in wanted):
+                return False
+        return True
+
+    def map(self, func, workers=None):
+        '''[func(file) for every file], in worker processes; func must be
+        a module-level function'''
+        workers = WORKERS if workers is None else workers
+        if workers <= 1 or len(self.filelist) < 2:
+            return [func(this_file) for this_file in self.filelist]
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(func, self.filelist,
+                            chunksize=max(len(self.filelist) // (4 * workers), 1))
+        finally:
+            pool.close()
+            pool.join()
+
+    def distribution(self, workers=None, INITIALIZE_GAUSSIAN_PARAMS=True):
+        '''CloudDistribution of all the shots, with the gaussian fits done
+        in workers processes. It has no directory, so update() does not add
+        shots the campaign did not select. The double gaussian and overlap
+        modes of cloud_distribution are not supported.'''
+        dist = cloud_distribution.CloudDistribution(None, False,
+                                                    files=self.filelist)
+        if not INITIALIZE_GAUSSIAN_PARAMS:
+            return dist
+        if cloud_distribution.DOUBLE_GAUSSIAN or cloud_distribution.OVERLAP:
+            raise NotImplementedError('Campaign distributions support single '
+                                      'gaussian fits only (DOUBLE_GAUSSIAN and '
+                                      'OVERLAP must be False)')
+        if cloud_distribution.USE_FIRST_WINDOW and self.filelist:
+            first_img = dist.makeimage(self.filelist[0])
+            dist.custom_fit_window = [first_img.trunc_win_x[0],
+                                      first_img.trunc_win_x[-1],
+                                      first_img.trunc_win_y[0],
+                                      first_img.trunc_win_y[-1]]
+        workers = WORKERS if workers is None else workers
+        window = (dist.custom_fit_window if cloud_distribution.CUSTOM_FIT_SWITCH
+                    else None)
+        jobs = [(this_file, window, dist.gaussian_fit_options)
+                    for this_file in self.filelist]
+        if workers <= 1:
+            results = [_shot_gaussian_params(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(_shot_gaussian_params, jobs,
+                                   chunksize=max(len(jobs) // (4 * workers), 1))
+            finally:
+                pool.close()
+                pool.join()
+        instrumentation.count('fit_errors', sum(1 for result in results
+                                                    if result is None))
+        dist.shot_params = dict(zip(self.filelist, results))
+        dist.add_gaussian_params(self.filelist, **dist.gaussian_fit_options)
+        return dist
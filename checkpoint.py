@@ -0,0 +1,86 @@
+'''checkpoint.py - per-shot results saved while a long analysis runs
+
+A Checkpoint keeps the results of every shot analysed so far, keyed by file
+name and fingerprinted by file size and modification time, together with
+the analysis options they were computed with. It is written to a JSON file
+every CHECKPOINT_EVERY shots, so an interrupted run over thousands of files
+resumes where it stopped, and a rerun after new files arrive only analyses
+the new ones. Results computed with different options are ignored.
+Used by CloudDistribution(checkpoint=...).'''
+
+import os
+import json
+import hashlib
+from dataset_store import _encode, _decode
+
+CHECKPOINT_EVERY = 200      #write the checkpoint after this many new shots
+CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.becy_cache', 'checkpoints')
+
+def fingerprint(filename):
+    '''(size, modification time) of a file; None for shots in a dataset
+    store, which have no file of their own'''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def default_path(directory, options):
+    '''checkpoint file for a directory and set of options'''
+    key = hashlib.md5(json.dumps([os.path.abspath(directory or ''),
+                                  _encode(options)], sort_keys=True).encode('utf-8'))
+    return os.path.join(CHECKPOINT_DIR, key.hexdigest() + '.json')
+
+class Checkpoint(object):
+    '''Results of shots analysed with options, saved to filename.
+    results maps file name -> result (None for a shot whose fit failed).'''
+    def __init__(self, filename, options):
+        self.filename = filename
+        self.options = _encode(options)
+        self.results = {}
+        self.fingerprints = {}
+        self._unsaved = 0
+        if os.path.exists(filename):
+            with open(filename) as ff:
+                saved = json.load(ff)
+            if saved['options'] == json.loads(json.dumps(self.options)):
+                for this_file, (this_fingerprint, result) in saved['shots'].items():
+                    if this_fingerprint == fingerprint(this_file):
+                        self.fingerprints[this_file] = this_fingerprint
+                        self.results[this_file] = _decode(result)
+            else:
+                print('Checkpoint %s was made with other options; starting again'
+                        %filename)
+
+    def __contains__(self, this_file):
+        return this_file in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def add(self, this_file, result):
+        '''Record the result of a shot, saving every CHECKPOINT_EVERY shots'''
+        self.results[this_file] = result
+        self.fingerprints[this_file] = fingerprint(this_file)
+        self._unsaved += 1
+        if self._unsaved >= CHECKPOINT_EVERY:
+            self.save()
+
+    def save(self):
+        '''Write the checkpoint, replacing the old one only once complete'''
+        if not self._unsaved and os.path.exists(self.filename):
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_file = self.filename + '.tmp'
+        with open(temp_file, 'w') as ff:
+            json.dump({'options': self.options,
+                       'shots': dict((this_file, [self.fingerprints[this_file],
+                                                  _encode(result)])
+                                     for this_file, result in self.results.items())},
+                      ff)
+        if os.path.exists(self.filename):
+            os.remove(self.filename) #os.rename does not replace on Windows
+        os.rename(temp_file, self.filename)
+        self._unsaved = 0
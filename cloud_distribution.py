@@ -3,9 +3,6 @@
 This is a class definition for getting distributional
 information over a set of cloud images in a single directory.'''
 
-import fittemp
-from scipy.cluster.vq import kmeans, vq
-from scipy.optimize import curve_fit
 import cloud_image
 from cloud_image import FitError
 import numpy as np
@@ -14,11 +11,28 @@ import matplotlib.pyplot as plt
 from scipy import stats
 import math
 import hempel
+from running_stats import RunningStats
 import pprint
 import fit_double_gaussian as fdg
-import platform
+import os
+import csv
+import json
+import functools
+from itertools import compress
+import instrumentation
+import dataset_store
+import frame_cache
+import prefetch
+import checkpoint
+import allan
+import resampling
+import grouping
+import temperature
+import clustering
+import oscillation
 from BECphysics import M, KB, GRAVITY
-from fit_functions import temp_func, lifetime_func, freq_func, magnif_func
+from fit_functions import (curve_fit, temp_func, lifetime_func, freq_func,
+                           damped_freq_func, magnif_func)
 
 # Flags for setting module behavior
 DEBUG_FLAG = False                  #Debug mode; shows each fit
@@ -35,34 +49,130 @@ OVERLAP = False                      #True if the data is actually two gaussians
 if DOUBLE_GAUSSIAN:
     OVERLAP = False         #always fit single gaussian if the two gaussians overlap
 
+PREFETCH_DEPTH = 4                  #images loaded ahead in background threads; 0 loads in the loop
+PREFETCH_WORKERS = 2                #background loading threads
+PREFETCH_MAX_MB = 512               #pause loading ahead while waiting images hold this much
+
 CUSTOM_FIT_WINDOW = [393,623,154,155]   #x0, x1, y0, y1, no atoms
 #CUSTOM_FIT_WINDOW = [393,623,158,176]   #x0, x1, y0, y1, unperturbed at 40 A
 
 CAMPIXSIZE = 3.75e-6 #m, physical size of camera pixel
 cloud_width = 1.0*10**-6.0 #used in OVERLAP, assuming the overlapping gaussians both have the same sigma of 1um
+
+SAVE_VERSION = 2 #format of files written by CloudDistribution.save
+
+GAUSSIAN_PARAMS = ['atom_number', 'position_x', 'position_z', 'width_x',
+                   'width_z', 'light_counts', 'timestamp', 'tof']
+
+def find_files(directory):
+    '''sorted .mat files in a data directory'''
+    return sorted(glob.glob(os.path.join(directory, '*.mat')))
+
+def gaussian_params(this_img, custom_fit_window=None, **kwargs):
+    '''return cloud parameters extracted from gaussian fits to an image,
+    truncated to custom_fit_window if given'''
+    with instrumentation.stage('shot'):
+        if custom_fit_window is not None:
+            this_img.truncate_image(*custom_fit_window)
+        this_gaussian_params = this_img.get_gaussian_fit_params(**kwargs)
+        this_gaussian_params['timestamp'] = this_img.timestamp()
+        this_gaussian_params['tof'] = this_img.curr_tof
+    return this_gaussian_params
            
 
+def lifetime_of(times, numbers, indices):
+    '''lifetime fitted to the shots at indices; a per-sample statistic
+    for resampling'''
+    p0 = np.array([numbers[0], 0.2, 0])
+    popt, _ = curve_fit(lifetime_func, times[indices], numbers[indices], p0)
+    return 1 / popt[1]
+
+def temperature_of(tofs, widths, indices):
+    '''temperature fitted to the shots at indices; a per-sample statistic
+    for resampling'''
+    p0 = np.array([np.min(widths), 0.002])
+    popt, _ = curve_fit(temp_func, tofs[indices], widths[indices], p0)
+    return M * popt[1]**2 / KB
+
+def _column_array(column):
+    '''column of dists as a numeric or string array, or None if it holds
+    something else'''
+    try:
+        array = np.asarray(column)
+    except ValueError:
+        return None
+    if array.ndim != 1:
+        return None
+    if array.dtype.kind in 'biufSU':
+        return array
+    try:
+        return np.asarray(column, dtype=float) #None -> NaN
+    except (TypeError, ValueError):
+        return None
+
+def _plot_fit(fit, title=True):
+    '''plot data and fit curve from one of the *_fit methods and show it'''
+    plt.plot(fit['x'], fit['y'], '.')
+    plt.plot(fit['fit_x'], fit['fit_y'])
+    plt.xlabel(fit['xlabel'])
+    plt.ylabel(fit['ylabel'])
+    if title:
+        plt.title(fit['title'])
+    plt.show()
+
+def image_metadata(this_img):
+    '''control parameter and variables of an image'''
+    try:
+        metadata = dict(this_img.get_variables_values() or {})
+    except AttributeError:
+        metadata = {}
+    metadata['cont_par_name'] = this_img.cont_par_name
+    metadata['cont_par'] = this_img.curr_cont_par
+    return metadata
+
 class CloudDistribution(object):
     '''class representing distributions of parameters over many images'''
 
-    def __init__(self, directory=None, INITIALIZE_GAUSSIAN_PARAMS=True):
+    def __init__(self, directory=None, INITIALIZE_GAUSSIAN_PARAMS=True,
+                    shots=None, checkpoint=None, files=None):
+        '''directory is a data directory or a store made by dataset_store;
+        files is a list of .mat files to use instead of those in directory;
+        shots optionally selects files by index or slice. checkpoint is a
+        file name, or True for one in checkpoint.CHECKPOINT_DIR, where the
+        gaussian fits are saved as they go and resumed from.'''
 
         self.directory = directory
         self.INITIALIZE_GAUSSIAN_PARAMS = INITIALIZE_GAUSSIAN_PARAMS
-        self.makeimage = cloud_image.CloudImage
+        self.image_class = cloud_image.CloudImage
+        self.makeimage = self.image_class
+        self.store = None
+        self.frame_cache = None
+        self.checkpoint_file = checkpoint
+        self.checkpoint = None
+        self.shot_params = None #file -> gaussian fit results, None for fit errors
+        self.value_kwargs = {}  #var -> kwargs of distributions made by values()
+        self.metadata = []      #variables and control parameter of each row of dists
 
-        print self.directory
+        if self.directory is not None:
+            print self.directory
 
         # Find all .mat files
-        if platform.system()=='Darwin' or platform.system()=='Linux':
-            #this step checks if we are running in Mac OS and change the format of the directory
-            self.filelist = sorted(glob.glob(self.directory + '*.mat')) #just a MAC OS directory difference
+        if files is not None:
+            self.filelist = list(files)
+        elif dataset_store.is_store(self.directory):
+            self.store = dataset_store.DatasetStore(self.directory)
+            self.filelist = list(self.store.filenames)
+            self.makeimage = self.store.image
         else:
-            self.filelist = sorted(glob.glob(self.directory + '\\*.mat'))
+            self.filelist = find_files(self.directory)
+        if shots is not None:
+            self.filelist = [str(ff) for ff in
+                                np.atleast_1d(np.array(self.filelist)[shots])]
         self.numimgs = len(self.filelist)
         self.dists = {}
         self.outliers = {}
         self.cont_par_name = None
+        self.calibration = None
         
         self.custom_fit_window = CUSTOM_FIT_WINDOW
         
@@ -80,17 +190,49 @@ class CloudDistribution(object):
             print("Initializing Gaussian Parameters")
             self.initialize_gaussian_params(**self.gaussian_fit_options)
         
+    def use_calibration(self, calibration=True):
+        '''Apply per-pixel camera calibration maps to every image made from
+        now on. Pass a CameraCalibration, or True to use the cached
+        calibration for each image's camera.'''
+        self.calibration = calibration
+        self.makeimage = functools.partial(self.makeimage,
+                                            calibration=calibration)
+
+    def use_frame_cache(self, cache_dir=None, window=None):
+        '''Serve images from a memory-mapped cache of the raw frames, filled
+        on the first pass over the files. window = (x1, x2, y1, y2) caches
+        only that part of the raw frames. See frame_cache.'''
+        if self.store is not None:
+            raise ValueError('Images already come from a dataset store')
+        self.frame_cache = frame_cache.FrameCache(self.filelist, cache_dir, window)
+        self.makeimage = functools.partial(self.frame_cache.image,
+                                            image_class=self.image_class)
+        if self.calibration is not None:
+            self.use_calibration(self.calibration)
+        return self.frame_cache
+
+    def iter_images(self, load=True, files=None):
+        '''Yield (index from 1, file name, image) for every file (or just
+        files), reporting progress. Images are loaded PREFETCH_DEPTH ahead
+        in background threads; with load=False the image is None.'''
+        files = self.filelist if files is None else files
+        if not load:
+            images = ((this_file, None) for this_file in files)
+        elif PREFETCH_DEPTH > 0:
+            images = prefetch.Prefetcher(files, self.makeimage,
+                                    PREFETCH_DEPTH, PREFETCH_WORKERS, PREFETCH_MAX_MB)
+        else:
+            images = ((this_file, self.makeimage(this_file))
+                        for this_file in files)
+        for index, (this_file, this_img) in enumerate(images):
+            instrumentation.progress(index + 1, len(files), this_file)
+            yield index + 1, this_file, this_img
+
     def initialize_gaussian_params(self, **kwargs):
         '''Calculate the most commonly used parameters
         that can be extracted from a gaussian fit'''
-        self.dists['atom_number'] = []
-        self.dists['position_x'] = []
-        self.dists['position_z'] = []
-        self.dists['width_x'] = []
-        self.dists['width_z'] = []
-        self.dists['light_counts'] = []
-        self.dists['timestamp'] = []
-        self.dists['tof'] = []
+        for key in GAUSSIAN_PARAMS:
+            self.dists[key] = []
         
         if OVERLAP:
             self.dists['d_peaks']=[] #inferred distance between two gaussians that are overlapping
@@ -104,41 +246,25 @@ class CloudDistribution(object):
             self.dists['sigma_2']=[]#width of second peak
             self.dists['sample_position']=[]#position of the sample, i.e. mid point of position_1 and position_2
 
-        index = 1
         if DOUBLE_GAUSSIAN:
             #p_0=fdg.fit_double_gaussian_1d(self.filelist[0],True)
             p_0= [20.,20.,21.,34.,3.5,3.2,288.,-2.9] # guess params for double gaussian fit in pixels or OD 
             #[amplitude of 1st peak, amplitude of 2nd peak, position_1, position_2, sigma_1, sigma_2,offset,slope]
-        for this_file in self.filelist:
-            if USE_FIRST_WINDOW and index == 1:
-                first_img = self.makeimage(this_file)
-                self.custom_fit_window = [first_img.trunc_win_x[0],
-                                     first_img.trunc_win_x[-1],
-                                     first_img.trunc_win_y[0],
-                                     first_img.trunc_win_y[-1]]
-                
-            print 'Processing File %d' % index
-            index += 1
-            if not DOUBLE_GAUSSIAN:
-                try:
-                    this_img_gaussian_params = \
-                                self.get_gaussian_params(this_file, **kwargs)
-
-                    for key in this_img_gaussian_params.keys():
-                        try:
-                            self.dists[key].append(this_img_gaussian_params[key])
-                        except AttributeError:
-                            print '''Invalid Method Name %s;
-                            CloudDistribution and CloudImage are out of sync!'''%key
-                            raise AttributeError
-                        # relies on same names in this and CloudImage.py!!
+        if USE_FIRST_WINDOW and self.filelist:
+            first_img = self.makeimage(self.filelist[0])
+            self.custom_fit_window = [first_img.trunc_win_x[0],
+                                 first_img.trunc_win_x[-1],
+                                 first_img.trunc_win_y[0],
+                                 first_img.trunc_win_y[-1]]
 
-                except FitError:
-                    print 'Fit Error'
-                
-                
-                        
-            else:
+        if not DOUBLE_GAUSSIAN:
+            self.shot_params = {}
+            if self.checkpoint_file is not None:
+                self.checkpoint = self.open_checkpoint(**kwargs)
+                self.shot_params = self.checkpoint.results
+            self.add_gaussian_params(self.filelist, **kwargs)
+        else:
+            for index, this_file, this_img in self.iter_images(load=False):
                 #fit data to double gaussians
                 print "Processing " + this_file
                 self.get_double_gaussian_params(this_file,p_0)
@@ -150,28 +276,230 @@ class CloudDistribution(object):
                     self.dists['h_from_sample'].append(1/i*np.sqrt((i**4.0-cloud_width**4.0)/2.0))
                 
 
+    def open_checkpoint(self, **kwargs):
+        '''Checkpoint of gaussian fits made with kwargs and the current fit
+        window; see the checkpoint module'''
+        options = {'fit_options': kwargs,
+                   'custom_fit_window': (self.custom_fit_window
+                                            if CUSTOM_FIT_SWITCH else None),
+                   'image_class': self.image_class.__name__}
+        filename = self.checkpoint_file
+        if filename is True:
+            filename = checkpoint.default_path(self.directory, options)
+        return checkpoint.Checkpoint(filename, options)
+
+    def add_gaussian_params(self, files, **kwargs):
+        '''Fit the files that have no results yet, then rebuild the
+        gaussian parameter distributions in file order'''
+        todo = [this_file for this_file in files
+                    if this_file not in self.shot_params]
+        try:
+            for index, this_file, this_img in self.iter_images(files=todo):
+                try:
+                    this_img_gaussian_params = \
+                                self.image_gaussian_params(this_img, **kwargs)
+                    this_img_gaussian_params['metadata'] = \
+                                self.image_metadata(this_img)
+                except FitError:
+                    print 'Fit Error'
+                    instrumentation.count('fit_errors')
+                    this_img_gaussian_params = None
+                if self.checkpoint is not None:
+                    self.checkpoint.add(this_file, this_img_gaussian_params)
+                else:
+                    self.shot_params[this_file] = this_img_gaussian_params
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.save()
+        for key in GAUSSIAN_PARAMS:
+            self.dists[key] = []
+        self.metadata = []
+        for this_file in self.filelist:
+            this_img_gaussian_params = self.shot_params.get(this_file)
+            if this_img_gaussian_params is None:
+                continue
+            self.metadata.append(this_img_gaussian_params.get('metadata', {}))
+            for key in this_img_gaussian_params.keys():
+                if key == 'metadata':
+                    continue
+                try:
+                    self.dists[key].append(this_img_gaussian_params[key])
+                except KeyError:
+                    print '''Invalid Method Name %s;
+                    CloudDistribution and CloudImage are out of sync!'''%key
+                    raise AttributeError
+                # relies on same names in this and CloudImage.py!!
+
+    def image_metadata(self, this_img):
+        '''control parameter and variables of an image, kept with its
+        gaussian fit so that shots can be grouped without reopening files'''
+        return image_metadata(this_img)
+
+    def column(self, var):
+        '''values of var for every row of dists: a distribution, a variable
+        or control parameter from the metadata (NaN where a shot does not
+        have it), or else a new distribution from values(). Raises
+        ValueError for a distribution whose rows are not those of the
+        metadata (one per successful fit), e.g. one made per file by
+        values() when some fits failed.'''
+        if var not in self.dists and any(var in row or row.get('cont_par_name') == var
+                                            for row in self.metadata):
+            return [row.get(var, row['cont_par'] if row.get('cont_par_name') == var
+                                    else np.nan)
+                    for row in self.metadata]
+        if var not in self.dists and not self.does_var_exist(var):
+            raise KeyError(var)
+        values = self.dists[var]
+        if self.metadata and len(values) != len(self.metadata):
+            raise ValueError('%s has %d rows, but the distribution has %d shots '
+                             'with gaussian fits'%(var, len(values), len(self.metadata)))
+        return values
+
+    def group_by(self, key):
+        '''grouping.GroupBy of the rows of dists by key, e.g. 'cont_par',
+        the control parameter name or a variable name'''
+        return grouping.GroupBy(self.column(key))
+
+    def group_stats(self, key, var):
+        '''count, mean, std, sem, median and mad of var in each group of
+        rows with the same key'''
+        return self.group_by(key).stats(self.column(var))
+
+    def group_ttests(self, key, var):
+        '''Welch t-tests of var between every pair of groups of key'''
+        return self.group_by(key).ttests(self.column(var))
+
+    def update(self):
+        '''Add files that have appeared in the directory since the
+        distribution was made, fitting only those. Distributions made with
+        values() are extended; other derived ones are dropped, to be
+        recalculated when next asked for.'''
+        if self.store is not None or self.directory is None:
+            return []
+        if self.value_kwargs is None:
+            raise ValueError('Distribution was loaded from a file saved without '
+                             'its fit results; make it again from %s to update'
+                             %self.directory)
+        known = set(self.filelist)
+        new_files = [this_file for this_file in find_files(self.directory)
+                        if this_file not in known]
+        if not new_files:
+            return new_files
+        self.filelist.extend(new_files)
+        self.numimgs = len(self.filelist)
+        gaussian_keys = set(GAUSSIAN_PARAMS)
+        for key in list(self.dists.keys()):
+            if key not in gaussian_keys and key not in self.value_kwargs:
+                del self.dists[key]
+        value_kwargs = self.value_kwargs
+        if self.shot_params is not None:
+            self.add_gaussian_params(new_files, **self.gaussian_fit_options)
+            value_kwargs = dict((var, kwargs) for var, kwargs in value_kwargs.items()
+                                    if var not in gaussian_keys)
+        if value_kwargs:
+            for index, this_file, this_img in self.iter_images(files=new_files):
+                for var, kwargs in value_kwargs.items():
+                    self.dists[var].append(self.image_value(this_img, var, **kwargs))
+        return new_files
+
+    def save(self, filename, compressed=True):
+        '''Write dists, outliers and the analysis options to a .npz file.
+        Columns of numbers or strings become arrays; anything else (e.g.
+        temperature_groups), the metadata and the per-file fit results
+        (so that a loaded distribution can still be updated) are stored
+        as JSON.'''
+        arrays = {}
+        other_dists = {}
+        for var, column in self.dists.items():
+            array = _column_array(column)
+            if array is None:
+                other_dists[var] = column
+            else:
+                arrays['dists/' + var] = array
+        for var, mask in self.outliers.items():
+            arrays['outliers/' + var] = np.asarray(mask, dtype=bool)
+        info = {'version': SAVE_VERSION,
+                'directory': self.directory,
+                'filelist': self.filelist,
+                'cont_par_name': self.cont_par_name,
+                'gaussian_fit_options': self.gaussian_fit_options,
+                'custom_fit_window': list(self.custom_fit_window),
+                'other_dists': dataset_store._encode(other_dists),
+                'metadata': dataset_store._encode(self.metadata),
+                'shot_params': dataset_store._encode(self.shot_params),
+                'value_kwargs': dataset_store._encode(self.value_kwargs)}
+        arrays['info'] = np.array(json.dumps(info))
+        if compressed:
+            np.savez_compressed(filename, **arrays)
+        else:
+            np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        '''CloudDistribution saved by save(), without reopening any image'''
+        with np.load(filename) as saved:
+            info = json.loads(str(saved['info']))
+            dist = cls(info['directory'], False, files=info['filelist'])
+            for key in saved.files:
+                kind, _, var = key.partition('/')
+                if kind == 'dists':
+                    dist.dists[var] = saved[key].tolist()
+                elif kind == 'outliers':
+                    dist.outliers[var] = saved[key]
+        dist.dists.update((str(var), column) for var, column in
+                            dataset_store._decode(info['other_dists']).items())
+        dist.metadata = dataset_store._decode(info['metadata'])
+        dist.cont_par_name = info['cont_par_name']
+        dist.gaussian_fit_options = info['gaussian_fit_options']
+        dist.custom_fit_window = info['custom_fit_window']
+        if info['version'] < 2:
+            # saved without shot_params and value_kwargs; update() refuses
+            dist.value_kwargs = None
+        else:
+            dist.shot_params = dataset_store._decode(info['shot_params'])
+            dist.value_kwargs = dict((str(var), kwargs) for var, kwargs in
+                            dataset_store._decode(info['value_kwargs']).items())
+        return dist
+
+    def to_csv(self, filename, columns=None):
+        '''Write the distributions with one value per row of dists (or
+        just columns) to a CSV file, one row per shot'''
+        if columns is None:
+            num_rows = len(self.dists.get('atom_number', []))
+            columns = sorted(var for var, column in self.dists.items()
+                                if len(column) == num_rows
+                                    and _column_array(column) is not None)
+        with open(filename, 'wb') as ff:
+            writer = csv.writer(ff)
+            writer.writerow(columns)
+            for row in zip(*[self.dists[var] for var in columns]):
+                writer.writerow(row)
+
+    def lean_images(self, keep='roi', **kwargs):
+        '''Return a LeanImage per file, truncated to the custom fit window
+        if CUSTOM_FIT_SWITCH is set. See CloudImage.lean for keep.'''
+        lean_imgs = []
+        for index, this_file, this_img in self.iter_images():
+            if CUSTOM_FIT_SWITCH:
+                this_img.truncate_image(*self.custom_fit_window)
+            lean_imgs.append(this_img.lean(keep, **kwargs))
+        return lean_imgs
+
     def get_gaussian_params(self, file, **kwargs):
         '''return cloud parameters extracted from gaussian fits'''
-        this_img = self.makeimage(file)
-        if CUSTOM_FIT_SWITCH:
-            this_img.truncate_image(*self.custom_fit_window)
-        gaussian_params = \
-                    this_img.get_gaussian_fit_params(**kwargs)
-        gaussian_params['timestamp'] = this_img.timestamp()
-        gaussian_params['tof'] = this_img.curr_tof
-        return gaussian_params
+        return self.image_gaussian_params(self.makeimage(file), **kwargs)
+
+    def image_gaussian_params(self, this_img, **kwargs):
+        '''return cloud parameters extracted from gaussian fits to an image'''
+        return gaussian_params(this_img,
+                    self.custom_fit_window if CUSTOM_FIT_SWITCH else None, **kwargs)
 
 
     def control_param_dist(self):
         '''Create a distribution for the control parameter'''
         self.cont_par_name = None
-        index = 1
         cont_pars = []
-        for this_file in self.filelist:
-            print 'Processing File %d' % index
-            index += 1
-
-            this_img = self.makeimage(this_file)
+        for index, this_file, this_img in self.iter_images():
             this_img_cont_par_name = this_img.cont_par_name
             if self.cont_par_name is None:
                 self.cont_par_name = this_img_cont_par_name
@@ -183,90 +511,100 @@ class CloudDistribution(object):
             cont_pars.append(this_img.curr_cont_par)
         self.dists[self.cont_par_name] = cont_pars
 
+    def temperature_labels(self):
+        '''time-of-flight series of each shot, from the shot times and
+        TOFs; see temperature.sequence_groups'''
+        times = None
+        if len(self.dists.get('timestamp', [])) == len(self.dists['tof']):
+            times = allan.timestamp_seconds(self.dists['timestamp'])
+        return temperature.sequence_groups(self.dists['tof'], times)
+
     def temperature_groups(self):
         '''Create a list of lists of images in the same temperature set'''
-        # This method assumes without warrant that the images are sorted
-        # by timestamp in each distribution. Does that make me a bad person?
-        tempseq = []
-        seqs = []
-        last_TOF = -1 # All valid TOFs are larger than this.
-        for index, this_TOF in enumerate(self.dists['tof']):
-            if this_TOF < last_TOF:
-                seqs.append(tempseq)
-                tempseq = []
-                tempseq.append(index)
-            else:
-                tempseq.append(index)
-            last_TOF = this_TOF
-        seqs.append(tempseq)
-        self.dists['temperature_groups'] = seqs
+        groups = grouping.GroupBy(self.temperature_labels())
+        self.dists['temperature_groups'] = [list(indices)
+                                            for indices in groups.indices()]
 
     def temp_dist(self):
-        '''Calculate temperatures, given temperature groups'''
-        # code for checking that temp groups exists needed
-        self.temperature_groups()
-        temp_x = []
-        temp_z = []
-        for temp_group in self.dists['temperature_groups']:
-            this_widths_x = [self.dists['width_x'][index]
-                                for index in temp_group]
-            this_widths_z = [self.dists['width_z'][index]
-                                for index in temp_group]
-            this_tofs = [self.dists['tof'][index] for index in temp_group]
-            this_temp_x, _ = fittemp.fittemp(this_tofs, this_widths_x)
-            this_temp_z, _ = fittemp.fittemp(this_tofs, this_widths_z)
-            temp_x.append(this_temp_x)
-            temp_z.append(this_temp_z)
-        self.dists['temp_x'] = temp_x
-        self.dists['temp_z'] = temp_z
-
+        '''Calculate temperatures of all temperature groups in one batched
+        fit; returns the temperature.fit_temperatures results, with axes
+        x and z'''
+        labels = self.temperature_labels()
+        groups = grouping.GroupBy(labels)
+        self.dists['temperature_groups'] = [list(indices)
+                                            for indices in groups.indices()]
+        widths = np.column_stack([self.dists['width_x'], self.dists['width_z']])
+        results = temperature.fit_temperatures(self.dists['tof'], widths, labels)
+        self.dists['temp_x'] = list(results['temperature'][:, 0])
+        self.dists['temp_z'] = list(results['temperature'][:, 1])
+        self.dists['temp_x_err'] = list(results['temperature_err'][:, 0])
+        self.dists['temp_z_err'] = list(results['temperature_err'][:, 1])
+        return results
 
     def values(self, var, **kwargs):
         '''Create a distribution for variable var, either
         from the variables file or by calling a CloudImage method'''
         var_dist = []
-        index = 1
-        for this_file in self.filelist:
-            print 'Processing File %d' % index
-            index += 1
-            try:  # First assume it is in the variables
-                this_img = self.makeimage(this_file)
-                this_value = this_img.get_variables_values()[var]
-                # raises an AttributeError if the data is
-                # too old to have saved variables, or
-            # Now see if it is a method name
-            except (KeyError, AttributeError):
-                try:
-                    this_img = self.makeimage(this_file)
-                    exec('this_value = this_img.' + var + '(**kwargs)')
-                except AttributeError:
-                    print 'Invalid Method Name'
-                    raise AttributeError
-                except cloud_image.FitError:
-                    print 'Fit Error'
-                # Add call to Matt's code for dealing with older data!
-            var_dist.append(this_value)
+        for index, this_file, this_img in self.iter_images():
+            var_dist.append(self.image_value(this_img, var, **kwargs))
         self.dists[var] = var_dist
+        if self.value_kwargs is not None:
+            self.value_kwargs[var] = kwargs
+
+    def image_value(self, this_img, var, **kwargs):
+        '''Value of variable var for one image, from the variables file or
+        by calling the CloudImage method of that name; None on a fit error'''
+        this_value = None
+        try:  # First assume it is in the variables
+            this_value = this_img.get_variables_values()[var]
+            # raises an AttributeError if the data is
+            # too old to have saved variables, or
+        # Now see if it is a method name
+        except (KeyError, AttributeError):
+            try:
+                this_value = getattr(this_img, var)(**kwargs)
+            except AttributeError:
+                print 'Invalid Method Name'
+                raise AttributeError
+            except cloud_image.FitError:
+                print 'Fit Error'
+                instrumentation.count('fit_errors')
+            # Add call to Matt's code for dealing with older data!
+        return this_value
 
-    def find_outliers(self, var, nMADM):
+    def find_outliers(self, var, nMADM, window=None):
         '''Add an entry to the outliers dictionary for the given variable,
-        of the form {var : [list of outlier indices]}'''
-        _, bad_indices = hempel.hempel_filter(self.dists[var], nMADM)
-        self.outliers[var] = bad_indices
+        of the form {var : boolean mask, True for outliers}. window is the
+        number of shots in a rolling median; None uses the global median.'''
+        if window is None:
+            self.outliers[var] = hempel.hempel_mask(self.dists[var], nMADM)
+        else:
+            self.outliers[var] = hempel.rolling_hempel_mask(self.dists[var],
+                                                            nMADM, window)
+        return self.outliers[var]
 
-    def remove_outliers(self, var, nMADM = 4):
+    def remove_outliers(self, var, nMADM = 4, window=None):
         '''Remove entries from all distributions for which the given
-        variable is an outlier.'''
+        variable is an outlier. Raises ValueError, changing nothing, if a
+        distribution has a different number of rows than var (e.g. one
+        made per file when some fits failed).'''
         if not self.does_var_exist(var):
             print '%s does not exist!'%var
             return
         if var not in self.outliers.keys():
-            self.find_outliers(var, nMADM)
-        bad_indices = self.outliers[var]
+            self.find_outliers(var, nMADM, window)
+        keep = ~self.outliers[var]
+        mismatched = [variable for variable in self.dists.keys()
+                        if len(self.dists[variable]) != len(keep)]
+        if mismatched:
+            raise ValueError('Cannot remove outliers of %s (%d rows): %s have '
+                             'other lengths'%(var, len(keep), ', '.join(
+                                '%s (%d)'%(variable, len(self.dists[variable]))
+                                for variable in mismatched)))
         for variable in self.dists.keys():
-            temp_dist = [j for i, j in enumerate(self.dists[variable])
-                            if i not in bad_indices]
-            self.dists[variable] = temp_dist
+            self.dists[variable] = list(compress(self.dists[variable], keep))
+        if len(self.metadata) == len(keep):
+            self.metadata = list(compress(self.metadata, keep))
 
     def does_var_exist(self, var, **kwargs):
         '''Check to see if the variable has a distribution defined.
@@ -366,6 +704,72 @@ class CloudDistribution(object):
     def allan_dev(self, var):
         return self.calc_statistic(var, lambda x: math.sqrt(0.5*np.mean(np.diff(x)**2)))
 
+    def allan_curve(self, var, taus=None, modified=False, use_timestamps=False,
+                        confidence=allan.CONFIDENCE):
+        '''Allan deviation of var over averaging times taus, in shots, or in
+        seconds between the file name timestamps with use_timestamps.
+        Returns an allan.AllanCurve of taus, adev, lower, upper, num.'''
+        values = self.column(var)
+        times = None
+        if use_timestamps:
+            times = allan.timestamp_seconds(self.column('timestamp'))
+            if len(times) != len(values):
+                raise ValueError('%s has %d rows but there are %d timestamps'
+                                 %(var, len(values), len(times)))
+        return allan.allan_deviation(values, taus, times, modified, confidence)
+
+    def _resampling_data(self, var, statistic):
+        if not self.does_var_exist(var):
+            raise KeyError(var)
+        values = np.asarray(self.dists[var], dtype=float)
+        if statistic == 'allan_dev':
+            values = np.diff(values)
+        return [values], resampling.STATISTICS.get(statistic, statistic)
+
+    def bootstrap(self, var, statistic='mean', num_resamples=resampling.NUM_RESAMPLES,
+                    confidence=resampling.CONFIDENCE, seed=None):
+        '''Bootstrap confidence interval of a statistic of var: 'mean',
+        'std', 'median', 'snr', 'allan_dev' or a vectorized function (see
+        resampling). Returns a resampling.Resampled.'''
+        data, statistic = self._resampling_data(var, statistic)
+        return resampling.bootstrap(data, statistic, num_resamples, confidence,
+                                    seed=seed)
+
+    def jackknife(self, var, statistic='mean', confidence=resampling.CONFIDENCE):
+        '''Jackknife estimate and confidence interval of a statistic of var,
+        as for bootstrap'''
+        data, statistic = self._resampling_data(var, statistic)
+        return resampling.jackknife(data, statistic, confidence)
+
+    def lifetime_bootstrap(self, num_resamples=200, confidence=resampling.CONFIDENCE,
+                            workers=1, seed=None):
+        '''Bootstrap confidence interval of the fitted lifetime, with the
+        fits spread over workers processes. The control parameter is taken
+        from the metadata of the fitted shots, so shots whose fits failed
+        do not shift it against the atom numbers.'''
+        numbers = self.dists['atom_number']
+        if self.metadata:
+            cont_pars = self.column('cont_par')
+        else:
+            if self.cont_par_name not in self.dists.keys():
+                self.control_param_dist()
+            cont_pars = self.dists[self.cont_par_name]
+        if len(cont_pars) != len(numbers):
+            raise ValueError('%d control parameter values for %d atom numbers'
+                             %(len(cont_pars), len(numbers)))
+        data = [cont_pars, numbers]
+        return resampling.bootstrap(data, lifetime_of, num_resamples, confidence,
+                                    vectorized=False, workers=workers, seed=seed)
+
+    def temperature_bootstrap(self, axis=1, num_resamples=200,
+                            confidence=resampling.CONFIDENCE, workers=1, seed=None):
+        '''Bootstrap confidence interval of the fitted temperature along
+        axis, with the fits spread over workers processes'''
+        widths = self.dists['width_x'] if axis == 0 else self.dists['width_z']
+        return resampling.bootstrap([self.dists['tof'], widths], temperature_of,
+                                    num_resamples, confidence, vectorized=False,
+                                    workers=workers, seed=seed)
+
     def calc_statistic(self, var, statistic):
         '''Returns the value of statistic for the given variable'''
         if self.does_var_exist(var):
@@ -394,7 +798,8 @@ class CloudDistribution(object):
         '''Display several commonly used statistics'''
         #TODO: make this create a dictionary instead
         if self.does_var_exist(var, **kwargs):
-            print '\n'+self.directory
+            if self.directory is not None:
+                print '\n'+self.directory
             print '\nStatistics of ' + var
             print 'Mean: %2.2e' % self.mean(var)
             print 'StdDev: %2.2e' % self.std(var)
@@ -435,76 +840,111 @@ class CloudDistribution(object):
         plt.ylabel(var2)
         plt.show()
         
-    def lifetime(self):
-        '''Perform exponential regression to determine the lifetime'''
+    def lifetime_fit(self):
+        '''Exponential fit of atom number against the control parameter;
+        returns a dictionary of the data, fit and fit curve'''
         if self.cont_par_name not in self.dists.keys():
             self.control_param_dist()
+        times = np.array(self.dists[self.cont_par_name])
+        numbers = np.array(self.dists['atom_number'])
         p0 = np.array([self.dists['atom_number'][0], 0.2, 0]) 
-        popt, pcov = curve_fit(lifetime_func, np.array(self.dists[self.cont_par_name]), np.array(self.dists['atom_number']), p0)
+        popt, pcov = curve_fit(lifetime_func, times, numbers, p0)
+        time_array = np.linspace(np.min(times), np.max(times), 100)
+        return {'x': times, 'y': numbers,
+                'fit_x': time_array,
+                'fit_y': lifetime_func(time_array, *popt),
+                'popt': popt, 'pcov': pcov,
+                'lifetime': 1/popt[1],
+                'sigma': np.sqrt(pcov[1][1]),
+                'xlabel': self.cont_par_name, 'ylabel': 'Atom Number',
+                'title': 'Lifetime'}
+
+    def lifetime(self):
+        '''Perform exponential regression to determine the lifetime'''
+        fit = self.lifetime_fit()
         print '\nRegression of atom number against ' + self.cont_par_name
-        print 'Lifetime: %2.1f' % (1/popt[1])
-        print 'sigma: %2.1e' % np.sqrt(pcov[1][1])
-        plt.plot(self.dists[self.cont_par_name], self.dists['atom_number'], '.')
-        time_srtd = sorted(self.dists[self.cont_par_name])
-        time_array = np.linspace(time_srtd[0], time_srtd[-1], 100)
-        # num_srtd = [x for (y, x) in sorted(zip(self.dists[self.cont_par_name], self.dists['atom_number']))]
-        plt.plot(
-            time_array,
-            lifetime_func(np.array(time_array), *popt))
-        plt.xlabel(self.cont_par_name)
-        plt.ylabel('Atom Number')
-        plt.show()
+        print 'Lifetime: %2.1f' % fit['lifetime']
+        print 'sigma: %2.1e' % fit['sigma']
+        _plot_fit(fit)
     
-    def trap_freq(self, axis=1):
-        '''Fit a position to a sine function to determine trap frequency'''
+    def trap_freq_fit(self, axis=1, damped=True, max_frequency=None):
+        '''(Damped) sine fit of a position against the control parameter,
+        started at the peak of its Lomb-Scargle periodogram; returns a
+        dictionary of the data, fit and fit curve'''
         if self.cont_par_name not in self.dists.keys():
             self.control_param_dist()
         
-        times = np.array(self.dists[self.cont_par_name])
+        times = np.array(self.dists[self.cont_par_name], dtype=float)
         if axis == 0:
-            positions = np.array(self.dists['position_x'])
-            pguess = np.array([2*math.pi*10, np.max(positions), 0, 0])
+            positions = np.array(self.dists['position_x'], dtype=float)
         else:
-            positions = np.array(self.dists['position_z'])
-            pguess = np.array([2*math.pi*700, np.max(positions), 0, 0])
+            positions = np.array(self.dists['position_z'], dtype=float)
+        frequencies = oscillation.frequency_grid(times, max_frequency)
+        fit = oscillation.fit_oscillation(times, positions, frequencies, damped)
+        popt = fit['popt']
+        time_axis = np.linspace(np.min(times), np.max(times), 500)
+        func = damped_freq_func if damped else freq_func
+        return {'x': times, 'y': positions,
+                'fit_x': time_axis,
+                'fit_y': func(time_axis, *popt),
+                'popt': popt, 'pcov': fit['pcov'],
+                'frequency': fit['frequency'],
+                'sigma': fit['sigma'],
+                'seed_frequency': fit['seed_frequency'],
+                'decay': popt[4] if damped else 0.,
+                'xlabel': self.cont_par_name,
+                'ylabel': 'X Position' if axis == 0 else 'Z Position',
+                'title': 'Trap Frequency'}
 
-        popt, pcov = curve_fit(freq_func, times, positions, pguess)
-        
-        print '\nRegression of position against ' + self.cont_par_name
-        print("Frequency: %2.2f Hz"%(popt[0] / 2 / math.pi))
-        print("Sigma: %2.2f Hz"%math.sqrt(pcov[0][0]))
+    def oscillation_fits(self, variables=('position_x', 'position_z'),
+                         damped=True, max_frequency=None):
+        '''Periodogram-seeded sine fits of several distributions against
+        the control parameter at once; oscillation.fit_oscillations results
+        with one entry per variable'''
+        if self.cont_par_name not in self.dists.keys():
+            self.control_param_dist()
+        times = np.array(self.dists[self.cont_par_name], dtype=float)
+        values = np.transpose([np.asarray(self.column(var), dtype=float)
+                                for var in variables])
+        frequencies = oscillation.frequency_grid(times, max_frequency)
+        return oscillation.fit_oscillations(times, values, frequencies, damped)
 
-        plt.plot(times, positions, '.')
-        time_axis = np.linspace(np.min(times), np.max(times))
-        plt.plot(time_axis, freq_func(time_axis, *popt))
-        plt.xlabel(self.cont_par_name)
-        if axis == 0:
-            plt.ylabel('X Position')
-        else:
-            plt.ylabel('Z Position')
-        plt.show()
+    def trap_freq(self, axis=1):
+        '''Fit a position to a sine function to determine trap frequency'''
+        fit = self.trap_freq_fit(axis)
+        print '\nRegression of position against ' + self.cont_par_name
+        print("Frequency: %2.2f Hz"%fit['frequency'])
+        print("Sigma: %2.2f Hz"%fit['sigma'])
+        _plot_fit(fit, title=False)
 
-    def magnification(self):
-        '''Extract magnification by fitting to a parabola'''
+    def magnification_fit(self):
+        '''Parabolic fit of the fall of the cloud against TOF; returns a
+        dictionary of the data, fit and fit curve'''
         T = np.array(self.dists['tof'])
         Y = np.array(self.dists['position_z'])
         Y = np.max(Y)-Y
         p0 = np.array([GRAVITY*3.0 / (2.0 * CAMPIXSIZE), 0, np.min(Y)])
         popt, pcov = curve_fit(magnif_func, T, Y, p0)
-        M = 2*popt[0] * CAMPIXSIZE / GRAVITY
-        sigma = 2*np.sqrt(pcov[0][0]) * CAMPIXSIZE / GRAVITY
-        print "Magnification: %2.2f"%M
-        print "Sigma: %2.2f"%sigma
-        plt.plot(T, Y, '.')
         xax = np.linspace(np.min(T), np.max(T))
-        plt.plot(xax, magnif_func(xax, *popt))
-        plt.xlabel('TOF / ms')
-        plt.ylabel('Height / px')
-        plt.title('Magnification Fit')
-        plt.show()
+        return {'x': T, 'y': Y,
+                'fit_x': xax,
+                'fit_y': magnif_func(xax, *popt),
+                'popt': popt, 'pcov': pcov,
+                'magnification': 2*popt[0] * CAMPIXSIZE / GRAVITY,
+                'sigma': 2*np.sqrt(pcov[0][0]) * CAMPIXSIZE / GRAVITY,
+                'xlabel': 'TOF / ms', 'ylabel': 'Height / px',
+                'title': 'Magnification Fit'}
+
+    def magnification(self):
+        '''Extract magnification by fitting to a parabola'''
+        fit = self.magnification_fit()
+        print "Magnification: %2.2f"%fit['magnification']
+        print "Sigma: %2.2f"%fit['sigma']
+        _plot_fit(fit)
         
-    def temperature(self, axis = 1):
-        '''Extract temperature'''
+    def temperature_fit(self, axis = 1):
+        '''Fit of cloud width against TOF; returns a dictionary of the
+        data, fit and fit curve'''
         T = np.array(self.dists['tof'])
         if axis == 0:
             S = np.array(self.dists['width_x'])
@@ -515,39 +955,63 @@ class CloudDistribution(object):
         sigma_v = tempfit_params[1]
         temp = M * sigma_v**2 / KB
         temp_var = 4.0 * M * temp * covars[1][1] / KB
-        print "Temperature: %2.2f nK"%(temp*1e9)
-        print "Sigma: %2.2f nK"%(np.sqrt(temp_var)*1e9)
-        plt.plot(T, S, '.')
         xax = np.linspace(np.min(T), np.max(T))
-        plt.plot(xax, temp_func(xax, *tempfit_params))
-        plt.xlabel('TOF / ms')
-        plt.ylabel('Width / px')
-        plt.title('Temperature Fit')
-        plt.show()
+        return {'x': T, 'y': S,
+                'fit_x': xax,
+                'fit_y': temp_func(xax, *tempfit_params),
+                'popt': tempfit_params, 'pcov': covars,
+                'temperature': temp,
+                'sigma': np.sqrt(temp_var),
+                'xlabel': 'TOF / ms', 'ylabel': 'Width / px',
+                'title': 'Temperature Fit'}
+
+    def temperature(self, axis = 1):
+        '''Extract temperature'''
+        fit = self.temperature_fit(axis)
+        print "Temperature: %2.2f nK"%(fit['temperature']*1e9)
+        print "Sigma: %2.2f nK"%(fit['sigma']*1e9)
+        _plot_fit(fit)
         
 
         
-    def kmeans(self, var1, var2, num_clusters=2):
-        '''Perform a common clustering algorithm'''
-        if var1 not in self.dists.keys():
-            print var1 + ' distribution has not been created.'
-            raise KeyError
-        if var2 not in self.dists.keys():
-            print var2 + ' distribution has not been created.'
-            raise KeyError
-        # data generation
-        data = np.transpose(np.array([self.dists[var1], self.dists[var2]]))
-
-        # computing K-Means with K = num_clusters
-        centroids, _ = kmeans(data, num_clusters)
-        # assign each sample to a cluster
-        idx, _ = vq(data, centroids)
-
-        # some plotting using numpy's logical indexing
-        plt.plot(data[idx == 0, 0], data[idx == 0, 1], 'ob',
-                 data[idx == 1, 0], data[idx == 1, 1], 'or')
-        plt.plot(centroids[:, 0], centroids[:, 1], 'sg', markersize=8)
+    def cluster(self, variables, num_clusters=2, label='cluster',
+                standardized=True, use_mini_batch=None, seed=None):
+        '''k-means clustering of the shots on any number of variables
+        (anything column() accepts). The cluster of each shot (-1 where a
+        variable is NaN) is stored as the distribution label, so that e.g.
+        loading failures can be split off with dists[label]. Returns
+        clustering.Clusters.'''
+        data = np.transpose([np.asarray(self.column(var), dtype=float)
+                                for var in variables])
+        result = clustering.kmeans(data, num_clusters, standardized,
+                                   use_mini_batch, seed)
+        self.dists[label] = list(result.labels)
+        return result
+
+    def choose_num_clusters(self, variables, ks=range(2, 7), standardized=True,
+                            seed=None):
+        '''number of clusters in ks with the best silhouette score, and the
+        score of each'''
+        data = np.transpose([np.asarray(self.column(var), dtype=float)
+                                for var in variables])
+        return clustering.choose_k(data, ks, standardized, seed)
+
+    def kmeans(self, var1, var2, num_clusters=2, label='cluster'):
+        '''Cluster on two variables and plot the clusters; returns the
+        cluster of each shot, also stored as dists[label]'''
+        result = self.cluster([var1, var2], num_clusters, label)
+        data = np.transpose([np.asarray(self.column(var), dtype=float)
+                                for var in [var1, var2]])
+        for index in range(num_clusters):
+            in_cluster = result.labels == index
+            plt.plot(data[in_cluster, 0], data[in_cluster, 1], 'o',
+                     label='Cluster %d'%index)
+        plt.plot(result.centroids[:, 0], result.centroids[:, 1], 'sk', markersize=8)
+        plt.xlabel(var1)
+        plt.ylabel(var2)
+        plt.legend()
         plt.show()
+        return result.labels
         
     def get_average_image(self, **kwargs):
         '''Return the average of all odimages in a distribution'''
@@ -556,9 +1020,7 @@ class CloudDistribution(object):
                 firstimg.truncate_image(*self.custom_fit_window)
         avg_img = np.zeros(np.shape(firstimg.get_od_image(**kwargs)))
     
-        for this_file in self.filelist:
-            this_img = self.makeimage(this_file)
-            print this_img.filename
+        for index, this_file, this_img in self.iter_images():
             if CUSTOM_FIT_SWITCH:
                 this_img.truncate_image(*self.custom_fit_window)
             this_odimg = this_img.get_od_image(**kwargs)
@@ -575,9 +1037,9 @@ class CloudDistribution(object):
             self.get_average_image()
         var_img = np.zeros(np.shape(self.avg_img))
         
-        for this_file in self.filelist:
-            this_img = self.makeimage(this_file).get_od_image()
-            var_img += (this_img - self.avg_img)**2
+        for index, this_file, this_img in self.iter_images():
+            this_odimg = this_img.get_od_image()
+            var_img += (this_odimg - self.avg_img)**2
             
         var_img /= self.numimgs
         
@@ -633,27 +1095,23 @@ class CloudDistribution(object):
         else:
             print 'Incorrect key: parameter may not exist for fitting double gaussian.'
     
-    def get_field_noise(self, filter_on=False):
-        fas = []
-        for ii, this_file in enumerate(self.filelist):
-            print 'Processing file %d'%(ii+1)
-            this_img = self.makeimage(this_file)
+    def get_field_noise(self, filter_on=False, accumulator=None):
+        '''Return the per-position standard deviation of the Gerbier field.
+        Profiles are streamed into a RunningStats accumulator, so memory
+        does not grow with the number of shots. Pass an existing accumulator
+        to combine several distributions.'''
+        if accumulator is None:
+            accumulator = RunningStats()
+        for index, this_file, this_img in self.iter_images():
             if CUSTOM_FIT_SWITCH:
-                print 'Using Custom Window'
                 this_img.truncate_image(*self.custom_fit_window)
-            this_field = this_img.get_gerbier_field(filter_on)
-            fas.append(this_field)
-        fa_arr = np.vstack(tuple(fas))
-        fa_std = np.std(fa_arr, axis=0)
-        return fa_std
+            accumulator.push(this_img.get_gerbier_field(filter_on))
+        return accumulator.std()
         
     def get_saturation(self):
         sats = []
-        for ii, this_file in enumerate(self.filelist):
-            print 'Processing file %d'%(ii+1)
-            this_img = self.makeimage(this_file)
+        for index, this_file, this_img in self.iter_images():
             if CUSTOM_FIT_SWITCH:
-                print 'Using Custom Window'
                 this_img.truncate_image(*self.custom_fit_window)
             this_saturation = this_img.saturation()
             sats.append(this_saturation)
@@ -661,14 +1119,14 @@ class CloudDistribution(object):
 
     def get_ic_atom_numbers(self):
         nums = []
-        for ii, this_file in enumerate(self.filelist):
-            this_img = self.makeimage(this_file)
+        for index, this_file, this_img in self.iter_images():
             if CUSTOM_FIT_SWITCH:
                 this_img.truncate_image(*self.custom_fit_window)
             try:
                 this_icnum = this_img.int_corr_atom_number()
             except cloud_image.FitError:
                 print 'FitError in get_ic_atom_numbers'
+                instrumentation.count('fit_errors')
                 pass #skip bad fits
             else:
                 nums.append(this_icnum)
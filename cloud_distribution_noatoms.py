@@ -1,6 +1,7 @@
 from cloud_distribution import CloudDistribution
 from no_atom_image import NoAtomImage as nai
 import numpy as np
+import functools
 
 # Flags for setting module behavior
 DEBUG_FLAG = False                  #Debug mode; shows each fit
@@ -22,6 +23,12 @@ CAMPIXSIZE = 3.75e-6 #m, physical size of camera pixel
 cloud_width = 1.0*10**-6.0 #used in OVERLAP, assuming the overlapping gaussians both have the same sigma of 1um
 
 class CloudDistributionNoAtoms(CloudDistribution):
-    def __init__(self, directory=None, INITIALIZE_GAUSSIAN_PARAMS=True):
-        CloudDistribution.__init__(self,directory, INITIALIZE_GAUSSIAN_PARAMS)
-        self.makeimage = nai
+    def __init__(self, directory=None, INITIALIZE_GAUSSIAN_PARAMS=True,
+                    shots=None):
+        CloudDistribution.__init__(self,directory, INITIALIZE_GAUSSIAN_PARAMS,
+                                    shots)
+        self.image_class = nai
+        if self.store is None:
+            self.makeimage = nai
+        else:
+            self.makeimage = functools.partial(self.store.image, image_class=nai)
@@ -9,11 +9,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import os
-from math import sqrt
-from scipy.ndimage import rotate, filters
+from math import sqrt, sin, cos, pi, floor, ceil
+from scipy.ndimage import rotate, filters, map_coordinates
 from fit_functions import *
 import BECphysics as bp
 from BECphysics import C, H, LAMBDA_RB
+import camera_calibration
+import instrumentation
 
 DEBUG_FLAG = False
 
@@ -21,10 +23,77 @@ FILE_RE = re.compile(r'.(\d{6})\.mat')
 
 DEFAULT_IMAGE_TIME = 10e-6 #sec
 
+ROTATE_ROI_ONLY = True      #rotate only a padded region around the windows in use
+ROTATION_PADDING = 8        #pixels kept around the windows when rotating
+SPLINE_MARGIN = 12          #extra input pixels so the spline prefilter matches a full-frame rotation
+ROTATION_CACHE_SIZE = 32    #number of cached rotation maps
+
+_ROTATION_MAPS = {}
+
 def image_subtract(im1, im2):
     ''' return the absolute value of im1 - im2'''
     return np.where(im1 > im2, im1 - im2, im2 - im1)
 
+def od_from_frames(a_img, l_img, d_img, fluc_cor=None, abs_od=True,
+                        hot_pixels=None):
+    '''optical density from atom, light and dark frames of the same shape,
+    scaling the light frame by fluc_cor if given; hot pixels, NaNs and
+    infinities are cleaned up as in get_od_image'''
+    if fluc_cor is not None:
+        l_img = fluc_cor * l_img
+    od_image = -np.log((a_img - d_img).astype(float)
+                        /(l_img - d_img).astype(float))
+    if abs_od:
+        od_image = np.abs(od_image)
+    if hot_pixels is not None:
+        od_image[hot_pixels] = 0
+    od_image[np.isnan(od_image)] = 0
+    od_image[np.isinf(od_image)] = od_image[~np.isinf(od_image)].max()
+    return od_image
+
+def rotation_geometry(angle, shape):
+    '''Matrix, offset and output shape of scipy.ndimage.rotate(reshape=True)
+    for a 2D frame; input position = dot(matrix, output position) + offset'''
+    rows, cols = shape
+    angle = pi / 180 * angle
+    matrix = np.array([[cos(angle), sin(angle)],
+                       [-sin(angle), cos(angle)]])
+    corners = np.dot(matrix.T, [[0, rows, rows], [cols, 0, cols]])
+    minc = np.minimum(corners.min(axis=1), 0)
+    maxc = np.maximum(corners.max(axis=1), 0)
+    out_rows = int(maxc[0] - minc[0] + 0.5)
+    out_cols = int(maxc[1] - minc[1] + 0.5)
+    offset = (np.array([rows / 2.0 - 0.5, cols / 2.0 - 0.5])
+                - np.dot(matrix, [out_rows / 2.0 - 0.5, out_cols / 2.0 - 0.5]))
+    return matrix, offset, (out_rows, out_cols)
+
+def rotation_map(angle, shape, window):
+    '''Return (input_slices, coordinates) for rotating the region
+    window = (x1, x2, y1, y2) of the rotated frame out of a frame of the
+    given shape, with map_coordinates(frame[input_slices], coordinates).
+    Maps are cached per (angle, shape, window), as the angle is fixed
+    within a dataset.'''
+    key = (angle, tuple(shape), tuple(window))
+    if key in _ROTATION_MAPS:
+        return _ROTATION_MAPS[key]
+    matrix, offset, _ = rotation_geometry(angle, shape)
+    x1, x2, y1, y2 = window
+    out_rows, out_cols = np.mgrid[y1:y2, x1:x2].astype(float)
+    coordinates = np.empty((2,) + out_rows.shape)
+    coordinates[0] = matrix[0, 0] * out_rows + matrix[0, 1] * out_cols + offset[0]
+    coordinates[1] = matrix[1, 0] * out_rows + matrix[1, 1] * out_cols + offset[1]
+    # only the input under the window, plus a margin for the spline filter
+    input_slices = []
+    for coords, size in zip(coordinates, shape):
+        start = min(max(int(floor(coords.min())) - SPLINE_MARGIN, 0), size - 1)
+        stop = max(min(int(ceil(coords.max())) + SPLINE_MARGIN + 1, size), start + 1)
+        coords -= start
+        input_slices.append(slice(start, stop))
+    if len(_ROTATION_MAPS) >= ROTATION_CACHE_SIZE:
+        _ROTATION_MAPS.clear()
+    _ROTATION_MAPS[key] = (tuple(input_slices), coordinates)
+    return _ROTATION_MAPS[key]
+
 class FitError(Exception):
     '''A rather generic error to raise if the gaussian fit fails'''
     def __init__(self, statement="Fit Error"):
@@ -33,17 +102,28 @@ class FitError(Exception):
 class CloudImage(object):
     '''CloudImage represents the information contained in a .mat file
     generated by our ImagingGUI'''
-    def __init__(self, filename):
-        self.mat_file = {}
+    def __init__(self, filename, calibration=None, mat_file=None, read_raw=None):
+        '''mat_file and read_raw are for shots that do not come from a .mat
+        file (see dataset_store): mat_file holds the rawImage, runData and
+        hfig_main entries, and read_raw(rows, cols), if given, returns the raw
+        frames of a region, rawImage then holding only what has been read.'''
+        self.mat_file = {} if mat_file is None else mat_file
         self.filename = filename
+        self.calibration = None
+        self.read_raw = read_raw
+        self.raw_regions = None if read_raw is None else []
         self.load_mat_file()
         
         self.image_angle_corr = 1 #this is not really implemented yet.
+        if calibration is not None:
+            self.set_calibration(calibration)
 
     def load_mat_file(self):
         '''Load a .mat file'''
-        scipy.io.loadmat(self.filename, mdict=self.mat_file,
-                            squeeze_me=True, struct_as_record=False)
+        if 'rawImage' not in self.mat_file:
+            with instrumentation.stage('loadmat'):
+                scipy.io.loadmat(self.filename, mdict=self.mat_file,
+                                    squeeze_me=True, struct_as_record=False)
 
         self.image_array = self.mat_file['rawImage']
         self.run_data_files = self.mat_file['runData']
@@ -53,11 +133,6 @@ class CloudImage(object):
         self.curr_cont_par = self.run_data_files.CurrContPar
         self.curr_tof = self.run_data_files.CurrTOF*1e-3
 
-        self.atom_image = scipy.array(self.image_array[:, :, 0])
-        #scipy.array is called to make a copy, not a reference
-        self.light_image = scipy.array(self.image_array[:, :, 1])
-        self.dark_image = scipy.array(self.image_array[:, :, 2])
-
         self.magnification = self.hfig_main.calculation.M
         self.pixel_size = self.hfig_main.calculation.pixSize
         self.image_rotation = self.hfig_main.display.imageRotation
@@ -94,44 +169,169 @@ class CloudImage(object):
         self.trunc_win_y = self.hfig_main.calculation.truncWinY
         self.trunc_x_lim = (self.trunc_win_x[0], self.trunc_win_x[-1])
         self.trunc_y_lim = (self.trunc_win_y[0], self.trunc_win_y[-1])
-        
-        if self.image_rotation != 0:
-            self.atom_image = rotate(self.atom_image, self.image_rotation)
-            self.light_image = rotate(self.light_image, self.image_rotation)
-            self.dark_image = rotate(self.dark_image, self.image_rotation)
-        
-        self.atom_image_trunc = \
-        self.atom_image[self.trunc_y_lim[0]:self.trunc_y_lim[1],
-                        self.trunc_x_lim[0]:self.trunc_x_lim[1]]
-        self.light_image_trunc = \
-        self.light_image[self.trunc_y_lim[0]:self.trunc_y_lim[1],
-                        self.trunc_x_lim[0]:self.trunc_x_lim[1]]
-        self.dark_image_trunc = \
-        self.dark_image[self.trunc_y_lim[0]:self.trunc_y_lim[1],
-                        self.trunc_x_lim[0]:self.trunc_x_lim[1]]
+        self.trunc_window = self.trunc_x_lim + self.trunc_y_lim
 
         self.fluc_win_x = self.hfig_main.calculation.flucWinX
         self.fluc_win_y = self.hfig_main.calculation.flucWinY
-        
+
+        self.rotated_windows = None
+        if self.image_rotation == 0 and not self.image_array.flags.writeable:
+            # read-only frames (a memory-mapped cache) can be shared
+            self.atom_image = self.image_array[:, :, 0]
+            self.light_image = self.image_array[:, :, 1]
+            self.dark_image = self.image_array[:, :, 2]
+        elif self.image_rotation == 0:
+            self.atom_image = scipy.array(self.image_array[:, :, 0])
+            #scipy.array is called to make a copy, not a reference
+            self.light_image = scipy.array(self.image_array[:, :, 1])
+            self.dark_image = scipy.array(self.image_array[:, :, 2])
+        elif ROTATE_ROI_ONLY:
+            self.rotate_frames([self.trunc_window,
+                                (self.fluc_win_x[0], self.fluc_win_x[-1],
+                                 self.fluc_win_y[0], self.fluc_win_y[-1])])
+        else:
+            self._rotate_full_frames()
+
+        self.truncate_image(*self.trunc_window)
+
         self.set_fluc_corr(self.fluc_win_x[0], self.fluc_win_x[-1], self.fluc_win_y[0], self.fluc_win_y[-1])
         return
 
+    def rotate_frames(self, windows=None):
+        '''Rotate the raw frames by image_rotation into atom_image,
+        light_image and dark_image.
+        With a list of windows (x1, x2, y1, y2) in the rotated frame, only a
+        padded region around each is interpolated and the rest of the frames
+        stays zero; rotated_windows lists the regions done so far. Without
+        windows the whole frames are rotated.
+        Call this before using whole frames.'''
+        if windows is None:
+            self._require_raw()
+            if self.rotated_windows is not None:
+                self._rotate_full_frames()
+                self.truncate_image(*self.trunc_window)
+            return
+        _, _, out_shape = rotation_geometry(self.image_rotation,
+                                            self.image_array.shape[:2])
+        if self.rotated_windows is None:
+            # untouched zero pages cost no memory
+            self.atom_image = np.zeros(out_shape, self.image_array.dtype)
+            self.light_image = np.zeros(out_shape, self.image_array.dtype)
+            self.dark_image = np.zeros(out_shape, self.image_array.dtype)
+            self.rotated_windows = []
+        with instrumentation.stage('rotate'):
+            for window in windows:
+                x1 = max(window[0] - ROTATION_PADDING, 0)
+                x2 = min(window[1] + ROTATION_PADDING, out_shape[1])
+                y1 = max(window[2] - ROTATION_PADDING, 0)
+                y2 = min(window[3] + ROTATION_PADDING, out_shape[0])
+                input_slices, coordinates = rotation_map(self.image_rotation,
+                                    self.image_array.shape[:2], (x1, x2, y1, y2))
+                self._require_raw(*input_slices)
+                # filled in place, so truncated views stay valid
+                for plane, frame in enumerate((self.atom_image, self.light_image,
+                                                self.dark_image)):
+                    frame[y1:y2, x1:x2] = map_coordinates(
+                                self.image_array[input_slices + (plane,)],
+                                coordinates, output=self.image_array.dtype)
+                self.rotated_windows.append((x1, x2, y1, y2))
+
+    def _rotate_full_frames(self):
+        self._require_raw()
+        with instrumentation.stage('rotate'):
+            self.atom_image = rotate(self.image_array[:, :, 0], self.image_rotation)
+            self.light_image = rotate(self.image_array[:, :, 1], self.image_rotation)
+            self.dark_image = rotate(self.image_array[:, :, 2], self.image_rotation)
+        self.rotated_windows = None
+
+    def _require_raw(self, rows=None, cols=None):
+        '''make sure image_array holds the raw data in rows, cols (default
+        everything); only shots read partially from a store can lack any'''
+        if self.raw_regions is None:
+            return
+        shape = self.image_array.shape
+        r0, r1 = (0, shape[0]) if rows is None else (max(rows.start, 0),
+                                                    min(rows.stop, shape[0]))
+        c0, c1 = (0, shape[1]) if cols is None else (max(cols.start, 0),
+                                                    min(cols.stop, shape[1]))
+        for a0, a1, b0, b1 in self.raw_regions:
+            if a0 <= r0 and r1 <= a1 and b0 <= c0 and c1 <= b1:
+                return
+        self.image_array[r0:r1, c0:c1] = self.read_raw(slice(r0, r1), slice(c0, c1))
+        self.raw_regions.append((r0, r1, c0, c1))
+        if self.image_rotation == 0 and hasattr(self, 'atom_image'):
+            # filled in place, so truncated views stay valid
+            self.atom_image[r0:r1, c0:c1] = self.image_array[r0:r1, c0:c1, 0]
+            self.light_image[r0:r1, c0:c1] = self.image_array[r0:r1, c0:c1, 1]
+            self.dark_image[r0:r1, c0:c1] = self.image_array[r0:r1, c0:c1, 2]
+        if (r0, r1, c0, c1) == (0, shape[0], 0, shape[1]):
+            self.raw_regions = None
+
+    def _check_rotated(self, window):
+        '''make sure the frames hold data in window, for ROI-only rotation
+        and partially read shots'''
+        if self.image_rotation == 0:
+            self._require_raw(slice(window[2], window[3]),
+                                slice(window[0], window[1]))
+            return
+        if self.rotated_windows is None:
+            return
+        for x1, x2, y1, y2 in self.rotated_windows:
+            if (x1 <= window[0] and window[1] <= x2
+                    and y1 <= window[2] and window[3] <= y2):
+                return
+        self.rotate_frames([window])
+
+    def set_calibration(self, calibration=True):
+        '''Use per-pixel calibration maps for dark subtraction, hot pixel
+        masking and intensity conversion. Pass True to look up the cached
+        calibration for this camera.'''
+        if calibration is True:
+            calibration = camera_calibration.get_calibration(self.cameratype)
+        calibration.check_image(self)
+        self.calibration = calibration
+        self.set_fluc_corr(*self.fluc_window)
+
+    def dark_frame(self, window=None):
+        '''Return the dark frame cropped to window = (x1, x2, y1, y2):
+        the calibrated master dark if a calibration is set, otherwise this
+        shot's own dark image'''
+        if self.calibration is not None:
+            return self.calibration.master_dark(self.get_image_time(), window)
+        if window is None:
+            return self.dark_image
+        x1, x2, y1, y2 = window
+        return self.dark_image[y1:y2, x1:x2]
+
     def set_fluc_corr(self, x1, x2, y1, y2):
         '''Calculate fluctuation correction given a fluctuation window'''
+        self._check_rotated((x1, x2, y1, y2))
+        dark = self.dark_frame((x1, x2, y1, y2))
         int_atom = np.mean(np.mean(self.atom_image[y1:y2,
-            x1:x2] - self.dark_image[y1:y2, x1:x2]))
+            x1:x2] - dark))
         int_light = np.mean(np.mean(self.light_image[y1:y2,
-            x1:x2] - self.dark_image[y1:y2, x1:x2]))
+            x1:x2] - dark))
         self.fluc_cor = int_atom / int_light
+        self.fluc_window = (x1, x2, y1, y2)
         self.fluc_cor_corner = (x1, y1)
         self.fluc_cor_width = x2 - x1
         self.fluc_cor_height = y2 - y1
 
     def truncate_image(self, x1, x2, y1, y2):
         '''Crop OD image within given coordinates'''
+        self._check_rotated((x1, x2, y1, y2))
         self.atom_image_trunc = self.atom_image[y1:y2, x1:x2]
         self.light_image_trunc = self.light_image[y1:y2, x1:x2]
         self.dark_image_trunc = self.dark_image[y1:y2, x1:x2]
+        self.trunc_window = (x1, x2, y1, y2)
+
+    def lean(self, keep='roi', **kwargs):
+        '''Return a LeanImage holding only what is needed after reduction.
+            keep='roi': copies of the truncated atom, light and dark frames
+            keep='od': only the OD image (get_od_image(**kwargs)) and its
+                        projections onto each axis
+        Set the truncation window and calibration before calling this.'''
+        return LeanImage(self, keep, **kwargs)
 
     def get_variables_file(self):
         '''returns the variables file?'''
@@ -153,6 +353,7 @@ class CloudImage(object):
                 return
         return variables_dict
 
+    @instrumentation.timed('od_image')
     def get_od_image(self
             , fluc_cor_switch=True
             , trunc_switch=True
@@ -164,25 +365,20 @@ class CloudImage(object):
             a_img = self.atom_image_trunc
             d_img = self.dark_image_trunc
             l_img = self.light_image_trunc
+            window = self.trunc_window
         else:
+            self.rotate_frames()
             a_img = self.atom_image
             d_img = self.dark_image
             l_img = self.light_image
-        if fluc_cor_switch:
-            od_image = -np.log((a_img
-                            - d_img).astype(float)
-                            /(self.fluc_cor * l_img
-                            - d_img).astype(float))
-        else:
-            od_image = -np.log((a_img
-                            - d_img).astype(float)
-                            /(l_img
-                            - d_img).astype(float))
-        if abs_od:
-            od_image = np.abs(od_image)
-        od_image[np.isnan(od_image)] = 0
-        od_image[np.isinf(od_image)] = od_image[~np.isinf(od_image)].max()
-        return od_image
+            window = None
+        hot_pixels = None
+        if self.calibration is not None:
+            d_img = self.dark_frame(window)
+            hot_pixels = self.calibration.roi(self.calibration.hot_pixels, window)
+        return od_from_frames(a_img, l_img, d_img,
+                                self.fluc_cor if fluc_cor_switch else None,
+                                abs_od, hot_pixels)
 
     def get_cd_image(self, axis=1, linear_bias_switch=False, INTCORR=True, **kwargs):
         '''return the column density, with offset removed'''
@@ -221,6 +417,7 @@ class CloudImage(object):
         
     def get_vert_image(self):
         '''return the sum of the three images, appropriate for persistent features, especially useful in vertical imaging to see the sample'''
+        self.rotate_frames()
         vert_image = self.atom_image + self.dark_image + self.light_image
         return vert_image
 
@@ -310,6 +507,13 @@ class CloudImage(object):
 
     def light_counts(self):
         '''return total counts in light image, for intensity fluctuation'''
+        if self.raw_regions is not None and 'lightCounts' in self.mat_file:
+            # partially read shot; the total was computed from the raw frames
+            return self.mat_file['lightCounts']
+        if self.rotated_windows is not None:
+            # rotation does not change the total, so use the raw frames
+            return np.sum((self.image_array[:, :, 1]
+                            - self.image_array[:, :, 2]).astype(float))
         return np.sum((self.light_image - self.dark_image).astype(float))
 
     def get_chi_squared_1d(self, axis=0):
@@ -324,6 +528,7 @@ class CloudImage(object):
         chisquare = np.sum((error)**2)/(variance*(img_1d.size-4))
         return chisquare
 
+    @instrumentation.timed('gaussian_fit')
     def get_gaussian_fit_params(self,
                                 fluc_cor_switch=False,
                                 linear_bias_switch=True,
@@ -355,6 +560,7 @@ class CloudImage(object):
         except:
             coefs_x = [0, 0, 0] # KLUDGE!!!
             print 'Fit Error in X'
+            instrumentation.count('fit_errors_x')
 
         try:
             if linear_bias_switch:
@@ -366,6 +572,7 @@ class CloudImage(object):
         except:
             coefs_z = [0,0,0]
             print 'Fit Error in Z'
+            instrumentation.count('fit_errors_z')
         
         # Using a switch to choose which axis gives offset
         if fit_axis==1:
@@ -433,8 +640,7 @@ class CloudImage(object):
                                     if coefs_x[2] is not None else None),
                     'width_z': (coefs_z[2]*self.pixel_size / self.magnification
                                     if coefs_z[2] is not None else None),
-                    'light_counts': np.sum((self.light_image - self.dark_image)
-                                                    .astype(float)),
+                    'light_counts': self.light_counts(),
                     'timestamp': self.timestamp}
         else:
             return {'atom_number': atom_number,
@@ -444,8 +650,7 @@ class CloudImage(object):
                                 if coefs_z[1] is not None else None),
                 'width_x':(coefs_x[2] if coefs_x[2] is not None else None),
                 'width_z': (coefs_z[2] if coefs_z[2] is not None else None),
-                'light_counts': np.sum((self.light_image - self.dark_image)
-                                                .astype(float)),
+                'light_counts': self.light_counts(),
                 'timestamp': self.timestamp}
 
     def timestamp(self):
@@ -472,6 +677,11 @@ class CloudImage(object):
 
 
     def counts2intensity(self, rawimage):
+        if (self.calibration is not None
+                and self.calibration.quantum_efficiency is not None):
+            photoelectrons = self.calibration.counts2photoelectrons(rawimage,
+                                                        self.trunc_window)
+            return (photoelectrons / self.calibration.quantum_efficiency)*(H*C/LAMBDA_RB) / ((self.pixel_size / self.magnification)**2) / self.get_image_time()
         result = (rawimage / self.quantum_efficiency)*(H*C/LAMBDA_RB) / ((self.pixel_size / self.magnification)**2) / self.get_image_time()
         if self.cameratype == 'dragonfly':
             result /= 16
@@ -496,13 +706,24 @@ class CloudImage(object):
             return this_image_time
 
     def optical_depth(self
-		    , linear_bias_switch=False):
-        """Return the intensity corrected optical depth.
+		    , linear_bias_switch=False
+                    , alpha=1.0):
+        """Return the intensity corrected optical depth,
+        alpha*OD + (I_i - I_f)/I_sat, with alpha the effective saturation
+        parameter (1 for an ideal two-level atom).
 
         Note that this relies on get_od_image and uses the default options,
         in particular truncation and fluctuation correction
         """
         optical_density = self.get_od_image(abs_od=False)
+        offset = self.od_offset(optical_density, linear_bias_switch)
+
+        intensity_term = self.intensity_change() / self.isat
+        return alpha * (optical_density - offset) + intensity_term
+
+    def od_offset(self, optical_density, linear_bias_switch=False):
+        '''Return the background optical density per pixel, from a gaussian
+        fit to the integrated OD image'''
         imgcut = np.sum(optical_density, axis=0)
         try:
             if linear_bias_switch:
@@ -514,9 +735,7 @@ class CloudImage(object):
         except RuntimeError:
             offset = np.mean(imgcut) / optical_density.shape[1]
             #raise FitError('atom_number')
-
-        intensity_term = self.intensity_change() / self.isat
-        return optical_density - offset + intensity_term
+        return offset
 
     def intensity_change(self):
         return self.fluc_cor * self.counts2intensity(self.light_image_trunc) - self.counts2intensity(self.atom_image_trunc)
@@ -541,3 +760,67 @@ class CloudImage(object):
     def int_term_number(self):
         int_term = self.intensity_change() / self.isat
         return np.sum(int_term) / self.s_lambda * (self.pixel_size / self.magnification)**2
+
+class LeanImage(object):
+    '''The reduced data and metadata of a CloudImage, without the .mat
+    contents or full frames, for holding thousands of shots in memory.
+    Provides the CloudImage methods that only need the ROI.'''
+    __slots__ = ('filename', 'cameratype', 'cont_par_name', 'curr_cont_par',
+                 'curr_tof', 'magnification', 'pixel_size', 'image_rotation',
+                 's_lambda', 'isat', 'A', 'quantum_efficiency', 'image_time',
+                 'variables', 'trunc_window', 'fluc_cor', 'keep',
+                 'atom_image_trunc', 'light_image_trunc', 'dark_image_trunc',
+                 'hot_pixels', 'od_image', 'projection_x', 'projection_z')
+
+    def __init__(self, img, keep='roi', **kwargs):
+        if keep not in ('roi', 'od'):
+            raise ValueError("keep must be 'roi' or 'od', not %r"%keep)
+        for name in ('filename', 'cameratype', 'cont_par_name', 'curr_cont_par',
+                     'curr_tof', 'magnification', 'pixel_size', 'image_rotation',
+                     's_lambda', 'isat', 'A', 'quantum_efficiency',
+                     'trunc_window', 'fluc_cor'):
+            setattr(self, name, getattr(img, name))
+        self.image_time = img.get_image_time()
+        self.variables = img.get_variables_values()
+        self.keep = keep
+        self.atom_image_trunc = self.light_image_trunc = None
+        self.dark_image_trunc = self.hot_pixels = None
+        self.od_image = self.projection_x = self.projection_z = None
+        if keep == 'roi':
+            # copies, so that the full frames can be freed
+            self.atom_image_trunc = img.atom_image_trunc.copy()
+            self.light_image_trunc = img.light_image_trunc.copy()
+            self.dark_image_trunc = np.array(img.dark_frame(self.trunc_window))
+            if img.calibration is not None:
+                self.hot_pixels = img.calibration.roi(
+                            img.calibration.hot_pixels, self.trunc_window).copy()
+        else:
+            self.od_image = img.get_od_image(**kwargs)
+            self.projection_x = np.sum(self.od_image, 0)
+            self.projection_z = np.sum(self.od_image, 1)
+
+    def get_od_image(self, fluc_cor_switch=True, abs_od=True, **kwargs):
+        '''return the optical density image of the ROI'''
+        if self.keep == 'od':
+            return self.od_image
+        return od_from_frames(self.atom_image_trunc, self.light_image_trunc,
+                                self.dark_image_trunc,
+                                self.fluc_cor if fluc_cor_switch else None,
+                                abs_od, self.hot_pixels)
+
+    def get_variables_values(self):
+        return self.variables
+
+    def get_image_time(self):
+        return self.image_time
+
+    def timestamp(self):
+        '''return timestamp, extracted from filename'''
+        return FILE_RE.search(os.path.basename(self.filename)).group(1)
+
+    def nbytes(self):
+        '''bytes held in arrays'''
+        return sum(arr.nbytes for arr in (self.atom_image_trunc,
+                        self.light_image_trunc, self.dark_image_trunc,
+                        self.hot_pixels, self.od_image, self.projection_x,
+                        self.projection_z) if arr is not None)
@@ -0,0 +1,163 @@
+'''clustering.py - k-means clustering of shots on any number of variables
+
+The data is an (shots, variables) array. Variables are standardized to zero
+mean and unit variance first by default, so that e.g. atom number and
+position count equally. Small datasets use Lloyd's k-means; large ones
+(more than MINI_BATCH_ABOVE shots) use mini-batch k-means, which updates
+the centres from random batches of shots and so costs the same per
+iteration however long the campaign. Both start from k-means++ centres.
+
+choose_k scores a range of cluster numbers by the mean silhouette (on a
+random sample of at most SILHOUETTE_SAMPLE shots): values near 1 mean
+well separated clusters, near 0 overlapping ones.'''
+
+from collections import namedtuple
+import numpy as np
+
+MINI_BATCH_ABOVE = 10000    #use mini-batch k-means for more shots than this
+BATCH_SIZE = 1024           #shots per mini-batch
+MAX_ITER = 300
+TOLERANCE = 1e-6            #stop when the centres move less than this (standardized units)
+SILHOUETTE_SAMPLE = 2000
+CHUNK_SIZE = 65536          #shots per block when assigning labels
+
+Clusters = namedtuple('Clusters', ['labels', 'centroids', 'inertia', 'mean', 'scale'])
+
+def standardize(data):
+    '''data scaled to zero mean and unit variance per column, with the mean
+    and scale used'''
+    mean = np.mean(data, axis=0)
+    scale = np.std(data, axis=0)
+    scale[scale == 0] = 1
+    return (data - mean) / scale, mean, scale
+
+def assign(data, centroids):
+    '''label of the nearest centroid of every row, and the squared distance'''
+    labels = np.empty(len(data), dtype=int)
+    distances = np.empty(len(data))
+    centroid_norms = np.sum(centroids**2, axis=1)
+    for start in range(0, len(data), CHUNK_SIZE):
+        block = data[start:start + CHUNK_SIZE]
+        squared = (np.sum(block**2, axis=1)[:, None] - 2 * block.dot(centroids.T)
+                        + centroid_norms[None, :])
+        labels[start:start + CHUNK_SIZE] = np.argmin(squared, axis=1)
+        distances[start:start + CHUNK_SIZE] = np.maximum(np.min(squared, axis=1), 0)
+    return labels, distances
+
+def kmeans_plusplus(data, num_clusters, rng):
+    '''initial centres spread out by the k-means++ rule'''
+    centroids = [data[rng.randint(len(data))]]
+    distances = np.sum((data - centroids[0])**2, axis=1)
+    for _ in range(1, num_clusters):
+        total = distances.sum()
+        if total == 0:
+            index = rng.randint(len(data))
+        else:
+            index = np.searchsorted(np.cumsum(distances), rng.rand() * total)
+            index = min(index, len(data) - 1)
+        centroids.append(data[index])
+        distances = np.minimum(distances, np.sum((data - data[index])**2, axis=1))
+    return np.array(centroids)
+
+def lloyd(data, centroids, max_iter=MAX_ITER):
+    '''k-means by alternating assignment and centre updates'''
+    labels = None
+    for _ in range(max_iter):
+        new_labels, _ = assign(data, centroids)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=len(centroids))
+        for column in range(data.shape[1]):
+            sums = np.bincount(labels, data[:, column], len(centroids))
+            filled = counts > 0
+            centroids[filled, column] = sums[filled] / counts[filled]
+    return centroids
+
+def mini_batch(data, centroids, rng, batch_size=BATCH_SIZE, max_iter=MAX_ITER):
+    '''mini-batch k-means: each centre moves towards the batch shots
+    assigned to it, with a step shrinking as it collects shots'''
+    counts = np.zeros(len(centroids))
+    for _ in range(max_iter):
+        batch = data[rng.randint(0, len(data), batch_size)]
+        labels, _ = assign(batch, centroids)
+        batch_counts = np.bincount(labels, minlength=len(centroids))
+        old = centroids.copy()
+        for column in range(data.shape[1]):
+            sums = np.bincount(labels, batch[:, column], len(centroids))
+            filled = batch_counts > 0
+            centroids[filled, column] = ((counts[filled] * centroids[filled, column]
+                                            + sums[filled])
+                                          / (counts[filled] + batch_counts[filled]))
+        counts += batch_counts
+        if np.max(np.abs(centroids - old)) < TOLERANCE:
+            break
+    return centroids
+
+def kmeans(data, num_clusters=2, standardized=True, use_mini_batch=None, seed=None):
+    '''Cluster the rows of data (shots, variables). Rows with NaNs get
+    label -1. use_mini_batch defaults to True above MINI_BATCH_ABOVE rows.
+    Returns Clusters(labels, centroids in the original units, inertia,
+    mean, scale).'''
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data[:, None]
+    valid = np.all(np.isfinite(data), axis=1)
+    points = data[valid]
+    if standardized:
+        points, mean, scale = standardize(points)
+    else:
+        mean, scale = np.zeros(data.shape[1]), np.ones(data.shape[1])
+    rng = np.random.RandomState(seed)
+    if use_mini_batch is None:
+        use_mini_batch = len(points) > MINI_BATCH_ABOVE
+    if use_mini_batch:
+        init = points[rng.randint(0, len(points), min(len(points), 10 * BATCH_SIZE))]
+        centroids = mini_batch(points, kmeans_plusplus(init, num_clusters, rng), rng)
+    else:
+        centroids = lloyd(points, kmeans_plusplus(points, num_clusters, rng))
+    point_labels, distances = assign(points, centroids)
+    labels = np.full(len(data), -1, dtype=int)
+    labels[valid] = point_labels
+    return Clusters(labels, centroids * scale + mean, distances.sum(), mean, scale)
+
+def silhouette(data, labels, sample=SILHOUETTE_SAMPLE, seed=None):
+    '''mean silhouette of labelled rows (label -1 is left out)'''
+    data = np.asarray(data, dtype=float)
+    keep = np.flatnonzero(labels >= 0)
+    if len(keep) > sample:
+        keep = np.random.RandomState(seed).choice(keep, sample, replace=False)
+    points, labels = data[keep], labels[keep]
+    clusters = np.unique(labels)
+    if len(clusters) < 2:
+        return np.nan
+    squared = np.sum(points**2, axis=1)
+    distances = np.sqrt(np.maximum(squared[:, None] - 2 * points.dot(points.T)
+                                    + squared[None, :], 0))
+    # mean distance from each point to each cluster
+    members = (labels[:, None] == clusters[None, :]).astype(float)
+    sizes = members.sum(axis=0)
+    totals = distances.dot(members)
+    own = np.searchsorted(clusters, labels)
+    own_size = sizes[own] - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        inside = totals[np.arange(len(points)), own] / own_size
+        means = totals / sizes[None, :]
+        means[np.arange(len(points)), own] = np.inf
+        nearest = means.min(axis=1)
+        scores = (nearest - inside) / np.maximum(nearest, inside)
+    scores[own_size == 0] = 0
+    return float(np.mean(scores))
+
+def choose_k(data, ks=range(2, 7), standardized=True, seed=None):
+    '''silhouette score of k-means with each number of clusters in ks;
+    returns (best k, {k: score})'''
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data[:, None]
+    scores = {}
+    for num_clusters in ks:
+        result = kmeans(data, num_clusters, standardized, seed=seed)
+        points = data if not standardized else (data - result.mean) / result.scale
+        scores[num_clusters] = silhouette(points, result.labels, seed=seed)
+    return max(scores, key=lambda k: scores[k]), scores
@@ -0,0 +1,285 @@
+'''dataset_store.py - a directory of ImagingGUI .mat files packed into one
+chunked, compressed store
+
+A store is a directory holding
+    frames.dat    - raw frames of shape (N, 3, H, W) in their native dtype,
+                    cut into chunks of CHUNKS = (shots, rows, cols) and
+                    compressed one chunk at a time with zlib
+    index.npz     - array shape, dtype, chunk shape and the byte offset and
+                    length of every chunk
+    metadata.json.gz - runData and hfig_main of every shot
+so that reading a region of interest or a range of shots only decompresses
+the chunks that cover it. Make one with
+
+    python dataset_store.py <data directory> <store directory>
+
+and pass the store directory to CloudDistribution in place of the data
+directory. CloudImages made from a store read only their windows; the rest
+of each frame is fetched if and when something asks for it.'''
+
+import os
+import glob
+import gzip
+import json
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.io
+from scipy.io.matlab.mio5_params import mat_struct
+import instrumentation
+
+CHUNKS = (16, 64, 64)       #shots, rows, cols per chunk
+COMPRESSION_LEVEL = 3       #zlib level, 1 (fast) to 9 (small)
+CACHE_CHUNKS = 64           #decompressed chunks kept in memory per store
+
+FRAMES_FILE = 'frames.dat'
+INDEX_FILE = 'index.npz'
+METADATA_FILE = 'metadata.json.gz'
+
+class MatStruct(object):
+    '''Stands in for the MATLAB structs loadmat returns'''
+    def __init__(self, **fields):
+        self._fieldnames = list(fields.keys())
+        self.__dict__.update(fields)
+
+def _encode(obj):
+    '''JSON-ready copy of loadmat output'''
+    if isinstance(obj, (mat_struct, MatStruct)):
+        return {'__struct__': dict((name, _encode(getattr(obj, name)))
+                                    for name in obj._fieldnames)}
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return {'__objects__': [_encode(item) for item in obj.ravel()],
+                    'shape': list(obj.shape)}
+        return {'__array__': obj.tolist(), 'dtype': obj.dtype.str}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return dict((key, _encode(value)) for key, value in obj.items())
+    return obj
+
+def _decode(obj):
+    '''inverse of _encode'''
+    if isinstance(obj, dict):
+        if '__struct__' in obj:
+            return MatStruct(**dict((str(name), _decode(value))
+                                    for name, value in obj['__struct__'].items()))
+        if '__objects__' in obj:
+            arr = np.empty(len(obj['__objects__']), dtype=object)
+            arr[:] = [_decode(item) for item in obj['__objects__']]
+            return arr.reshape(obj['shape'])
+        if '__array__' in obj:
+            return np.array(obj['__array__'], dtype=obj['dtype'])
+        return dict((key, _decode(value)) for key, value in obj.items())
+    return obj
+
+def is_store(path):
+    '''True if path is a store directory'''
+    return path is not None and os.path.isfile(os.path.join(path, INDEX_FILE))
+
+def _num_chunks(size, chunk):
+    return (size + chunk - 1) // chunk
+
+def convert(directory, store_path, chunks=CHUNKS, level=COMPRESSION_LEVEL):
+    '''Pack every .mat file in directory into a new store at store_path.
+    All shots must have raw frames of the same shape and dtype.
+    Returns a DatasetStore on the new store.'''
+    filelist = sorted(glob.glob(os.path.join(directory, '*.mat')))
+    if not filelist:
+        raise ValueError('No .mat files in %s'%directory)
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    chunk_shots, chunk_rows, chunk_cols = chunks
+    records = []
+    buffered = []
+    shape = dtype = offsets = lengths = None
+    with open(os.path.join(store_path, FRAMES_FILE), 'wb') as frames:
+        for index, this_file in enumerate(filelist):
+            instrumentation.progress(index + 1, len(filelist), this_file)
+            mat_file = scipy.io.loadmat(this_file, squeeze_me=True,
+                                        struct_as_record=False)
+            raw = mat_file['rawImage']
+            if shape is None:
+                shape = raw.shape[:2]
+                dtype = raw.dtype
+                grid = (_num_chunks(len(filelist), chunk_shots),
+                        _num_chunks(shape[0], chunk_rows),
+                        _num_chunks(shape[1], chunk_cols))
+                offsets = np.zeros(grid, dtype=np.int64)
+                lengths = np.zeros(grid, dtype=np.int64)
+            elif raw.shape[:2] != shape or raw.dtype != dtype:
+                raise ValueError('%s has frames of %s %s, not %s %s'%(this_file,
+                                    raw.shape[:2], raw.dtype, shape, dtype))
+            records.append({'filename': os.path.basename(this_file),
+                            'runData': _encode(mat_file['runData']),
+                            'hfig_main': _encode(mat_file['hfig_main']),
+                            'lightCounts': float(np.sum((raw[:, :, 1]
+                                                - raw[:, :, 2]).astype(float)))})
+            buffered.append(np.rollaxis(raw, 2))
+            if len(buffered) == chunk_shots or index == len(filelist) - 1:
+                block = np.array(buffered)
+                shot_chunk = index // chunk_shots
+                for row_chunk in range(offsets.shape[1]):
+                    for col_chunk in range(offsets.shape[2]):
+                        tile = np.ascontiguousarray(block[:, :,
+                                row_chunk*chunk_rows:(row_chunk + 1)*chunk_rows,
+                                col_chunk*chunk_cols:(col_chunk + 1)*chunk_cols])
+                        data = zlib.compress(tile.tobytes(), level)
+                        offsets[shot_chunk, row_chunk, col_chunk] = frames.tell()
+                        lengths[shot_chunk, row_chunk, col_chunk] = len(data)
+                        frames.write(data)
+                buffered = []
+    np.savez(os.path.join(store_path, INDEX_FILE),
+                shape=np.array((len(filelist), 3) + tuple(shape)),
+                dtype=np.array(dtype.str),
+                chunks=np.array(chunks),
+                offsets=offsets,
+                lengths=lengths)
+    with gzip.open(os.path.join(store_path, METADATA_FILE), 'wb') as ff:
+        ff.write(json.dumps(records).encode('utf-8'))
+    return DatasetStore(store_path)
+
+class DatasetStore(object):
+    '''Read access to a store made by convert'''
+    def __init__(self, path):
+        if not is_store(path):
+            raise IOError('%s is not a dataset store'%path)
+        self.path = path
+        with np.load(os.path.join(path, INDEX_FILE)) as index:
+            self.shape = tuple(int(size) for size in index['shape'])
+            self.dtype = np.dtype(str(index['dtype']))
+            self.chunks = tuple(int(size) for size in index['chunks'])
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+        with gzip.open(os.path.join(path, METADATA_FILE), 'rb') as ff:
+            self.records = json.loads(ff.read().decode('utf-8'))
+        self.num_shots = self.shape[0]
+        self.filenames = [os.path.join(path, str(record['filename']))
+                            for record in self.records]
+        self._indices = dict((os.path.basename(ff), ii)
+                                for ii, ff in enumerate(self.filenames))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock() #for prefetching threads
+        self._frames = open(os.path.join(path, FRAMES_FILE), 'rb')
+
+    def __len__(self):
+        return self.num_shots
+
+    def close(self):
+        self._frames.close()
+
+    def table(self):
+        '''Dictionary of per-shot arrays: filename, control parameter name
+        and value, time of flight (sec), image rotation and light counts'''
+        runs = [_decode(record['runData']) for record in self.records]
+        return {'filename': np.array(self.filenames),
+                'cont_par_name': np.array([run.ContParName for run in runs]),
+                'curr_cont_par': np.array([run.CurrContPar for run in runs]),
+                'tof': np.array([run.CurrTOF*1e-3 for run in runs]),
+                'image_rotation': np.array([record['hfig_main']['__struct__']
+                                    ['display']['__struct__']['imageRotation']
+                                            for record in self.records]),
+                'light_counts': np.array([record['lightCounts']
+                                            for record in self.records])}
+
+    def index(self, filename):
+        '''Shot number of a file name (with or without its directory)'''
+        return self._indices[os.path.basename(filename)]
+
+    def _chunk(self, shot_chunk, row_chunk, col_chunk):
+        with self._lock:
+            return self._read_chunk(shot_chunk, row_chunk, col_chunk)
+
+    def _read_chunk(self, shot_chunk, row_chunk, col_chunk):
+        key = (shot_chunk, row_chunk, col_chunk)
+        if key in self._cache:
+            self._cache[key] = self._cache.pop(key)
+            return self._cache[key]
+        num_shots, _, rows, cols = self.shape
+        chunk_shots, chunk_rows, chunk_cols = self.chunks
+        chunk_shape = (min(chunk_shots, num_shots - shot_chunk*chunk_shots), 3,
+                       min(chunk_rows, rows - row_chunk*chunk_rows),
+                       min(chunk_cols, cols - col_chunk*chunk_cols))
+        with instrumentation.stage('store_read'):
+            self._frames.seek(self.offsets[key])
+            data = zlib.decompress(self._frames.read(self.lengths[key]))
+        chunk = np.frombuffer(data, dtype=self.dtype).reshape(chunk_shape)
+        if len(self._cache) >= CACHE_CHUNKS:
+            self._cache.popitem(last=False)
+        self._cache[key] = chunk
+        return chunk
+
+    def read(self, shots=None, window=None):
+        '''Return raw frames of shape (n, 3, rows, cols) for the shots
+        selected by shots (an index, slice or list; default all) within
+        window = (x1, x2, y1, y2) (default the whole frame)'''
+        _, _, rows, cols = self.shape
+        indices = np.arange(self.num_shots)
+        if shots is not None:
+            indices = np.atleast_1d(indices[shots])
+        x1, x2, y1, y2 = (0, cols, 0, rows) if window is None else window
+        x1, x2 = max(x1, 0), min(x2, cols)
+        y1, y2 = max(y1, 0), min(y2, rows)
+        frames = np.zeros((len(indices), 3, max(y2 - y1, 0), max(x2 - x1, 0)),
+                            dtype=self.dtype)
+        if frames.size == 0:
+            return frames
+        chunk_shots, chunk_rows, chunk_cols = self.chunks
+        for shot_chunk in np.unique(indices // chunk_shots):
+            selected = np.nonzero(indices // chunk_shots == shot_chunk)[0]
+            local = indices[selected] - shot_chunk*chunk_shots
+            for row_chunk in range(y1 // chunk_rows, (y2 - 1) // chunk_rows + 1):
+                r0 = row_chunk*chunk_rows
+                for col_chunk in range(x1 // chunk_cols, (x2 - 1) // chunk_cols + 1):
+                    c0 = col_chunk*chunk_cols
+                    chunk = self._chunk(shot_chunk, row_chunk, col_chunk)
+                    ra, rb = max(y1, r0), min(y2, r0 + chunk.shape[2])
+                    ca, cb = max(x1, c0), min(x2, c0 + chunk.shape[3])
+                    frames[selected, :, ra - y1:rb - y1, ca - x1:cb - x1] = \
+                                chunk[local][:, :, ra - r0:rb - r0, ca - c0:cb - c0]
+        return frames
+
+    def mat_file(self, shot):
+        '''The runData and hfig_main of a shot, as loadmat would return them'''
+        record = self.records[shot]
+        return {'runData': _decode(record['runData']),
+                'hfig_main': _decode(record['hfig_main']),
+                'lightCounts': record['lightCounts']}
+
+    def image(self, filename, image_class=None, calibration=None, roi_only=True):
+        '''Make a CloudImage (or image_class) of one shot, given its file
+        name or number. With roi_only only the windows in use are read.'''
+        if image_class is None:
+            from cloud_image import CloudImage as image_class
+        shot = filename if isinstance(filename, (int, np.integer)) \
+                        else self.index(filename)
+        mat_file = self.mat_file(shot)
+        _, _, rows, cols = self.shape
+        read_raw = None
+        if roi_only:
+            # Fortran order, like loadmat, so that sums run in the same order
+            mat_file['rawImage'] = np.zeros((rows, cols, 3), dtype=self.dtype,
+                                            order='F')
+            def read_raw(row_slice, col_slice):
+                frames = self.read(shot, (col_slice.start, col_slice.stop,
+                                          row_slice.start, row_slice.stop))
+                return np.rollaxis(frames[0], 0, 3)
+        else:
+            mat_file['rawImage'] = np.asfortranarray(
+                                        np.rollaxis(self.read(shot)[0], 0, 3))
+        return image_class(self.filenames[shot], calibration,
+                            mat_file=mat_file, read_raw=read_raw)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack a directory of .mat files into a chunked store')
+    parser.add_argument('directory')
+    parser.add_argument('store')
+    parser.add_argument('--chunks', type=int, nargs=3, default=list(CHUNKS),
+                        metavar=('SHOTS', 'ROWS', 'COLS'))
+    parser.add_argument('--level', type=int, default=COMPRESSION_LEVEL)
+    args = parser.parse_args()
+    store = convert(args.directory, args.store, tuple(args.chunks), args.level)
+    print('Packed %d shots of %dx%d into %s'%(store.num_shots, store.shape[2],
+                                              store.shape[3], args.store))
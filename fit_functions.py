@@ -6,9 +6,45 @@ fit_functions - a collection of functions used to fit data
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
+import inspect
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit as scipy_curve_fit
 from math import pi
+import instrumentation
+
+def curve_fit(f, xdata, ydata, *args, **kwargs):
+    '''scipy.optimize.curve_fit, counting calls, function evaluations and
+    failures per fitting function when instrumentation is enabled'''
+    if not instrumentation.ENABLED:
+        return scipy_curve_fit(f, xdata, ydata, *args, **kwargs)
+    name = 'fit.' + f.__name__
+    evaluations = [0]
+    def counted(*fargs):
+        evaluations[0] += 1
+        return f(*fargs)
+    if not args and kwargs.get('p0') is None:
+        # curve_fit takes the number of parameters from the signature of f,
+        # which counted hides, so pass its default start of all ones
+        try:
+            num_params = len(inspect.getargspec(f).args) - 1
+            if inspect.ismethod(f):
+                num_params -= 1
+        except TypeError:
+            num_params = None
+        if num_params is None:
+            counted = None
+        else:
+            kwargs['p0'] = np.ones(num_params)
+    instrumentation.count(name + '.calls')
+    try:
+        with instrumentation.stage(name):
+            return scipy_curve_fit(counted or f, xdata, ydata, *args, **kwargs)
+    except Exception:
+        instrumentation.count(name + '.failures')
+        raise
+    finally:
+        if counted is not None:
+            instrumentation.count(name + '.nfev', evaluations[0])
 
 def find_nearest(array, value):
     '''return the index and value of the array element closest to value'''
@@ -220,6 +256,26 @@ def lifetime_func(t, N0, decay_rate, offset):
 def freq_func(t, omega, amplitude, offset, phase):
     '''fitting function for trap frequency measurement'''
     return offset + amplitude*np.sin(omega*t + phase)
+
+def freq_jac(t, omega, amplitude, offset, phase):
+    '''derivatives of freq_func by each parameter, shape (len(t), 4)'''
+    t = np.asarray(t, dtype=float)
+    cos = np.cos(omega*t + phase)
+    return np.column_stack([amplitude*t*cos, np.sin(omega*t + phase),
+                            np.ones_like(t), amplitude*cos])
+
+def damped_freq_func(t, omega, amplitude, offset, phase, decay):
+    '''fitting function for a damped trap frequency oscillation'''
+    return offset + amplitude*np.exp(-decay*t)*np.sin(omega*t + phase)
+
+def damped_freq_jac(t, omega, amplitude, offset, phase, decay):
+    '''derivatives of damped_freq_func by each parameter, shape (len(t), 5)'''
+    t = np.asarray(t, dtype=float)
+    envelope = np.exp(-decay*t)
+    sin = envelope*np.sin(omega*t + phase)
+    cos = amplitude*envelope*np.cos(omega*t + phase)
+    return np.column_stack([t*cos, sin, np.ones_like(t), cos,
+                            -amplitude*t*sin])
     
 def magnif_func(x, a, b, c):
     '''fitting function for magnification measurement'''
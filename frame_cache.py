@@ -0,0 +1,194 @@
+'''frame_cache.py - memory-mapped cache of the raw frames of a dataset
+
+The first pass over a dataset decodes each .mat file as usual and also
+writes its raw frames (or a crop of them) into one .npy file; later passes
+memory-map that file and hand out zero-copy, read-only views, so they run
+at memory speed instead of scipy.io.loadmat speed. The runData/hfig_main
+metadata is kept alongside in an append-only log of JSON lines, one per
+cached shot, so caching costs the same per shot however long the dataset;
+the last line for a shot wins.
+
+Each cached shot is fingerprinted by file size and modification time; a
+shot whose file has changed is decoded and cached again, and a different
+file list or frame shape starts a new cache. Use through
+CloudDistribution.use_frame_cache.'''
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import scipy.io
+import instrumentation
+from dataset_store import _encode, _decode
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.becy_cache')
+SAVE_EVERY = 100    #write the records after this many newly cached shots
+
+FRAMES_FILE = 'frames.npy'
+INDEX_FILE = 'index.json'       #file list and window of the cache
+RECORDS_FILE = 'records.jsonl'  #one line per cached shot
+
+def fingerprint(filename):
+    '''(size, modification time) of a file'''
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+class FrameCache(object):
+    '''Raw frames of filelist, cached in a memory-mapped .npy file.
+        Args:
+            filelist: the .mat files, in order
+            cache_dir: where caches live (default CACHE_DIR); each file list
+                        and window gets its own subdirectory
+            window: (x1, x2, y1, y2) of the raw frames to cache, or None for
+                        whole frames. Pixels outside it are read from the
+                        .mat file if anything asks for them.'''
+    def __init__(self, filelist, cache_dir=None, window=None):
+        self.filelist = [os.path.abspath(ff) for ff in filelist]
+        self.window = None if window is None else tuple(int(ww) for ww in window)
+        key = hashlib.md5(json.dumps([self.filelist, self.window]).encode('utf-8'))
+        self.path = os.path.join(cache_dir or CACHE_DIR, key.hexdigest())
+        self._indices = dict((ff, ii) for ii, ff in enumerate(self.filelist))
+        self.fingerprints = [None] * len(self.filelist)
+        self.records = [None] * len(self.filelist)
+        self._num_stored = 0    #shots with a fingerprint
+        self._frames = None
+        self._writer = None
+        self._unsaved = []      #record lines not yet written
+        self._lock = threading.Lock() #for prefetching threads
+        index_file = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_file) and os.path.exists(self._frames_file()):
+            with open(index_file) as ff:
+                index = json.load(ff)
+            if index['filelist'] == self.filelist:
+                self._read_records()
+                self._frames = np.load(self._frames_file(), mmap_mode='r')
+
+    def _frames_file(self):
+        return os.path.join(self.path, FRAMES_FILE)
+
+    def is_cached(self, shot):
+        '''True if shot is cached and its file has not changed since'''
+        return (self.fingerprints[shot] is not None and
+                self.fingerprints[shot] == fingerprint(self.filelist[shot]))
+
+    def num_cached(self):
+        return sum(1 for shot in range(len(self.filelist)) if self.is_cached(shot))
+
+    def _records_file(self):
+        return os.path.join(self.path, RECORDS_FILE)
+
+    def _read_records(self):
+        '''replay the record log; a line cut short by a crash ends it'''
+        if not os.path.exists(self._records_file()):
+            return
+        with open(self._records_file()) as ff:
+            for line in ff:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                shot = entry['shot']
+                if self.fingerprints[shot] is None:
+                    self._num_stored += 1
+                self.fingerprints[shot] = entry['fingerprint']
+                self.records[shot] = entry['record']
+
+    def _crop(self, raw):
+        '''frames as stored: (3, cols, rows), so that the transpose has the
+        Fortran layout loadmat returns'''
+        if self.window is not None:
+            x1, x2, y1, y2 = self.window
+            raw = raw[y1:y2, x1:x2]
+        return raw.T
+
+    def _store(self, shot, mat_file):
+        frames = self._crop(mat_file['rawImage'])
+        if (self._writer is None and self._frames is not None
+                and self._frames.shape[1:] == frames.shape
+                and self._frames.dtype == frames.dtype):
+            self._writer = np.load(self._frames_file(), mmap_mode='r+')
+        if self._writer is None or self._writer.shape[1:] != frames.shape:
+            # first shot, or the frames changed shape: start again
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._writer = np.lib.format.open_memmap(self._frames_file(), mode='w+',
+                                dtype=frames.dtype,
+                                shape=(len(self.filelist),) + frames.shape)
+            self.fingerprints = [None] * len(self.filelist)
+            self.records = [None] * len(self.filelist)
+            self._num_stored = 0
+            self._unsaved = []
+            with open(self._records_file(), 'w'):
+                pass
+            with open(os.path.join(self.path, INDEX_FILE), 'w') as ff:
+                json.dump({'filelist': self.filelist, 'window': self.window}, ff)
+            self._frames = np.load(self._frames_file(), mmap_mode='r')
+        self._writer[shot] = frames
+        if self.fingerprints[shot] is None:
+            self._num_stored += 1
+        self.fingerprints[shot] = fingerprint(self.filelist[shot])
+        self.records[shot] = {'runData': _encode(mat_file['runData']),
+                              'hfig_main': _encode(mat_file['hfig_main']),
+                              'shape': list(mat_file['rawImage'].shape),
+                              'lightCounts': float(np.sum((mat_file['rawImage'][:, :, 1]
+                                    - mat_file['rawImage'][:, :, 2]).astype(float)))}
+        self._unsaved.append(json.dumps({'shot': shot,
+                                         'fingerprint': self.fingerprints[shot],
+                                         'record': self.records[shot]}))
+        if (len(self._unsaved) >= SAVE_EVERY
+                or self._num_stored == len(self.filelist)):
+            self.save()
+
+    def save(self):
+        '''Flush the frames, then append the records of the shots cached
+        since the last save'''
+        if self._writer is None:
+            return
+        self._writer.flush()
+        if self._unsaved:
+            with open(self._records_file(), 'a') as ff:
+                ff.write('\n'.join(self._unsaved) + '\n')
+        self._unsaved = []
+
+    def _load(self, filename):
+        mat_file = {}
+        with instrumentation.stage('loadmat'):
+            scipy.io.loadmat(filename, mdict=mat_file,
+                                squeeze_me=True, struct_as_record=False)
+        return mat_file
+
+    def image(self, filename, image_class=None, calibration=None):
+        '''Make a CloudImage (or image_class) of filename, from the cache if
+        possible, caching it otherwise'''
+        if image_class is None:
+            from cloud_image import CloudImage as image_class
+        shot = self._indices[os.path.abspath(filename)]
+        if not self.is_cached(shot):
+            instrumentation.count('frame_cache.misses')
+            mat_file = self._load(filename)
+            with self._lock:
+                self._store(shot, mat_file)
+            return image_class(filename, calibration, mat_file=mat_file)
+        instrumentation.count('frame_cache.hits')
+        mat_file = {'runData': _decode(self.records[shot]['runData']),
+                    'hfig_main': _decode(self.records[shot]['hfig_main'])}
+        frames = self._frames[shot].T
+        if self.window is None:
+            mat_file['rawImage'] = frames
+            return image_class(filename, calibration, mat_file=mat_file)
+        x1, x2, y1, y2 = self.window
+        loaded = {}
+        def read_raw(rows, cols):
+            if (y1 <= rows.start and rows.stop <= y2
+                    and x1 <= cols.start and cols.stop <= x2):
+                return frames[rows.start - y1:rows.stop - y1,
+                              cols.start - x1:cols.stop - x1]
+            if not loaded:
+                loaded.update(self._load(filename))
+            return loaded['rawImage'][rows, cols]
+        mat_file['rawImage'] = np.zeros(self.records[shot]['shape'], frames.dtype,
+                                        order='F')
+        mat_file['lightCounts'] = self.records[shot]['lightCounts']
+        return image_class(filename, calibration, mat_file=mat_file,
+                            read_raw=read_raw)
@@ -39,8 +39,8 @@ def gpe_bfield(img):
     cd_img = filters.gaussian_filter(cd_img, 2, order=0) #reconstruction filter
     img_cut = np.sum(cd_img, axis=1)
     real_pix = img.pixel_size / img.magnification
-    zees = (np.array(range(len(img_cut))) - centroid(img_cut))*real_pix
     symm = symmetrize(img_cut)
+    zees = (np.array(range(len(symm))) - centroid(symm))*real_pix
     img_cut_prime = filters.gaussian_filter(symm, 1, order=1) / real_pix
 
     cloud_abel = abel(np.array(img_cut_prime), zees)
@@ -0,0 +1,103 @@
+'''grouping.py - statistics of shots grouped by a control parameter
+
+GroupBy sorts the shots once by their key (a control parameter value, a
+variable, ...) and finds where the key changes; every statistic after that
+is a vectorized reduction over the sorted values, so grouping costs
+O(n log n) however many groups there are.
+
+    groups = GroupBy(hold_times)
+    table = groups.stats(atom_numbers)     #count, mean, std, sem, median, mad
+    tests = groups.ttests(atom_numbers)    #Welch t-test of every pair
+
+NaN values are left out of the statistics of their group.'''
+
+import numpy as np
+from scipy import stats
+
+class GroupBy(object):
+    '''Sort-based index of shots by key'''
+    def __init__(self, keys):
+        keys = np.asarray(keys)
+        self.order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[self.order]
+        if len(keys):
+            changes = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+            self.starts = np.concatenate([[0], changes])
+        else:
+            self.starts = np.array([], dtype=int)
+        self.keys = sorted_keys[self.starts]
+        self.counts = np.diff(np.append(self.starts, len(keys)))
+        # group number of every shot, in the original order
+        self.inverse = np.empty(len(keys), dtype=int)
+        self.inverse[self.order] = np.repeat(np.arange(len(self.keys)), self.counts)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def indices(self):
+        '''list of the shot indices in each group'''
+        return np.split(self.order, self.starts[1:])
+
+    def _sorted(self, values):
+        '''values sorted by group, then value, without NaNs, with their
+        group numbers and the start and size of each group'''
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        groups = self.inverse[valid]
+        values = values[valid]
+        order = np.lexsort((values, groups))
+        counts = np.bincount(groups, minlength=len(self.keys))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        return values[order], groups[order], starts, counts
+
+    @staticmethod
+    def _medians(values, starts, counts):
+        '''medians of the runs of sorted values'''
+        medians = np.full(len(counts), np.nan)
+        filled = counts > 0
+        low = starts[filled] + (counts[filled] - 1) // 2
+        high = starts[filled] + counts[filled] // 2
+        medians[filled] = 0.5 * (values[low] + values[high])
+        return medians
+
+    def stats(self, values):
+        '''dictionary of per-group arrays: key, count, mean, std (ddof=1),
+        sem, median and mad (median absolute deviation)'''
+        values, groups, starts, counts = self._sorted(values)
+        num = np.maximum(counts, 1).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.bincount(groups, values, len(self.keys)) / num
+            squares = np.bincount(groups, (values - means[groups])**2, len(self.keys))
+            std = np.sqrt(squares / (counts - 1))
+            std[counts < 2] = np.nan
+            means[counts == 0] = np.nan
+            sem = std / np.sqrt(counts)
+        medians = self._medians(values, starts, counts)
+        deviations = np.abs(values - medians[groups])
+        deviations = deviations[np.lexsort((deviations, groups))]
+        return {'key': self.keys,
+                'count': counts,
+                'mean': means,
+                'std': std,
+                'sem': sem,
+                'median': medians,
+                'mad': self._medians(deviations, starts, counts)}
+
+    def ttests(self, values):
+        '''Welch t-test between every pair of groups; dictionary of arrays
+        key_1, key_2, difference (mean_1 - mean_2), t, dof and p (two-sided)'''
+        table = self.stats(values)
+        first, second = np.triu_indices(len(self.keys), 1)
+        var_1 = table['std'][first]**2 / table['count'][first]
+        var_2 = table['std'][second]**2 / table['count'][second]
+        difference = table['mean'][first] - table['mean'][second]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = difference / np.sqrt(var_1 + var_2)
+            dof = (var_1 + var_2)**2 / (var_1**2 / (table['count'][first] - 1)
+                                        + var_2**2 / (table['count'][second] - 1))
+        return {'key_1': self.keys[first],
+                'key_2': self.keys[second],
+                'difference': difference,
+                't': t,
+                'dof': dof,
+                'p': 2 * stats.t.sf(np.abs(t), dof)}
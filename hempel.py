@@ -1,17 +1,65 @@
 # module for outlier removal using hempel criterion
+#
+# A value is an outlier if it is more than nMADM median absolute deviations
+# (MADs) from the median. hempel_mask uses one median and MAD for the whole
+# series; rolling_hempel_mask uses those of a window centred on each value,
+# so slow drifts over a long campaign are not flagged. Both return boolean
+# masks, True for outliers.
 
 import numpy
+from numpy.lib.stride_tricks import as_strided
 
-def hempel_filter(list, nMADM = 3):
-    median = numpy.median(list)
-    adm = [abs(x - median) for x in list]
-    madm = numpy.median(adm)
-    cutoff = nMADM*madm
-    filtered = []
-    filt_ind = []
-    for index, item in enumerate(list):
-        if abs(item - median) > cutoff:
-            filtered.append(item)
-            filt_ind.append(index)
+CHUNK_VALUES = 2**22     #window values per block in rolling statistics
 
-    return filtered, filt_ind
\ No newline at end of file
+def hempel_mask(values, nMADM = 3):
+    '''boolean mask of values more than nMADM MADs from the median;
+    NaNs are never outliers'''
+    values = numpy.asarray(values, dtype=float)
+    median = numpy.nanmedian(values)
+    madm = numpy.nanmedian(numpy.abs(values - median))
+    with numpy.errstate(invalid='ignore'):
+        return numpy.abs(values - median) > nMADM * madm
+
+def rolling_median_mad(values, window):
+    '''median and MAD of the window values centred on each value. Windows
+    are shifted, not shortened, at the ends of the series, so every one
+    holds window values (all of them if the series is shorter).'''
+    values = numpy.ascontiguousarray(values, dtype=float)
+    num = len(values)
+    window = min(int(window), num)
+    if window < 1:
+        return numpy.empty(0), numpy.empty(0)
+    windows = as_strided(values, shape=(num - window + 1, window),
+                         strides=(values.strides[0], values.strides[0]))
+    starts = numpy.clip(numpy.arange(num) - window // 2, 0, num - window)
+    medians = numpy.empty(num)
+    madms = numpy.empty(num)
+    rows = max(CHUNK_VALUES // window, 1)
+    for first in range(0, num, rows):
+        these_starts = starts[first:first + rows]
+        block = windows[these_starts]
+        block_medians = numpy.median(block, axis=1)
+        medians[first:first + rows] = block_medians
+        madms[first:first + rows] = numpy.median(
+                    numpy.abs(block - block_medians[:, None]), axis=1)
+    return medians, madms
+
+def rolling_hempel_mask(values, nMADM = 3, window = 51):
+    '''boolean mask of values more than nMADM MADs from the median of the
+    window values around them'''
+    values = numpy.asarray(values, dtype=float)
+    medians, madms = rolling_median_mad(values, window)
+    with numpy.errstate(invalid='ignore'):
+        return numpy.abs(values - medians) > nMADM * madms
+
+def hempel_filter(list, nMADM = 3, window = None):
+    '''return the outlying values and their indices; window gives the
+    rolling variant'''
+    values = numpy.asarray(list, dtype=float)
+    if window is None:
+        mask = hempel_mask(values, nMADM)
+    else:
+        mask = rolling_hempel_mask(values, nMADM, window)
+    filt_ind = numpy.flatnonzero(mask).tolist()
+    filtered = values[mask].tolist()
+    return filtered, filt_ind
@@ -0,0 +1,140 @@
+'''instrumentation.py - opt-in timing, counters and progress reporting
+
+Stages of the analysis pipeline are wrapped in
+    with instrumentation.stage('loadmat'):
+        ...
+and events are counted with instrumentation.count('fit_failures').
+Nothing is recorded until enable() is called; while disabled, stage()
+returns a shared do-nothing context manager, so the hooks cost one
+attribute lookup and a function call.
+
+Per-file progress goes through progress(), which by default prints the
+same 'Processing File n' lines as before; replace the callback with
+set_progress_callback to log elsewhere, or pass None to silence it.
+
+After a run, summary() gives a table of stages and counters and dump()
+a JSON-ready dictionary.'''
+
+import json
+from timeit import default_timer
+
+ENABLED = False
+
+_stages = {}   # name -> [calls, total seconds, max seconds]
+_counters = {}
+
+def enable(flag=True):
+    '''Start (or with flag=False, stop) recording'''
+    global ENABLED
+    ENABLED = flag
+
+def disable():
+    enable(False)
+
+def reset():
+    '''Forget everything recorded so far'''
+    _stages.clear()
+    _counters.clear()
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        add_time(self.name, default_timer() - self.start)
+        if exc_type is not None:
+            count(self.name + '.errors')
+        return False
+
+def stage(name):
+    '''Context manager timing the enclosed block as stage name'''
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name)
+
+def timed(name):
+    '''Decorator timing every call of a function as stage name'''
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+def add_time(name, seconds):
+    '''Record one call of stage name taking seconds'''
+    record = _stages.setdefault(name, [0, 0.0, 0.0])
+    record[0] += 1
+    record[1] += seconds
+    record[2] = max(record[2], seconds)
+
+def count(name, amount=1):
+    '''Increment counter name, if recording'''
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def _print_progress(label, index, total, filename):
+    if total:
+        print('%s %d of %d'%(label, index, total))
+    else:
+        print('%s %d'%(label, index))
+
+_progress_callback = _print_progress
+
+def set_progress_callback(callback):
+    '''callback(label, index, total, filename) is called for each file;
+    None silences progress output'''
+    global _progress_callback
+    _progress_callback = callback
+
+def progress(index, total=None, filename=None, label='Processing File'):
+    '''Report that file number index (from 1) of total is being processed'''
+    if ENABLED:
+        count('files_processed')
+    if _progress_callback is not None:
+        _progress_callback(label, index, total, filename)
+
+def dump(filename=None):
+    '''Return the recorded metrics as a dictionary, optionally writing JSON'''
+    metrics = {'stages': dict((name, {'calls': calls,
+                                      'total_s': total,
+                                      'mean_s': total / calls,
+                                      'max_s': longest})
+                              for name, (calls, total, longest) in _stages.items()),
+               'counters': dict(_counters)}
+    if filename is not None:
+        with open(filename, 'w') as ff:
+            json.dump(metrics, ff, indent=2, sort_keys=True)
+    return metrics
+
+def summary():
+    '''Return a table of stage timings, slowest first, and counters'''
+    lines = ['%-32s %8s %10s %10s %10s'%('stage', 'calls', 'total s',
+                                         'mean ms', 'max ms')]
+    for name, (calls, total, longest) in sorted(_stages.items(),
+                                                key=lambda item: -item[1][1]):
+        lines.append('%-32s %8d %10.3f %10.3f %10.3f'%(name, calls, total,
+                                            1e3 * total / calls, 1e3 * longest))
+    if _counters:
+        lines.append('')
+        lines.append('%-32s %8s'%('counter', 'value'))
+        for name in sorted(_counters):
+            lines.append('%-32s %8d'%(name, _counters[name]))
+    return '\n'.join(lines)
@@ -10,17 +10,108 @@ import cloud_image as ci
 from math import pi
 from BECphysics import C, H, LAMBDA_RB
 import numpy as np
+import warnings
 
 DEFAULT_I_SAT = 30.54 # W/m**2, for pi light
+DEFAULT_ALPHA = 1.0 # effective saturation parameter, 1 for an ideal two-level atom
+NEWTON_MAX_ITERATIONS = 50 # quadratic convergence; usually done in under 8
+NEWTON_TOLERANCE = 1e-12 # relative step at which a pixel has converged
 
 def optical_depth(cloudimage
-        , saturation_intensity=DEFAULT_I_SAT):
+        , saturation_intensity=DEFAULT_I_SAT
+        , alpha=DEFAULT_ALPHA):
     try:
         optical_density = cloudimage.get_cd_image() * cloudimage.s_lambda
     except ci.FitError:
         optical_density = cloudimage.get_od_image()
     intensity_term = intensity_change(cloudimage) / saturation_intensity
-    return optical_density + intensity_term
+    return alpha * optical_density + intensity_term
+
+def exact_optical_depth(s_initial, s_final, alpha=DEFAULT_ALPHA):
+    '''Per-pixel optical depth sigma_0*n from the saturation parameters
+    s = I/I_sat before and after the cloud, solving
+        dI/dz = -n sigma_0 I / (alpha + I/I_sat)
+    which integrates to
+        sigma_0*n = alpha*ln(s_i/s_f) + (s_i - s_f).
+    Works elementwise on ROIs or stacks of ROIs of any shape; alpha may be
+    a scalar or broadcast against the stack.'''
+    s_initial = np.asarray(s_initial, dtype=float)
+    s_final = np.asarray(s_final, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        od = alpha * np.log(s_initial / s_final) + (s_initial - s_final)
+    od[~np.isfinite(od)] = 0
+    return od
+
+def transmitted_saturation(s_initial, optical_depth, alpha=DEFAULT_ALPHA,
+        max_iterations=NEWTON_MAX_ITERATIONS, tolerance=NEWTON_TOLERANCE,
+        full_output=False):
+    '''Inverse of exact_optical_depth: the saturation parameter after a
+    cloud of the given optical depth, for each pixel of an ROI or stack.
+
+    With u = s_f/alpha the transmission equation is u + ln(u) = r, with
+    r = s_i/alpha + ln(s_i/alpha) - od/alpha, i.e. u = W(exp(r)). This is
+    solved with a batched Newton iteration in log space, which does not
+    overflow at high intensity the way exp(r) would, until every pixel's
+    relative step is below tolerance. Pixels still not converged after
+    max_iterations are reported with a warning; with full_output the
+    boolean map of converged pixels is returned as well.'''
+    s_initial = np.asarray(s_initial, dtype=float)
+    optical_depth = np.asarray(optical_depth, dtype=float)
+    rhs = (s_initial - optical_depth) / alpha + np.log(s_initial / alpha)
+    # Lambert W asymptotics as a starting point
+    big = rhs > 1
+    uu = np.where(big, rhs - np.log(np.where(big, rhs, 1)), np.exp(np.minimum(rhs, 1)))
+    converged = ~np.isfinite(rhs) # nothing to solve for
+    for _ in range(max_iterations):
+        with np.errstate(invalid='ignore'):
+            step = (uu + np.log(uu) - rhs) * uu / (uu + 1)
+            new_uu = np.maximum(uu - step, np.finfo(float).tiny)
+            uu = np.where(converged, uu, new_uu)
+            converged = converged | (np.abs(step) <= tolerance * uu)
+        if converged.all():
+            break
+    if not converged.all():
+        warnings.warn('transmitted_saturation: %d of %d pixels did not converge '
+                      'in %d iterations'%(np.size(converged) - np.count_nonzero(converged),
+                                          np.size(converged), max_iterations))
+    if full_output:
+        return alpha * uu, converged
+    return alpha * uu
+
+def saturation_images(cloudimage):
+    '''Return the dark-subtracted saturation parameters (s_i, s_f) of the
+    light and atom images in the ROI, with fluctuation correction'''
+    dark = cloudimage.dark_frame(cloudimage.trunc_window)
+    s_initial = cloudimage.counts2saturation(cloudimage.fluc_cor *
+                    (cloudimage.light_image_trunc - dark).astype(float))
+    s_final = cloudimage.counts2saturation(
+                    (cloudimage.atom_image_trunc - dark).astype(float))
+    return s_initial, s_final
+
+def number_parts(cloudimage):
+    '''Return the atom number carried by the logarithmic and by the linear
+    term of the exact optical depth, so that N(alpha) = alpha*A + B.'''
+    s_initial, s_final = saturation_images(cloudimage)
+    scale = (cloudimage.pixel_size / cloudimage.magnification)**2 / cloudimage.s_lambda
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_term = np.log(s_initial / s_final)
+    log_term[~np.isfinite(log_term)] = 0
+    return scale * np.sum(log_term), scale * np.sum(s_initial - s_final)
+
+def fit_alpha(optdens_parts, int_parts):
+    '''Calibrate alpha from a dataset taken at varying probe intensity.
+
+    For each shot N(alpha) = alpha*A + B, with A the optical-depth number and
+    B the intensity-term number (as returned by strong_saturation.od_parts or
+    number_parts). alpha is chosen to make N independent of intensity, i.e.
+    to minimise the variance of N across shots, which is closed form:
+        alpha = -cov(A, B) / var(A).
+    Returns (alpha, corrected atom numbers).'''
+    optdens_parts = np.asarray(optdens_parts, dtype=float)
+    int_parts = np.asarray(int_parts, dtype=float)
+    covariance = np.cov(optdens_parts, int_parts)
+    alpha = -covariance[0, 1] / covariance[0, 0]
+    return alpha, alpha * optdens_parts + int_parts
 
 def intensity_change(cloudimage):
     return cloudimage.counts2intensity(cloudimage.light_image_trunc) - cloudimage.counts2intensity(cloudimage.atom_image_trunc)
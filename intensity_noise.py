@@ -1,44 +1,170 @@
-from cloud_distribution_noatoms import CloudDistributionNoAtoms as CDna
-from no_atom_image import NoAtomImage as nai
 import matplotlib.pyplot as plt
 import numpy as np
+import instrumentation
+
+DEFAULT_NUM_BINS = 50
 
 def image_subtract(im1, im2):
     return np.int32(im1) - np.int32(im2)
 
-def get_intensity_noise(img, num_bins=50, threshold = 0):
+def noise_images(img):
+    '''return the mean signal and difference images of a light/atom pair,
+    the raw material of a photon transfer curve'''
     mean_img = image_subtract(0.5 * (img.atom_image_trunc + img.fluc_cor*img.light_image_trunc), img.dark_image_trunc)
     diff = image_subtract(img.fluc_cor*img.light_image_trunc, img.atom_image_trunc)
+    return mean_img, diff
+
+def signal_bin_edges(mean_vec, num_bins=DEFAULT_NUM_BINS):
+    '''num_bins equal bins spanning the observed signal range'''
+    low, high = np.min(mean_vec), np.max(mean_vec)
+    if high <= low:
+        high = low + 1
+    edges = np.linspace(low, high, num_bins + 1)
+    edges[-1] = np.nextafter(edges[-1], np.inf) # keep the brightest pixel
+    return edges
+
+def binned_moments(mean_vec, diff_vec, bin_edges):
+    '''return the number of pixels, summed signal, mean difference and
+    summed squared deviation of the difference from that mean, in each signal
+    bin, as an array of shape (4, len(bin_edges) + 1). Index 0 holds pixels
+    below the first edge and the last index pixels on or above the last edge,
+    as with np.digitize.'''
+    nbins = len(bin_edges) + 1
+    labels = np.digitize(mean_vec, bin_edges)
+    diff_vec = diff_vec.astype(float)
+    counts = np.bincount(labels, minlength=nbins).astype(float)
+    sum_signal = np.bincount(labels, weights=mean_vec.astype(float), minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_diff = np.bincount(labels, weights=diff_vec, minlength=nbins) / counts
+    mean_diff[counts == 0] = 0
+    centred = diff_vec - mean_diff[labels]
+    sum_dev2 = np.bincount(labels, weights=centred**2, minlength=nbins)
+    return np.array([counts, sum_signal, mean_diff, sum_dev2])
+
+def combine_moments(first, second):
+    '''binned_moments of the union of two sets of pixels (Chan et al.), so
+    frames can be accumulated one at a time without the precision loss of
+    summing squares'''
+    count_a, signal_a, mean_a, dev2_a = first
+    count_b, signal_b, mean_b, dev2_b = second
+    counts = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_diff = np.where(counts > 0, mean_a + delta * count_b / counts, 0)
+        sum_dev2 = dev2_a + dev2_b + np.where(counts > 0,
+                                    delta**2 * count_a * count_b / counts, 0)
+    return np.array([counts, signal_a + signal_b, mean_diff, sum_dev2])
+
+def binned_variance(counts, sum_dev2):
+    '''variance of the difference in each bin from its binned moments'''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sum_dev2 / counts
+
+def get_intensity_noise(img, num_bins=DEFAULT_NUM_BINS, threshold = 0):
+    mean_img, diff = noise_images(img)
 
     mean_img_hist, mean_img_bins = np.histogram(np.ravel(mean_img), num_bins)
 
     diff_vec = np.ravel(diff)
     mean_vec = np.ravel(mean_img)
-    diff_bin_labels = np.digitize(mean_vec, mean_img_bins)
-
-    bin_members = [[] for _ in range(len(mean_img_bins))]
-    for ii, this_diff in enumerate(diff_vec):
-        bin_members[diff_bin_labels[ii]-1].append(this_diff)
-    bin_vars = [np.std(members)**2 for members in bin_members]
+    # centre the differences on their bin means before squaring, so that the
+    # variance does not lose precision on bright bins
+    labels = np.clip(np.digitize(mean_vec, mean_img_bins) - 1, 0, num_bins)
+    counts = np.bincount(labels, minlength=num_bins+1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bin_means = np.bincount(labels, weights=diff_vec, minlength=num_bins+1) / counts
+        centred = diff_vec - bin_means[labels]
+        bin_vars = np.bincount(labels, weights=centred**2, minlength=num_bins+1) / counts
 
     threshold_counts = threshold * np.size(mean_img) / num_bins
     filtered_bin_vars = [0 if meancounts < threshold else bin_var for meancounts, bin_var in zip(mean_img_hist, bin_vars)]
     return mean_img_bins[:-1], filtered_bin_vars
 
+def fit_photon_transfer(signal, variance, counts, min_counts=10):
+    '''Fit the variance of difference images against mean signal.
+
+    For a pair of frames the difference variance is
+        var = 2*signal/gain + 2*read_noise**2
+    with gain in photoelectrons per count and read noise in counts.
+    Each bin is weighted by the inverse variance of its variance estimate.
+    Returns (gain, read_noise, gain_err, read_noise_err).'''
+    with np.errstate(invalid='ignore'):
+        good = (counts >= min_counts) & np.isfinite(variance) & (variance > 0)
+    if np.count_nonzero(good) < 2:
+        raise ValueError('Not enough populated bins for a photon transfer fit')
+    xx = signal[good]
+    yy = variance[good]
+    weights = (counts[good] - 1) / (2.0 * yy**2)
+    design = np.vstack((xx, np.ones_like(xx))).T
+    wdesign = design * weights[:, np.newaxis]
+    normal = np.dot(design.T, wdesign)
+    coefs = np.linalg.solve(normal, np.dot(wdesign.T, yy))
+    covar = np.linalg.inv(normal)
+    slope, intercept = coefs
+    gain = 2.0 / slope
+    gain_err = 2.0 * np.sqrt(covar[0, 0]) / slope**2
+    read_noise = np.sqrt(max(intercept, 0) / 2.0)
+    read_noise_err = (np.sqrt(covar[1, 1]) / (4.0 * read_noise)
+                        if read_noise > 0 else np.inf)
+    return gain, read_noise, gain_err, read_noise_err
+
+def photon_transfer(dist, window=None, num_bins=DEFAULT_NUM_BINS,
+                        bin_edges=None, min_counts=10):
+    '''Photon transfer analysis over every frame of a CloudDistributionNoAtoms.
+
+    Pixels from all frames are binned by mean signal on common bin edges and
+    only the per-bin moments of signal and difference are kept, so memory
+    does not depend on the number of frames.
+        Args:
+            dist: a CloudDistributionNoAtoms (or any CloudDistribution)
+            window: (x1, x2, y1, y2) to truncate each image to, or None
+            num_bins: number of signal bins, spanning the signal range of
+                the first frame, when bin_edges is not given
+            bin_edges: signal bin edges in counts; pixels outside them are
+                left out
+            min_counts: bins with fewer pixels are left out of the fit
+    Returns a dictionary with the binned signal, variance and pixel counts and
+    the fitted gain (photoelectrons per count) and read noise (counts).'''
+    totals = None
+    for ii, fname in enumerate(dist.filelist):
+        instrumentation.progress(ii + 1, len(dist.filelist), fname)
+        this_img = dist.makeimage(fname)
+        if window is not None:
+            this_img.truncate_image(*window)
+        mean_img, diff = noise_images(this_img)
+        if bin_edges is None:
+            bin_edges = signal_bin_edges(np.ravel(mean_img), num_bins)
+        moments = binned_moments(np.ravel(mean_img), np.ravel(diff), bin_edges)
+        totals = moments if totals is None else combine_moments(totals, moments)
+    # the first and last bins hold pixels outside the edges and are dropped
+    counts, sum_signal, _, sum_dev2 = totals[:, 1:-1]
+    variance = binned_variance(counts, sum_dev2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        signal = sum_signal / counts
+    gain, read_noise, gain_err, read_noise_err = \
+                fit_photon_transfer(signal, variance, counts, min_counts)
+    return {'signal': signal,
+            'variance': variance,
+            'counts': counts,
+            'bin_edges': bin_edges,
+            'gain': gain,
+            'read_noise': read_noise,
+            'gain_err': gain_err,
+            'read_noise_err': read_noise_err}
+
 if __name__ == "__main__":
+    from cloud_distribution_noatoms import CloudDistributionNoAtoms as CDna
     datadir = r'Z:\Data\ACM Data\Imaging system\PIXIS\2015-01-21\100us'
     dist = CDna(datadir, False)
-    most_counts = 0
-    sat_counts = 3400
-    for ii, fname in enumerate(dist.filelist):
-        print 'Processing File %d'%(ii+1)
-        this_img = nai(fname)
-        this_img.truncate_image(396, 623, 130, 148)
-        this_bins, this_vars = get_intensity_noise(this_img)
-        this_sat = this_bins 
-        plt.plot(this_sat, this_vars, '.', color='b')
-        most_counts = max((most_counts, max(this_bins)))
+    ptc = photon_transfer(dist, window=(396, 623, 130, 148))
+    print('Gain: %2.3f +/- %2.3f e-/count'%(ptc['gain'], ptc['gain_err']))
+    print('Read noise: %2.2f +/- %2.2f counts'%(ptc['read_noise'], ptc['read_noise_err']))
+    most_counts = np.nanmax(ptc['signal'])
+    plt.plot(ptc['signal'], ptc['variance'], '.', color='b')
     plt.plot([0, float(most_counts)], [0, 2.0*most_counts], color='red', linewidth=3, label='Shot Noise Limited')
+    plt.plot([0, float(most_counts)],
+                [2.0*ptc['read_noise']**2, 2.0*(most_counts/ptc['gain'] + ptc['read_noise']**2)],
+                color='green', linewidth=2, label='Photon Transfer Fit')
    # plt.xlim(0, 2)
    # plt.ylim(0, 30000)
     plt.xlabel('Photon Counts')
@@ -0,0 +1,161 @@
+'''live_distribution.py - analyse shots while the imaging GUI writes them
+
+LiveDistribution watches a data directory by polling it, and analyses each
+new .mat file once it has been completely written: its size and
+modification time must be unchanged between two scans and at least
+SETTLE_TIME old, and a file that still fails to load is retried on later
+scans. Each shot gets the usual gaussian fit (plus any extra variables)
+appended to dists, and running mean, std, SNR and Allan deviation of the
+main parameters are updated in constant time per shot.
+
+    live = LiveDistribution('C:\\data\\2014-10-15\\', cycle_time=20)
+    live.watch()            #Ctrl-C to stop; live.dists is kept
+
+Polling rather than file system events is used because the data directory
+is usually a network share, where change notifications are unreliable.'''
+
+import os
+import glob
+import time
+from timeit import default_timer
+import instrumentation
+from cloud_distribution import CloudDistribution
+from cloud_image import FitError
+from running_stats import SeriesStats
+
+POLL_INTERVAL = 0.5         #seconds between scans of the directory
+SETTLE_TIME = 1.0           #seconds a file must be unchanged before it is read
+MAX_LOAD_ATTEMPTS = 5       #give up on a file that fails to load this many times
+LIVE_VARIABLES = ['atom_number', 'position_x', 'position_z',
+                  'width_x', 'width_z', 'light_counts']   #running statistics kept
+
+class LiveDistribution(CloudDistribution):
+    '''CloudDistribution that grows as new files appear in its directory.
+        Args:
+            directory: directory to watch
+            variables: extra variables per shot, as for values()
+            cycle_time: experiment cycle time in seconds; shots taking
+                        longer than this to analyse are reported
+            skip_existing: ignore files already in the directory
+            callback: callback(live, filename, params) after every shot'''
+    def __init__(self, directory, variables=None, cycle_time=None,
+                    skip_existing=False, callback=None):
+        CloudDistribution.__init__(self, directory, False)
+        self.filelist = []
+        self.numimgs = 0
+        self.variables = list(variables or [])
+        self.cycle_time = cycle_time
+        self.callback = callback
+        self.latencies = []
+        self.stats = dict((var, SeriesStats())
+                            for var in LIVE_VARIABLES + self.variables)
+        self._seen = set()
+        self._pending = {}      #file -> (size, mtime) at the last scan
+        self._failures = {}     #file -> failed load attempts
+        if skip_existing:
+            self._seen.update(self.scan())
+
+    def scan(self):
+        '''all .mat files now in the directory'''
+        return sorted(glob.glob(os.path.join(self.directory, '*.mat')))
+
+    def ready_files(self):
+        '''new files that have finished being written, oldest first'''
+        ready = []
+        now = time.time()
+        for this_file in self.scan():
+            if this_file in self._seen:
+                continue
+            try:
+                stat = os.stat(this_file)
+            except OSError:
+                continue #removed or renamed since the scan
+            signature = (stat.st_size, stat.st_mtime)
+            if (self._pending.get(this_file) == signature
+                    and now - stat.st_mtime >= SETTLE_TIME):
+                ready.append(this_file)
+            else:
+                self._pending[this_file] = signature
+        return ready
+
+    def poll(self):
+        '''Analyse every new file that is ready; returns their names'''
+        done = []
+        for this_file in self.ready_files():
+            if self.process(this_file):
+                done.append(this_file)
+        return done
+
+    def process(self, this_file):
+        '''Analyse one file and append it to dists and stats. Returns False
+        if the file could not be loaded yet.'''
+        start = default_timer()
+        try:
+            this_img = self.makeimage(this_file)
+        except Exception as err:
+            self._failures[this_file] = self._failures.get(this_file, 0) + 1
+            instrumentation.count('live.load_failures')
+            if self._failures[this_file] >= MAX_LOAD_ATTEMPTS:
+                print('Giving up on %s: %r'%(this_file, err))
+                self._seen.add(this_file)
+            return False
+        self._seen.add(this_file)
+        self._pending.pop(this_file, None)
+        self.filelist.append(this_file)
+        self.numimgs = len(self.filelist)
+        instrumentation.progress(self.numimgs, None, this_file, 'Live File')
+
+        try:
+            params = self.image_gaussian_params(this_img,
+                                                **self.gaussian_fit_options)
+        except FitError:
+            print 'Fit Error'
+            instrumentation.count('fit_errors')
+            params = None
+        else:
+            for var in self.variables:
+                params[var] = self.image_value(this_img, var)
+            for key in params.keys():
+                self.dists.setdefault(key, []).append(params[key])
+                if key in self.stats and params[key] is not None:
+                    self.stats[key].push(params[key])
+
+        latency = default_timer() - start
+        self.latencies.append(latency)
+        instrumentation.add_time('live.shot', latency)
+        if self.cycle_time is not None and latency > self.cycle_time:
+            print('Shot took %.2f s, longer than the %.2f s cycle'
+                    %(latency, self.cycle_time))
+        if self.callback is not None:
+            self.callback(self, this_file, params)
+        return True
+
+    def watch(self, timeout=None, max_shots=None, interval=None):
+        '''Poll the directory until timeout seconds pass, max_shots have
+        been analysed or Ctrl-C is pressed'''
+        interval = POLL_INTERVAL if interval is None else interval
+        start = time.time()
+        try:
+            while True:
+                self.poll()
+                if max_shots is not None and self.numimgs >= max_shots:
+                    break
+                if timeout is not None and time.time() - start >= timeout:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopped watching %s after %d files'
+                    %(self.directory, self.numimgs))
+        return self
+
+    def live_statistics(self, var):
+        '''count, mean, std, snr and allan_dev of var so far'''
+        return self.stats[var].summary()
+
+    def display_live_statistics(self, var='atom_number'):
+        '''Print a one-line summary of var and the analysis latency'''
+        summary = self.live_statistics(var)
+        latency = self.latencies[-1] if self.latencies else float('nan')
+        print('%s: n=%d mean=%2.2e std=%2.2e SNR=%2.2f Allan=%2.2e (%.0f ms/shot)'
+                %(var, summary['count'], summary['mean'], summary['std'],
+                  summary['snr'], summary['allan_dev'], 1e3 * latency))
@@ -3,27 +3,52 @@
 from cloud_distribution import *
 from cloud_image import CloudImage as ci
 import BECphysics as bp
+from running_stats import FieldNoiseAccumulator
 import matplotlib.pyplot as plt
 import numpy as np
 from math import pi
+from itertools import izip_longest
 from mpl_toolkits.mplot3d.axes3d import Axes3D
 
 DEFAULT_PIXSIZE = 13.0 / 24 *1e-6 #PIXIS
 
+def iter_field_profiles(dist, unbias=False, **kwargs):
+    '''Yield magnetic field profiles calculated from data in distribution,
+    one shot at a time, so that no CloudImage outlives its profile.
+        Args:
+            dist: a CloudDistribution
+            unbias: if True, subtract the mean magnetic field from each field profile
+    '''
+    for ff in dist.filelist:
+        img = ci(ff)
+        ld = bp.line_density(img.get_od_image() / img.s_lambda)
+        fa = bp.field_array(ld, **kwargs)
+        if unbias:
+            fa = fa - np.mean(fa)
+        yield fa
+
 def field_dist(dist, unbias=False, **kwargs):
     '''Return a list of magnetic field profiles calculated from data in distribution.
         Args:
             dist: a CloudDistribution
             unbias: if True, subtract the mean magnetic field from each field profile
     '''
-    imgs = [ci(ff) for ff in dist.filelist]
-    cdimgs = [img.get_od_image()/ img.s_lambda for img in imgs]
-    lds = [bp.line_density(cd) for cd in cdimgs]
-
-    fas = [bp.field_array(ld, **kwargs) for ld in lds]
-    if unbias:
-	    fas = [fa - np.mean(fa) for fa in fas]
-    return fas
+    return list(iter_field_profiles(dist, unbias, **kwargs))
+
+def accumulate_fields(dist, offdist, accumulator=None, **kwargs):
+    '''Stream the field profiles of dist (sample on) and offdist (sample off)
+    into a FieldNoiseAccumulator, alternating between the two datasets.
+    Memory use is constant in the number of shots.'''
+    if accumulator is None:
+        accumulator = FieldNoiseAccumulator()
+    on_profiles = iter_field_profiles(dist, **kwargs)
+    off_profiles = iter_field_profiles(offdist, **kwargs)
+    for fa_on, fa_off in izip_longest(on_profiles, off_profiles):
+        if fa_on is not None:
+            accumulator.push(fa_on, sample_on=True)
+        if fa_off is not None:
+            accumulator.push(fa_off, sample_on=False)
+    return accumulator
 
 def field_avg(dist, offdist, pixsize=DEFAULT_PIXSIZE, **kwargs):
     '''Return spatially varying statistics of magnetic field profiles.
@@ -32,33 +57,17 @@ def field_avg(dist, offdist, pixsize=DEFAULT_PIXSIZE, **kwargs):
             offdist: CloudDistribution of data in same trap with sample off
             pixsize: real space pixel length
     '''
-    fas = field_dist(dist, **kwargs)
-    fas_off = field_dist(offdist, **kwargs)
+    acc = accumulate_fields(dist, offdist, **kwargs)
+    fa_tot = acc.field()
+    fa_noise = acc.noise()
 
-    fa_mean = np.mean(np.array(fas), axis=0)
-    fa_off_mean = np.mean(np.array(fas_off), axis = 0)
-
-    fa_std = np.std(np.array(fas), axis=0)
-    fa_off_std = np.std(np.array(fas_off), axis=0)
-
-    fa_tot = fa_mean - fa_off_mean
-    fa_noise = np.sqrt(np.power(fa_std, 2) + np.power(fa_off_std, 2))
-
-    xaxis = np.cumsum(np.ones(len(fas[0])) * pixsize)
+    xaxis = np.cumsum(np.ones(len(fa_tot)) * pixsize)
     return fa_tot, fa_noise, xaxis
 
 
 def field_noise(dist, offdist, pixsize=DEFAULT_PIXSIZE, **kwargs):
     '''Return spatially varying standard deviation of magnetic field profiles'''
-    fas = field_dist(dist, **kwargs)
-    fas_off = field_dist(offdist, **kwargs)
-
-    fa_std = np.std(np.array(fas), axis = 0)
-    fa_off_std = np.std(np.array(fas_off), axis=0)
-
-    fa_noise = np.sqrt(np.power(fa_std, 2) + np.power(fa_off_std, 2))
-
-    xaxis = np.cumsum(np.ones(len(fas[0])) * pixsize)
+    _, fa_noise, xaxis = field_avg(dist, offdist, pixsize, **kwargs)
     return fa_noise, xaxis
 
 
@@ -34,6 +34,7 @@ if __name__ == "__main__":
     
     for f in imgs:
         img = ci(f)
+        img.rotate_frames()
         limg = img.light_image
         plt.imshow(limg)
         plt.show()
@@ -2,8 +2,8 @@ from cloud_image import CloudImage
 import numpy as np
 
 class NoAtomImage(CloudImage):
-    def __init__(self, filename):
-        CloudImage.__init__(self, filename)
+    def __init__(self, filename, calibration=None, mat_file=None, read_raw=None):
+        CloudImage.__init__(self, filename, calibration, mat_file, read_raw)
         
     def get_cd_image(self
                     , axis=1
@@ -0,0 +1,220 @@
+'''oscillation.py - frequency of oscillating positions, seeded by a periodogram
+
+A sine fit started at a fixed frequency (trap_freq used 700 Hz and 10 Hz)
+easily settles on an alias or a local minimum. Here the start comes from
+the data: a Lomb-Scargle periodogram, which needs no even spacing of the
+control parameter, finds the strongest frequency, and a linear fit at that
+frequency gives the amplitude, phase and offset. The sinusoid, optionally
+with an exponential decay, is then fitted with its analytic Jacobian
+(fit_functions.freq_jac, damped_freq_jac).
+
+    fit = fit_oscillation(hold_times, positions)
+    fit['frequency'], fit['sigma']
+
+fit_oscillations fits many traces at once, e.g. both axes or every pixel
+row, with a Levenberg-Marquardt loop vectorized over the traces.
+
+Parameters follow fit_functions: omega, amplitude, offset, phase and, for
+damped fits, decay. NaN values are left out.'''
+
+import math
+import numpy as np
+from fit_functions import (curve_fit, freq_func, freq_jac, damped_freq_func,
+                           damped_freq_jac)
+
+OVERSAMPLE = 10         #periodogram frequency steps per 1 / (time span)
+CHUNK_FREQUENCIES = 512 #frequencies per block when computing the periodogram
+MAX_ITER = 100
+TOLERANCE = 1e-10       #relative change of the cost at which a fit has converged
+
+def frequency_grid(times, max_frequency=None, oversample=OVERSAMPLE):
+    '''Frequencies (Hz if times are in s) to search: from 1 / span up to
+    max_frequency, by default half the inverse median spacing of the
+    distinct times'''
+    times = np.unique(np.asarray(times, dtype=float))
+    span = times[-1] - times[0]
+    if span <= 0:
+        raise ValueError('Need at least two distinct times')
+    if max_frequency is None:
+        max_frequency = 0.5 / np.median(np.diff(times))
+    step = 1. / (oversample * span)
+    return np.arange(1. / span, max_frequency + step, step)
+
+def _weights(values):
+    '''values with NaNs set to zero, and 0/1 weights marking them'''
+    weights = np.isfinite(values).astype(float)
+    return np.where(weights > 0, values, 0), weights
+
+def _sine_sums(times, values, weights, omegas):
+    '''weighted sums of the linear fit of a cos + b sin at each omega:
+    (cc, ss, cs, yc, ys), each of shape (frequencies, traces)'''
+    phases = np.outer(omegas, times)
+    cos = np.cos(phases)
+    sin = np.sin(phases)
+    return (np.dot(cos**2, weights), np.dot(sin**2, weights),
+            np.dot(cos*sin, weights), np.dot(cos, values), np.dot(sin, values))
+
+def lomb_scargle(times, values, frequencies=None):
+    '''Normalized Lomb-Scargle periodogram of values (shots,) or (shots,
+    traces) at frequencies (default frequency_grid): the fraction of the
+    variance of each trace removed by a sine at each frequency. Returns
+    (frequencies, power) with power of shape (frequencies,) or
+    (frequencies, traces).'''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    single = values.ndim == 1
+    if single:
+        values = values[:, None]
+    if frequencies is None:
+        frequencies = frequency_grid(times)
+    frequencies = np.asarray(frequencies, dtype=float)
+    values, weights = _weights(values)
+    means = values.sum(axis=0) / weights.sum(axis=0)
+    values = (values - means) * weights
+    variance = np.sum(values**2, axis=0)
+    power = np.empty((len(frequencies), values.shape[1]))
+    for start in range(0, len(frequencies), CHUNK_FREQUENCIES):
+        omegas = 2 * math.pi * frequencies[start:start + CHUNK_FREQUENCIES]
+        cc, ss, cs, yc, ys = _sine_sums(times, values, weights, omegas)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            power[start:start + len(omegas)] = ((ss * yc**2 - 2 * cs * yc * ys
+                                                 + cc * ys**2)
+                                                / (cc * ss - cs**2) / variance)
+    power = np.nan_to_num(power)
+    return frequencies, power[:, 0] if single else power
+
+def seed(times, values, frequencies=None, damped=True):
+    '''Starting parameters (traces, 4 or 5) for values (shots, traces): the
+    periodogram peak, and the amplitude, phase and offset of the linear fit
+    at that frequency; also returns the peak power'''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    frequencies, power = lomb_scargle(times, values, frequencies)
+    traces = np.arange(values.shape[1])
+    peak = np.argmax(power, axis=0)
+    omegas = 2 * math.pi * frequencies[peak]
+    values, weights = _weights(values)
+    offsets = values.sum(axis=0) / weights.sum(axis=0)
+    centred = (values - offsets) * weights
+    phases = np.outer(omegas, times)
+    cos = np.cos(phases)
+    sin = np.sin(phases)
+    # the sums of _sine_sums, only at the peak of each trace
+    cc = np.sum(cos**2 * weights.T, axis=1)
+    ss = np.sum(sin**2 * weights.T, axis=1)
+    cs = np.sum(cos * sin * weights.T, axis=1)
+    yc = np.sum(cos * centred.T, axis=1)
+    ys = np.sum(sin * centred.T, axis=1)
+    det = cc * ss - cs**2
+    a = (ss * yc - cs * ys) / det
+    b = (cc * ys - cs * yc) / det
+    columns = [omegas, np.hypot(a, b), offsets, np.arctan2(a, b)]
+    if damped:
+        columns.append(np.zeros(len(omegas)))
+    return np.column_stack(columns), power[peak, traces]
+
+def _model(times, params):
+    '''fit function and Jacobian for every trace: (shots, traces) and
+    (shots, traces, parameters)'''
+    omega, amplitude, offset, phase = [params[:, index][None, :] for index in range(4)]
+    t = times[:, None]
+    envelope = np.exp(-params[:, 4][None, :] * t) if params.shape[1] > 4 else 1.
+    sin = envelope * np.sin(omega * t + phase)
+    cos = amplitude * envelope * np.cos(omega * t + phase)
+    columns = [t * cos, sin, np.ones_like(sin), cos]
+    if params.shape[1] > 4:
+        columns.append(-amplitude * t * sin)
+    return offset + amplitude * sin, np.stack(columns, axis=2)
+
+def fit_oscillations(times, values, frequencies=None, damped=True,
+                     max_iter=MAX_ITER):
+    '''Fit freq_func (or damped_freq_func if damped) to every column of
+    values (shots, traces), each seeded by its periodogram. Returns a
+    dictionary of arrays over the traces: popt, pcov, frequency, sigma
+    (of the frequency), seed_frequency, power (periodogram peak) and
+    converged.'''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    single = values.ndim == 1
+    if single:
+        values = values[:, None]
+    params, power = seed(times, values, frequencies, damped)
+    seed_frequency = params[:, 0] / (2 * math.pi)
+    values, weights = _weights(values)
+    num_params = params.shape[1]
+    diagonal = np.arange(num_params)
+
+    def cost_of(params):
+        model, jac = _model(times, params)
+        residuals = (values - model) * weights
+        return np.sum(residuals**2, axis=0), residuals, jac
+
+    cost, residuals, jac = cost_of(params)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    for _ in range(max_iter):
+        weighted = jac * weights[:, :, None]
+        hessian = np.einsum('npi,npj->pij', weighted, weighted)
+        gradient = np.einsum('npi,np->pi', weighted, residuals)
+        scaled = hessian.copy()
+        scaled[:, diagonal, diagonal] *= 1 + damping[:, None]
+        scaled[:, diagonal, diagonal] += 1e-300
+        try:
+            step = np.linalg.solve(scaled, gradient[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('pij,pj->pi', np.linalg.pinv(scaled), gradient)
+        step[converged] = 0
+        new_cost, new_residuals, new_jac = cost_of(params + step)
+        better = new_cost <= cost
+        improvement = (cost - new_cost) / np.maximum(cost, 1e-300)
+        converged |= better & (improvement < TOLERANCE)
+        converged |= damping > 1e12
+        params[better] += step[better]
+        cost[better] = new_cost[better]
+        residuals[:, better] = new_residuals[:, better]
+        jac[:, better] = new_jac[:, better]
+        damping = np.where(better, damping / 10, damping * 10)
+        if converged.all():
+            break
+    # covariance from the undamped normal equations at the solution
+    model, jac = _model(times, params)
+    jac = jac * weights[:, :, None]
+    hessian = np.einsum('npi,npj->pij', jac, jac)
+    dof = weights.sum(axis=0) - num_params
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pcov = np.linalg.pinv(hessian) * (cost / dof)[:, None, None]
+    # report positive frequencies and amplitudes
+    flip = params[:, 0] < 0
+    params[flip, 0] *= -1
+    params[flip, 1] *= -1
+    params[flip, 3] *= -1
+    flip = params[:, 1] < 0
+    params[flip, 1] *= -1
+    params[flip, 3] += math.pi
+    params[:, 3] = np.mod(params[:, 3] + math.pi, 2 * math.pi) - math.pi
+    results = {'popt': params,
+               'pcov': pcov,
+               'frequency': params[:, 0] / (2 * math.pi),
+               'sigma': np.sqrt(pcov[:, 0, 0]) / (2 * math.pi),
+               'seed_frequency': seed_frequency,
+               'power': power,
+               'converged': converged}
+    if single:
+        results = dict((key, value[0]) for key, value in results.items())
+    return results
+
+def fit_oscillation(times, values, frequencies=None, damped=True):
+    '''Fit freq_func (or damped_freq_func if damped) to one trace with
+    curve_fit, seeded by the periodogram. Returns a dictionary of popt,
+    pcov, frequency, sigma, seed_frequency and power.'''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    params, power = seed(times, values[:, None], frequencies, damped)
+    func, jac = (damped_freq_func, damped_freq_jac) if damped else (freq_func, freq_jac)
+    popt, pcov = curve_fit(func, times[valid], values[valid], params[0], jac=jac)
+    return {'popt': popt, 'pcov': pcov,
+            'frequency': abs(popt[0]) / (2 * math.pi),
+            'sigma': math.sqrt(pcov[0][0]) / (2 * math.pi),
+            'seed_frequency': params[0, 0] / (2 * math.pi),
+            'power': power[0]}
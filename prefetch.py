@@ -0,0 +1,148 @@
+'''prefetch.py - load images in background threads while the current one
+is being analysed
+
+Reading and decoding .mat files is mostly file I/O and zlib, which release
+the GIL, so a few threads reading ahead keep a slow network share busy
+while the main thread fits. Images come out in file order; at most depth
+of them are loaded or loading at any time, and loading pauses while the
+loaded-but-unused images hold more than max_mb megabytes.'''
+
+import mmap
+import threading
+import numpy as np
+import instrumentation
+
+def _root(array):
+    '''the array whose memory array views, and whether that memory is a
+    memory-mapped file'''
+    while isinstance(array.base, np.ndarray):
+        if isinstance(array, np.memmap):
+            return array, True
+        array = array.base
+    return array, isinstance(array, np.memmap) or isinstance(array.base, mmap.mmap)
+
+def _region_nbytes(array, sizes):
+    '''bytes of array filled in so far: only the regions of (rows, columns)
+    sizes listed (the rest is zero pages never touched)'''
+    per_pixel = array.itemsize * int(np.prod(array.shape[2:]))
+    return sum(per_pixel * max(rows, 0) * max(cols, 0) for rows, cols in sizes)
+
+def image_nbytes(img):
+    '''bytes of memory held by an image: the raw frames, the atom, light and
+    dark planes and anything else it has computed. Views are counted once,
+    through the array they view; memory-mapped frames (a frame cache) are
+    not counted, and frames filled in only partly (shots read from a
+    store, rotated windows) count only the parts filled in.'''
+    attributes = getattr(img, '__dict__', {})
+    owners = {}
+    views = {}
+    for name, value in list(attributes.items()):
+        if not isinstance(value, np.ndarray):
+            continue
+        root, mapped = _root(value)
+        if mapped:
+            continue
+        if root is value:
+            owners[id(value)] = (name, value)
+        else:
+            views[(value.__array_interface__['data'][0], value.nbytes)] = (id(root), value)
+    total = 0
+    for name, array in owners.values():
+        if name == 'image_array' and attributes.get('raw_regions') is not None:
+            total += _region_nbytes(array, [(r1 - r0, c1 - c0) for r0, r1, c0, c1
+                                                in attributes['raw_regions']])
+        elif (name in ('atom_image', 'light_image', 'dark_image')
+                and attributes.get('rotated_windows') is not None):
+            total += _region_nbytes(array, [(y2 - y1, x2 - x1) for x1, x2, y1, y2
+                                                in attributes['rotated_windows']])
+        else:
+            total += array.nbytes
+    total += sum(view.nbytes for root_id, view in views.values()
+                    if root_id not in owners)
+    return total
+
+class Prefetcher(object):
+    '''Iterate over (filename, makeimage(filename)) with up to depth images
+    loaded ahead by workers threads.
+    An exception raised while loading a file is raised again when the
+    iteration reaches that file.'''
+    def __init__(self, filelist, makeimage, depth=4, workers=2, max_mb=None):
+        self.filelist = list(filelist)
+        self.makeimage = makeimage
+        self.depth = max(depth, 1)
+        self.max_bytes = None if max_mb is None else max_mb * 2**20
+        self._cond = threading.Condition()
+        self._next = 0          #next file to start loading
+        self._in_flight = 0
+        self._ready = {}        #index -> (image, error, nbytes)
+        self._bytes = 0
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work)
+                            for _ in range(max(workers, 1))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def queue_depth(self):
+        '''number of images loaded and waiting'''
+        with self._cond:
+            return len(self._ready)
+
+    def queued_mb(self):
+        '''megabytes held by images loaded and waiting'''
+        with self._cond:
+            return self._bytes / 2.0**20
+
+    def _full(self):
+        return (len(self._ready) + self._in_flight >= self.depth
+                or (self.max_bytes is not None and self._ready
+                    and self._bytes >= self.max_bytes))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while (not self._closed and self._next < len(self.filelist)
+                            and self._full()):
+                    self._cond.wait(0.1)
+                if self._closed or self._next >= len(self.filelist):
+                    return
+                index = self._next
+                self._next += 1
+                self._in_flight += 1
+            img = error = None
+            try:
+                with instrumentation.stage('prefetch_load'):
+                    img = self.makeimage(self.filelist[index])
+            except Exception as err:
+                error = err
+            nbytes = image_nbytes(img)
+            with self._cond:
+                self._ready[index] = (img, error, nbytes)
+                self._bytes += nbytes
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            for index, this_file in enumerate(self.filelist):
+                with self._cond:
+                    if index not in self._ready:
+                        instrumentation.count('prefetch.waits')
+                    while index not in self._ready:
+                        self._cond.wait(0.1)
+                    img, error, nbytes = self._ready.pop(index)
+                    self._bytes -= nbytes
+                    self._cond.notify_all()
+                if error is not None:
+                    raise error
+                yield this_file, img
+        finally:
+            self.close()
+
+    def close(self):
+        '''Stop loading; threads finish the file they are on'''
+        with self._cond:
+            self._closed = True
+            self._ready.clear()
+            self._bytes = 0
+            self._cond.notify_all()
@@ -25,7 +25,7 @@ def get_line_densities(dist,pixsize=DEFAULT_PIXSIZE):
     '''returns the integrated line densities (lds) and the normalized lds
     dist - a cloud distribution object
     '''
-    imgs = [ci(ff) for ff in dist.filelist]
+    imgs = [ci(ff).lean('od') for ff in dist.filelist]
     cdimgs = [im.get_od_image() / im.s_lambda for im in imgs]
     ldimgs = [bp.line_density(cdim, pixsize) for cdim in cdimgs]
     ldsnorm = [ld/np.sum(ld) for ld in ldimgs]
@@ -130,7 +130,7 @@ def plt_ave_shifted_imag(dist,pixsize=DEFAULT_PIXSIZE, **kwargs):
 def get_shifts(dist, ref_dist, max_shift=DEFAULT_MAX_SHIFT, pixsize=DEFAULT_PIXSIZE):
     '''try to return shifts between two distributions, not really working for now
     '''
-    imgs = [ci(ff) for ff in dist.filelist]
+    imgs = [ci(ff).lean('od') for ff in dist.filelist]
     cdimgs = [im.get_od_image() / im.s_lambda for im in imgs]
     ldimgs = [bp.line_density(cdim, pixsize) for cdim in cdimgs]
     ldsnorm = [ld/np.sum(ld) for ld in ldimgs]
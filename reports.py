@@ -0,0 +1,237 @@
+'''reports.py - render distribution plots to files without a display
+
+The plots of CloudDistribution (plot_distribution, plot_gaussian_params,
+lifetime, trap_freq, magnification, temperature) are split here into a
+data step, which does the fits and returns plain arrays, and a render step,
+which draws those arrays on a matplotlib Figure with the Agg canvas and
+saves it. Nothing goes through pyplot, so reports can be made in batch
+jobs, on servers and in worker processes, and never block.
+
+    python reports.py Z:\\Data\\2014-10-15 reports/ --workers 4
+
+renders every run directory (any directory holding .mat files) under the
+given paths, in parallel processes, with a summary.json of the fitted
+values and statistics next to the figures of each run. Saved
+distributions (.npz files from CloudDistribution.save) can be given in
+place of directories.'''
+
+import os
+import sys
+import json
+import numbers
+import traceback
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+FORMAT = 'png'
+DPI = 100
+NUM_BINS = 20
+SUMMARY_VARS = ['atom_number', 'position_x', 'position_z', 'width_x',
+                'width_z', 'light_counts']
+
+def _headless():
+    '''use the Agg backend if pyplot has not been set up yet, so importing
+    cloud_distribution needs no display'''
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+
+def _figure(figsize):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+# data steps: dist -> dictionary of arrays and labels
+
+def distribution_data(dist, var):
+    return {'var': var, 'values': np.asarray(dist.dists[var], dtype=float)}
+
+def gaussian_params_data(dist):
+    return dict((var, np.asarray(dist.dists[var], dtype=float))
+                    for var in SUMMARY_VARS)
+
+def fit_data(dist, plot, **kwargs):
+    '''data of one of the *_fit methods of CloudDistribution'''
+    fit = getattr(dist, plot + '_fit')(**kwargs)
+    fit.pop('pcov')
+    return fit
+
+# render steps: (figure, data) -> None
+
+def render_distribution(fig, data):
+    hist = fig.add_subplot(121)
+    hist.hist(data['values'][np.isfinite(data['values'])], NUM_BINS)
+    hist.set_ylabel('Counts')
+    hist.set_xlabel(data['var'])
+    hist.set_title('Histogram of ' + data['var'])
+    series = fig.add_subplot(122)
+    series.plot(data['values'], marker='o', linestyle='--')
+    series.set_ylabel(data['var'])
+    series.set_xlabel('Run Number')
+    series.set_title('Time Series of ' + data['var'])
+
+def render_gaussian_params(fig, data):
+    panels = [(321, 'hist', 'atom_number', None, 'Atom Number', 'Counts',
+                    'Number Histogram'),
+              (322, 'series', 'atom_number', None, 'Run Number', 'Atom Number',
+                    'Time Series'),
+              (323, 'scatter', 'position_x', 'position_z', 'X Position',
+                    'Z Position', 'Location of Cloud Center'),
+              (324, 'scatter', 'width_x', 'width_z', 'X Width', 'Z Width',
+                    'Cloud Widths'),
+              (325, 'hist', 'light_counts', None, 'Light Counts', 'Counts',
+                    'Light Intensity Distribution'),
+              (326, 'scatter', 'light_counts', 'atom_number', 'Light Counts',
+                    'Atom Number', 'Atom Number vs. Light Intensity')]
+    for position, kind, var1, var2, xlabel, ylabel, title in panels:
+        ax = fig.add_subplot(position)
+        if kind == 'hist':
+            values = data[var1]
+            ax.hist(values[np.isfinite(values)], NUM_BINS)
+        elif kind == 'series':
+            ax.plot(data[var1], marker='o', linestyle='--')
+        else:
+            ax.scatter(data[var1], data[var2], marker='o')
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+    fig.tight_layout()
+
+def render_fit(fig, data):
+    ax = fig.add_subplot(111)
+    ax.plot(data['x'], data['y'], '.')
+    ax.plot(data['fit_x'], data['fit_y'])
+    ax.set_xlabel(data['xlabel'])
+    ax.set_ylabel(data['ylabel'])
+    ax.set_title(data['title'])
+
+# name -> (data step, its keyword arguments, render step, figure size)
+PLOTS = OrderedDict([
+    ('gaussian_params', (gaussian_params_data, {}, render_gaussian_params, (10, 12))),
+    ('atom_number', (distribution_data, {'var': 'atom_number'},
+                        render_distribution, (10, 4))),
+    ('lifetime', (fit_data, {'plot': 'lifetime'}, render_fit, (6, 4.5))),
+    ('trap_freq_z', (fit_data, {'plot': 'trap_freq', 'axis': 1}, render_fit, (6, 4.5))),
+    ('magnification', (fit_data, {'plot': 'magnification'}, render_fit, (6, 4.5))),
+    ('temperature_z', (fit_data, {'plot': 'temperature', 'axis': 1},
+                        render_fit, (6, 4.5))),
+    ])
+
+def render(data, render_step, filename, figsize=(8, 6)):
+    '''Draw data with render_step and save it to filename'''
+    fig = _figure(figsize)
+    render_step(fig, data)
+    fig.savefig(filename, dpi=DPI)
+    return filename
+
+def _scalars(data):
+    return dict((key, float(value)) for key, value in data.items()
+                    if isinstance(value, numbers.Number))
+
+def report(dist, output_dir, plots=None, fmt=FORMAT):
+    '''Render the plots (names in PLOTS, default all) of a distribution
+    into output_dir, and write summary.json of statistics and fitted
+    values. A plot whose data cannot be made (e.g. a fit that fails, or a
+    dataset without a control parameter) is recorded as an error in the
+    summary and skipped.'''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    summary = OrderedDict([('directory', dist.directory),
+                           ('num_files', len(dist.filelist)),
+                           ('statistics', OrderedDict()),
+                           ('fits', OrderedDict()),
+                           ('files', []),
+                           ('errors', OrderedDict())])
+    for var in SUMMARY_VARS:
+        if len(dist.dists.get(var, [])):
+            values = np.asarray(dist.dists[var], dtype=float)
+            summary['statistics'][var] = {'mean': float(np.mean(values)),
+                    'std': float(np.std(values)),
+                    'allan_dev': float(np.sqrt(0.5*np.mean(np.diff(values)**2)))
+                                    if len(values) > 1 else None}
+    for name in plots or PLOTS.keys():
+        data_step, kwargs, render_step, figsize = PLOTS[name]
+        try:
+            data = data_step(dist, **kwargs)
+        except Exception as err:
+            summary['errors'][name] = repr(err)
+            continue
+        if data_step is fit_data:
+            summary['fits'][name] = _scalars(data)
+        filename = os.path.join(output_dir, '%s.%s'%(name, fmt))
+        summary['files'].append(render(data, render_step, filename, figsize))
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as ff:
+        json.dump(summary, ff, indent=2)
+    return summary
+
+def _report_job(args):
+    '''make the distribution of a directory or saved .npz and report it;
+    run in worker processes'''
+    source, output_dir, plots, fmt = args
+    _headless()
+    import instrumentation
+    import cloud_distribution
+    instrumentation.set_progress_callback(None)
+    try:
+        if source.endswith('.npz'):
+            dist = cloud_distribution.CloudDistribution.load(source)
+        else:
+            dist = cloud_distribution.CloudDistribution(
+                                os.path.join(source, ''))
+        return report(dist, output_dir, plots, fmt)
+    except Exception:
+        return {'directory': source, 'errors': {'report': traceback.format_exc()}}
+
+def run_directories(paths):
+    '''directories holding .mat files under paths, and any .npz files'''
+    runs = []
+    for path in paths:
+        if path.endswith('.npz'):
+            runs.append(path)
+            continue
+        for root, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            if any(name.lower().endswith('.mat') for name in names):
+                runs.append(root)
+    return runs
+
+def batch_reports(paths, output_root, plots=None, fmt=FORMAT, workers=None):
+    '''Report every run under paths into its own directory of output_root,
+    several runs at once in worker processes; returns the summaries'''
+    runs = run_directories(paths)
+    common = os.path.dirname(os.path.commonprefix([os.path.abspath(run)
+                                                    for run in runs]))
+    jobs = []
+    for run in runs:
+        name = os.path.relpath(os.path.abspath(run), common)
+        name = os.path.splitext(name)[0].replace(os.sep, '_')
+        jobs.append((run, os.path.join(output_root, name), plots, fmt))
+    workers = workers or multiprocessing.cpu_count()
+    if workers <= 1 or len(jobs) < 2:
+        return [_report_job(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(_report_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == "__main__":
+    _headless()
+    import argparse
+    parser = argparse.ArgumentParser(description='Render distribution reports')
+    parser.add_argument('paths', nargs='+',
+                        help='data directories (searched recursively) or .npz files')
+    parser.add_argument('output', help='directory for the reports')
+    parser.add_argument('--plots', nargs='+', choices=list(PLOTS.keys()))
+    parser.add_argument('--format', default=FORMAT)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    summaries = batch_reports(args.paths, args.output, args.plots, args.format,
+                              args.workers)
+    for summary in summaries:
+        print('%s: %d figures, %d errors'%(summary['directory'],
+                    len(summary.get('files', [])), len(summary['errors'])))
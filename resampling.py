@@ -0,0 +1,139 @@
+'''resampling.py - bootstrap and jackknife uncertainties of statistics
+
+Statistics come in two kinds:
+    vectorized  - statistic(*samples) takes arrays of shape (resamples,
+                  shots) and returns one value per resample, like
+                  lambda x: np.mean(x, axis=-1). All resamples in a block
+                  are evaluated in one call.
+    per-sample  - statistic(*data, indices) does something that cannot be
+                  vectorized, like a curve fit, for one resample. These can
+                  be spread over worker processes; the statistic must then
+                  be a module-level function (or a functools.partial of
+                  one) so that it can be pickled.
+
+Index matrices are drawn a block at a time, at most CHUNK_VALUES indices
+per block, so memory does not grow with the number of resamples. Results
+are Resampled tuples of (estimate, se, lower, upper, samples); intervals
+are percentile intervals for the bootstrap and normal intervals for the
+jackknife.'''
+
+from collections import namedtuple
+import multiprocessing
+import numpy as np
+from scipy import stats
+
+NUM_RESAMPLES = 1000    #default number of bootstrap resamples
+CONFIDENCE = 0.683      #default confidence level, 1 sigma
+CHUNK_VALUES = 2**22    #indices per block of resamples
+
+Resampled = namedtuple('Resampled', ['estimate', 'se', 'lower', 'upper', 'samples'])
+
+def mean(x):
+    return np.mean(x, axis=-1)
+
+def std(x):
+    return np.std(x, axis=-1)
+
+def median(x):
+    return np.median(x, axis=-1)
+
+def snr(x):
+    return np.mean(x, axis=-1) / np.std(x, axis=-1)
+
+def allan_dev_of_diffs(diffs):
+    '''lag-1 Allan deviation from shot to shot differences; bootstrapping
+    the differences rather than the values keeps the time order'''
+    return np.sqrt(0.5 * np.mean(diffs**2, axis=-1))
+
+STATISTICS = {'mean': mean, 'std': std, 'median': median, 'snr': snr,
+              'allan_dev': allan_dev_of_diffs}
+
+def _as_arrays(data):
+    data = [np.asarray(column, dtype=float) for column in data]
+    num = len(data[0])
+    if any(len(column) != num for column in data):
+        raise ValueError('All data must have one value per shot')
+    return data, num
+
+def _blocks(total, num, parts=1):
+    '''sizes of blocks of resamples of num indices, in at least parts
+    blocks so that each worker gets several'''
+    size = max(min(CHUNK_VALUES // max(num, 1), -(-total // parts)), 1)
+    return [min(size, total - start) for start in range(0, total, size)]
+
+def _apply(args):
+    '''evaluate a per-sample statistic on each row of an index block'''
+    statistic, data, indices = args
+    values = np.empty(len(indices))
+    for row, these_indices in enumerate(indices):
+        try:
+            values[row] = statistic(*(data + [these_indices]))
+        except Exception:
+            values[row] = np.nan #e.g. a fit that did not converge
+    return values
+
+def _evaluate(statistic, data, index_blocks, vectorized, workers):
+    if vectorized:
+        return np.concatenate([statistic(*[column[indices] for column in data])
+                                for indices in index_blocks])
+    jobs = [(statistic, data, indices) for indices in index_blocks]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_apply, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_apply(job) for job in jobs]
+    return np.concatenate(results)
+
+def _estimate(statistic, data, num, vectorized):
+    if vectorized:
+        return float(statistic(*data))
+    return float(statistic(*(data + [np.arange(num)])))
+
+def bootstrap(data, statistic, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE,
+                vectorized=True, workers=1, seed=None):
+    '''Bootstrap distribution of statistic over shots.
+        Args:
+            data: list of arrays with one value per shot, resampled together
+            statistic: see the module docstring
+            vectorized: False for a per-sample statistic
+            workers: processes for per-sample statistics
+            seed: seed of the random resampling'''
+    data, num = _as_arrays(data)
+    rng = np.random.RandomState(seed)
+    index_blocks = (rng.randint(0, num, size=(size, num))
+                        for size in _blocks(num_resamples, num,
+                                            1 if vectorized else 4 * workers))
+    if not vectorized:
+        index_blocks = list(index_blocks) #draw all before sending to workers
+    samples = _evaluate(statistic, data, index_blocks, vectorized, workers)
+    alpha = 1 - confidence
+    lower, upper = np.nanpercentile(samples, [50 * alpha, 100 - 50 * alpha])
+    return Resampled(_estimate(statistic, data, num, vectorized),
+                     np.nanstd(samples, ddof=1), lower, upper, samples)
+
+def jackknife(data, statistic, confidence=CONFIDENCE, vectorized=True, workers=1):
+    '''Jackknife (leave one shot out) estimate, with the bias removed, and
+    standard error of statistic; arguments as for bootstrap'''
+    data, num = _as_arrays(data)
+    # row i of the leave-one-out index matrix is 0..num-1 without i
+    def index_blocks():
+        start = 0
+        for size in _blocks(num, num - 1, 1 if vectorized else 4 * workers):
+            left_out = np.arange(start, start + size)
+            indices = np.arange(num - 1)[None, :] + (
+                            np.arange(num - 1)[None, :] >= left_out[:, None])
+            start += size
+            yield indices
+    blocks = index_blocks() if vectorized else list(index_blocks())
+    samples = _evaluate(statistic, data, blocks, vectorized, workers)
+    full = _estimate(statistic, data, num, vectorized)
+    mean_sample = np.nanmean(samples)
+    estimate = num * full - (num - 1) * mean_sample
+    se = np.sqrt((num - 1) / float(num) * np.nansum((samples - mean_sample)**2))
+    half_width = se * stats.norm.ppf(0.5 + confidence / 2)
+    return Resampled(estimate, se, estimate - half_width, estimate + half_width,
+                     samples)
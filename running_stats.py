@@ -0,0 +1,164 @@
+'''running_stats.py - streaming statistics over many shots
+
+The accumulators here keep per-position mean and variance of a sequence of
+equally shaped arrays (field profiles, line densities, images) without
+holding the arrays themselves, so memory is constant in the number of shots.
+Updates use the Welford/Chan pairwise formulas, which are numerically stable
+and let partial results from different datasets be merged.'''
+
+import numpy as np
+
+class RunningStats(object):
+    '''Per-position running mean and variance of a stream of arrays'''
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+
+    def push(self, value):
+        '''Add a single array to the accumulator'''
+        value = np.asarray(value, dtype=float)
+        if self._mean is None:
+            self.count = 1
+            self._mean = value.copy()
+            self._m2 = np.zeros_like(self._mean)
+            return
+        if value.shape != self._mean.shape:
+            raise ValueError('Shape %s does not match accumulated shape %s'
+                                %(value.shape, self._mean.shape))
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def push_many(self, values):
+        '''Add a stack of arrays, indexed along the first axis'''
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] == 0:
+            return
+        batch = RunningStats()
+        batch.count = values.shape[0]
+        batch._mean = np.mean(values, axis=0)
+        batch._m2 = np.sum((values - batch._mean)**2, axis=0)
+        self.merge(batch)
+
+    def merge(self, other):
+        '''Combine the statistics of another accumulator into this one'''
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            return self
+        if other._mean.shape != self._mean.shape:
+            raise ValueError('Shape %s does not match accumulated shape %s'
+                                %(other._mean.shape, self._mean.shape))
+        total = self.count + other.count
+        delta = other._mean - self._mean
+        self._mean += delta * (float(other.count) / total)
+        self._m2 += other._m2 + delta**2 * (float(self.count) * other.count / total)
+        self.count = total
+        return self
+
+    @property
+    def shape(self):
+        return None if self._mean is None else self._mean.shape
+
+    @property
+    def mean(self):
+        return self._mean
+
+    def variance(self, ddof=0):
+        '''Per-position variance; ddof=0 matches np.var'''
+        if self.count - ddof <= 0:
+            return np.full(self.shape, np.nan) if self.shape else None
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        '''Per-position standard deviation; ddof=0 matches np.std'''
+        var = self.variance(ddof)
+        return None if var is None else np.sqrt(var)
+
+
+class FieldNoiseAccumulator(object):
+    '''Streaming statistics of field profiles with the sample on and off.
+
+    Profiles from both datasets can be pushed in any order; the difference
+    of the means and the quadrature sum of the standard deviations are
+    available at any time.'''
+    def __init__(self):
+        self.on = RunningStats()
+        self.off = RunningStats()
+
+    def push(self, profile, sample_on=True):
+        '''Add a field profile to the on or off statistics'''
+        if sample_on:
+            self.on.push(profile)
+        else:
+            self.off.push(profile)
+
+    def merge(self, other):
+        '''Combine another accumulator, e.g. from a parallel worker'''
+        self.on.merge(other.on)
+        self.off.merge(other.off)
+        return self
+
+    def field(self):
+        '''Mean field with the sample on, minus mean field with it off'''
+        if self.off.count == 0:
+            return self.on.mean
+        return self.on.mean - self.off.mean
+
+    def noise(self):
+        '''Per-position field noise, combining on and off in quadrature'''
+        if self.off.count == 0:
+            return self.on.std()
+        return np.sqrt(self.on.variance() + self.off.variance())
+
+
+class SeriesStats(object):
+    '''Running statistics of a time series of scalars, one value per shot:
+    mean, standard deviation, SNR and the lag-1 Allan deviation, matching
+    CloudDistribution.mean, std, snr and allan_dev on the same values.'''
+    def __init__(self):
+        self.moments = RunningStats()
+        self.last = None
+        self._sum_diff2 = 0.0
+
+    @property
+    def count(self):
+        return self.moments.count
+
+    def push(self, value):
+        '''Add the value of the next shot'''
+        value = float(value)
+        if self.last is not None:
+            self._sum_diff2 += (value - self.last)**2
+        self.last = value
+        self.moments.push(value)
+
+    def mean(self):
+        return float(self.moments.mean) if self.count else np.nan
+
+    def std(self, ddof=0):
+        return float(self.moments.std(ddof)) if self.count else np.nan
+
+    def snr(self):
+        '''mean / std, 0 for a constant series as in stats.signaltonoise'''
+        std = self.std()
+        return 0.0 if std == 0 else self.mean() / std
+
+    def allan_dev(self):
+        '''sqrt(<(x[i+1] - x[i])**2> / 2)'''
+        if self.count < 2:
+            return np.nan
+        return np.sqrt(0.5 * self._sum_diff2 / (self.count - 1))
+
+    def summary(self):
+        '''dictionary of the current statistics'''
+        return {'count': self.count,
+                'mean': self.mean(),
+                'std': self.std(),
+                'snr': self.snr(),
+                'allan_dev': self.allan_dev()}
@@ -10,43 +10,103 @@ import cloud_image as ci
 import intensity_correction as ic
 import re
 import glob
+import multiprocessing
 import matplotlib.pyplot as plt
 import numpy as np
 
 DEFAULT_IMAGE_TIME = 10e-6
+SATURATION_FIELDS = ('saturation', 'atom_number', 'optdens_number',
+                        'int_term_number', 'log_part', 'linear_part')
 
-def sat_vs_num(data_dir, **kwargs):
-    '''Given a directory, return the saturation parameters and intensity-corrected atom numbers from each image'''
-    data_filenames = sorted(glob.glob(data_dir + '/*.mat'))
+def shot_saturation_parts(img, saturation_intensity=ic.DEFAULT_I_SAT):
+    '''Return every saturation-related quantity of one image as a dictionary,
+    computing each intensity image and each fit only once.
+    The values match the intensity_correction functions of the same name;
+    log_part and linear_part are the terms of intensity_correction.number_parts.'''
+    scale = (img.pixel_size / img.magnification)**2 / img.s_lambda
+    light_int = img.counts2intensity(img.light_image_trunc)
+    atom_int = img.counts2intensity(img.atom_image_trunc)
+    dark_int = img.counts2intensity(img.dark_frame(img.trunc_window))
 
-    saturation2num = []
+    # CloudImage.optical_depth, sharing the intensity images
+    optical_density = img.get_od_image(abs_od=False)
+    offset = img.od_offset(optical_density)
+    cd_od = optical_density - offset + (img.fluc_cor * light_int - atom_int) / img.isat
 
-    for index, datum in enumerate(data_filenames):
-	print 'Processing Image %d'%(index+1)
-        this_img = ci.CloudImage(datum)
-        this_number = ic.atom_number(this_img)
-        this_saturation = ic.saturation(this_img)
-        saturation2num.append((this_saturation, this_number))
+    int_term = (light_int - atom_int) / saturation_intensity
+    s_initial = img.fluc_cor * (light_int - dark_int) / img.isat
+    s_final = (atom_int - dark_int) / img.isat
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_term = np.log(s_initial / s_final)
+    log_term[~np.isfinite(log_term)] = 0
 
-    saturations, nums = zip(*saturation2num)
-    return (saturations, nums)
+    return {'saturation': np.mean(light_int) / img.isat,
+            'atom_number': np.sum(cd_od + int_term) * scale,
+            'optdens_number': img.atom_number(),
+            'int_term_number': np.sum(int_term) * scale,
+            'log_part': np.sum(log_term) * scale,
+            'linear_part': np.sum(s_initial - s_final) * scale}
 
-def od_parts(data_dir, **kwargs):
-    '''Given a directory, return the saturation parameters, optical densities, and intensity correction terms from each image'''
+def _analyse_file(args):
+    '''Pool worker: load one file and return its saturation parts'''
+    filename, saturation_intensity = args
+    try:
+        return shot_saturation_parts(ci.CloudImage(filename), saturation_intensity)
+    except ci.FitError:
+        return None
+
+def saturation_analysis(data_dir, processes=1,
+                        saturation_intensity=ic.DEFAULT_I_SAT):
+    '''Given a directory, load each image once and return a dictionary of
+    NumPy arrays with the saturation, atom_number, optdens_number and
+    int_term_number of every image (see SATURATION_FIELDS), plus the filenames.
+    Images are processed in this process by default; processes > 1, or
+    None for one per CPU, uses a pool of worker processes, which on Windows
+    needs the calling script to be guarded by if __name__ == '__main__'.
+    Images whose fits fail are left out.'''
     data_filenames = sorted(glob.glob(data_dir + '/*.mat'))
+    jobs = [(datum, saturation_intensity) for datum in data_filenames]
+    if processes == 1:
+        results = map(_analyse_file, jobs)
+    else:
+        workers = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_analyse_file, jobs,
+                                chunksize=max(1, len(jobs) // (4 * workers)))
+        finally:
+            pool.close()
+            pool.join()
 
-    saturation2od_parts = []
+    kept = [(datum, parts) for datum, parts in zip(data_filenames, results)
+                if parts is not None]
+    if len(kept) < len(data_filenames):
+        print 'Fit Error in %d of %d images'%(len(data_filenames) - len(kept),
+                                            len(data_filenames))
+    analysis = {'filename': np.array([datum for datum, _ in kept])}
+    for field in SATURATION_FIELDS:
+        analysis[field] = np.array([parts[field] for _, parts in kept])
+    return analysis
 
-    for index, datum in enumerate(data_filenames):
-        print 'Processing Image %d'%(index+1)
-        this_img = ci.CloudImage(datum)
-        this_saturation = ic.saturation(this_img)
-        this_optdens_part = ic.optdens_number(this_img)
-        this_int_part = ic.int_term_number(this_img)
-        saturation2od_parts.append((this_saturation, this_optdens_part, this_int_part))
+def sat_vs_num(data_dir, **kwargs):
+    '''Given a directory, return the saturation parameters and intensity-corrected atom numbers from each image'''
+    analysis = saturation_analysis(data_dir, **kwargs)
+    return (analysis['saturation'], analysis['atom_number'])
+
+def od_parts(data_dir, **kwargs):
+    '''Given a directory, return the saturation parameters, optical densities, and intensity correction terms from each image'''
+    analysis = saturation_analysis(data_dir, **kwargs)
+    return (analysis['saturation'], analysis['optdens_number'],
+                analysis['int_term_number'])
 
-    saturations, optdens_parts, int_parts = zip(*saturation2od_parts)
-    return (saturations, optdens_parts, int_parts)
+def calibrate_alpha(data_dir, **kwargs):
+    '''Given a directory of images taken at varying probe intensity, return the
+    effective saturation parameter alpha that makes the atom number independent
+    of intensity, along with the saturations and corrected atom numbers'''
+    saturations, optdens_parts, int_parts = od_parts(data_dir, **kwargs)
+    alpha, nums = ic.fit_alpha(optdens_parts, int_parts)
+    print 'alpha = %2.3f'%alpha
+    return (alpha, saturations, nums)
 	
 def sigma_w_int_corr(data_dir):
     '''DEPRECATED!
@@ -0,0 +1,243 @@
+'''synthetic_data.py - write synthetic ImagingGUI .mat files
+
+Produces shots that CloudImage and CloudDistribution load exactly like lab
+data: a rawImage stack of atom, light and dark planes, runData (ContParName,
+CurrContPar, CurrTOF, vars, AllFiles) and hfig_main.calculation/display.
+Clouds are gaussian, bimodal (thermal plus Thomas-Fermi) or double-peaked,
+imaged with photon shot noise, read noise and saturation of the probe
+transition, so datasets of any size can be made offline for tests and
+benchmarks.
+
+Example:
+    make_dataset('/tmp/bench/100shots', 100, camera='pixis', shape=(256, 512))
+'''
+
+import os
+import time
+import numpy as np
+import scipy.io
+from BECphysics import C, H, LAMBDA_RB, M, KB
+import intensity_correction as ic
+
+# camera geometry and noise; shape is (rows, columns)
+CAMERAS = {'dragonfly': {'pixel_size': 3.75e-6,
+                         'shape': (960, 1280),
+                         'magnification': 2.0,
+                         'quantum_efficiency': 0.14,
+                         'counts_per_electron': 16, #12 bit data, MSB aligned
+                         'bias': 200.0,
+                         'read_noise': 2.0},
+           'pixis': {'pixel_size': 13.0e-6,
+                     'shape': (1024, 1024),
+                     'magnification': 24.0,
+                     'quantum_efficiency': 1.03,
+                     'counts_per_electron': 1,
+                     'bias': 600.0,
+                     'read_noise': 4.0}}
+
+SIGMA_S_LAMBDA = 2.9e-13 #m^2, sigma light cross section
+PI_S_LAMBDA = 1.4e-13 #m^2, pi light cross section
+I_SAT = {SIGMA_S_LAMBDA: 16.7, PI_S_LAMBDA: 30.4} #W/m^2, as in CloudImage
+
+DEFAULT_CLOUD = {'kind': 'gaussian',     #'gaussian', 'bimodal' or 'double'
+                 'atom_number': 2e3,
+                 'center': (0.5, 0.5),   #(x, z), fraction of the frame
+                 'sigma': (20.0, 6.0),   #(x, z) gaussian widths in pixels
+                 'tf_radius': (10.0, 3.0), #(x, z) Thomas-Fermi radii in pixels
+                 'condensate_fraction': 0.5,
+                 'separation': 12.0,     #pixels along z, for 'double'
+                 'temperature': None,    #K; if set, widths grow with TOF
+                 'position_jitter': 0.5, #pixels rms
+                 'number_jitter': 0.05}  #fractional rms
+
+DEFAULT_IMAGING = {'saturation': 0.3,    #probe I/I_sat
+                   'image_time': 100e-6, #sec
+                   's_lambda': PI_S_LAMBDA,
+                   'alpha': 1.0,         #effective saturation parameter
+                   'intensity_jitter': 0.01, #fractional rms shot-to-shot
+                   'image_rotation': 0}
+
+def _quantum_efficiency(camera, magnification):
+    '''counts per photon as assumed by CloudImage'''
+    if camera == 'dragonfly':
+        return 0.11 if magnification > 3 else 0.14
+    return CAMERAS[camera]['quantum_efficiency']
+
+def _struct_array(entries):
+    '''A MATLAB struct array with at least two entries, so that loadmat with
+    squeeze_me=True returns a sequence, as for real ImagingGUI files'''
+    arr = np.empty(max(len(entries), 2), dtype=object)
+    for ii, entry in enumerate(entries):
+        arr[ii] = entry
+    for ii in range(len(entries), len(arr)):
+        arr[ii] = {'name': 'Unused%d'%ii, 'value': 0.0}
+    return arr
+
+def column_density(kind, shape, center, sigma, tf_radius=None,
+                    condensate_fraction=0.5, separation=0.0):
+    '''Return a cloud profile on the pixel grid, normalized to unit sum'''
+    rows, cols = shape
+    zz, xx = np.mgrid[0:rows, 0:cols].astype(float)
+    x0, z0 = center
+    gauss = lambda zc: np.exp(-0.5 * (((xx - x0) / sigma[0])**2
+                                        + ((zz - zc) / sigma[1])**2))
+    if kind == 'gaussian':
+        profile = gauss(z0)
+    elif kind == 'double':
+        profile = gauss(z0 - 0.5 * separation) + gauss(z0 + 0.5 * separation)
+    elif kind == 'bimodal':
+        tf_arg = 1 - ((xx - x0) / tf_radius[0])**2 - ((zz - z0) / tf_radius[1])**2
+        condensate = np.maximum(tf_arg, 0)**1.5
+        thermal = gauss(z0)
+        profile = (condensate_fraction * condensate / max(np.sum(condensate), 1e-300)
+                    + (1 - condensate_fraction) * thermal / np.sum(thermal))
+    else:
+        raise ValueError('Unknown cloud kind %s'%kind)
+    return profile / np.sum(profile)
+
+def make_shot(camera='pixis', shape=None, magnification=None, cloud=None,
+                imaging=None, tof=5e-3, random_state=None):
+    '''Simulate one shot and return (raw_image, calculation) where raw_image
+    is the (rows, cols, 3) uint16 atom/light/dark stack'''
+    geometry = CAMERAS[camera]
+    cloud = dict(DEFAULT_CLOUD, **(cloud or {}))
+    imaging = dict(DEFAULT_IMAGING, **(imaging or {}))
+    rs = random_state if random_state is not None else np.random
+    shape = tuple(shape or geometry['shape'])
+    magnification = magnification or geometry['magnification']
+    pixel_area = (geometry['pixel_size'] / magnification)**2
+    isat = I_SAT.get(imaging['s_lambda'], 30.4)
+
+    sigma = np.array(cloud['sigma'], dtype=float)
+    if cloud['temperature'] is not None:
+        velocity = np.sqrt(KB * cloud['temperature'] / M)
+        sigma = np.sqrt(sigma**2 + (velocity * tof / np.sqrt(pixel_area))**2)
+    center = (cloud['center'][0] * shape[1] + cloud['position_jitter'] * rs.randn(),
+              cloud['center'][1] * shape[0] + cloud['position_jitter'] * rs.randn())
+    number = cloud['atom_number'] * (1 + cloud['number_jitter'] * rs.randn())
+    profile = column_density(cloud['kind'], shape, center, sigma,
+                             cloud['tf_radius'], cloud['condensate_fraction'],
+                             cloud['separation'])
+    optical_depth = imaging['s_lambda'] * number * profile / pixel_area
+
+    s_initial = imaging['saturation'] * (1 + imaging['intensity_jitter'] * rs.randn())
+    s_initial = np.full(shape, max(s_initial, 1e-6))
+    s_final = ic.transmitted_saturation(s_initial, optical_depth, imaging['alpha'])
+
+    qe = _quantum_efficiency(camera, magnification)
+    photons_per_sat = isat * pixel_area * imaging['image_time'] / (H * C / LAMBDA_RB)
+    def expose(sat):
+        electrons = rs.poisson(np.maximum(sat, 0) * photons_per_sat * qe)
+        counts = (electrons * geometry['counts_per_electron'] + geometry['bias']
+                    + geometry['read_noise'] * rs.randn(*shape))
+        return np.clip(np.round(counts), 0, 2**16 - 1).astype(np.uint16)
+    raw_image = np.dstack((expose(s_final), expose(s_initial), expose(0)))
+
+    rows, cols = shape
+    half_x = int(min(6 * sigma[0] + cloud['separation'], cols // 2 - 1))
+    half_z = int(min(6 * sigma[1] + cloud['separation'], rows // 2 - 1))
+    cx, cz = int(cloud['center'][0] * cols), int(cloud['center'][1] * rows)
+    fluc = max(4, min(rows, cols) // 8)
+    calculation = {'M': float(magnification),
+                   'pixSize': geometry['pixel_size'],
+                   'c1': 1.0,
+                   's_lambda': imaging['s_lambda'],
+                   'A': pixel_area,
+                   'truncWinX': np.arange(max(cx - half_x, 0), min(cx + half_x, cols)),
+                   'truncWinY': np.arange(max(cz - half_z, 0), min(cz + half_z, rows)),
+                   'flucWinX': np.arange(0, fluc),
+                   'flucWinY': np.arange(0, fluc)}
+    return raw_image, calculation
+
+def write_shot(filename, raw_image, calculation, cont_par_name='VOID',
+                curr_cont_par=0, tof=5e-3, variables=None, image_rotation=0,
+                do_compression=False):
+    '''Write one ImagingGUI-style .mat file'''
+    variables = dict(variables or {})
+    var_structs = _struct_array([{'name': name, 'value': value}
+                                    for name, value in sorted(variables.items())])
+    all_files = np.empty((2, 2), dtype=object)
+    all_files[0, 0] = 'Variables.m'
+    all_files[0, 1] = '\n'.join('%s = %r;'%item for item in sorted(variables.items()))
+    all_files[1, 0] = 'Sequence.m'
+    all_files[1, 1] = '% synthetic shot'
+    run_data = {'ContParName': cont_par_name,
+                'CurrContPar': curr_cont_par,
+                'CurrTOF': tof * 1e3, #ImagingGUI stores ms
+                'vars': var_structs,
+                'AllFiles': all_files}
+    hfig_main = {'calculation': calculation,
+                 'display': {'imageRotation': image_rotation}}
+    scipy.io.savemat(filename, {'rawImage': raw_image,
+                                'runData': run_data,
+                                'hfig_main': hfig_main},
+                     do_compression=do_compression, oned_as='row')
+
+def shot_filename(directory, timestamp):
+    '''ImagingGUI file name for a shot taken at timestamp (seconds since epoch)'''
+    return os.path.join(directory,
+                        time.strftime('%Y-%m-%d_%H%M%S.mat', time.localtime(timestamp)))
+
+def make_dataset(directory, num_shots, camera='pixis', shape=None,
+                    magnification=None, cloud=None, imaging=None,
+                    cont_par_name='VOID', cont_par_values=None, tofs=None,
+                    vary=None, start_time=None, cycle_time=30, seed=0,
+                    do_compression=False):
+    '''Write num_shots synthetic shots into directory and return the filenames.
+
+        Args:
+            camera: 'dragonfly' or 'pixis', see CAMERAS
+            shape: (rows, cols) of the frame, default is the full sensor
+            cloud, imaging: overrides of DEFAULT_CLOUD and DEFAULT_IMAGING
+            cont_par_name: name of the control parameter
+            cont_par_values: values cycled through shot by shot; each is also
+                stored in vars under cont_par_name
+            tofs: time-of-flight values (sec) cycled through shot by shot
+            vary: optional function (index, random_state) returning a dict with
+                'cloud' and/or 'imaging' overrides for that shot
+            start_time, cycle_time: timestamps of the shots, in seconds; file
+                names carry one-second resolution, so cycle_time >= 1
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rs = np.random.RandomState(seed)
+    if start_time is None:
+        start_time = time.mktime((2014, 10, 15, 12, 0, 0, 0, 0, -1))
+    filenames = []
+    for index in range(num_shots):
+        tof = tofs[index % len(tofs)] if tofs is not None else 5e-3
+        cont_par = (cont_par_values[index % len(cont_par_values)]
+                        if cont_par_values is not None else 0)
+        overrides = vary(index, rs) if vary is not None else {}
+        shot_cloud = dict(cloud or {}, **overrides.get('cloud', {}))
+        shot_imaging = dict(imaging or {}, **overrides.get('imaging', {}))
+        full_imaging = dict(DEFAULT_IMAGING, **shot_imaging)
+        raw_image, calculation = make_shot(camera, shape, magnification,
+                                            shot_cloud, shot_imaging, tof, rs)
+        variables = {'ImagePulseTime': full_imaging['image_time'],
+                     'TOF': tof * 1e3}
+        if cont_par_name != 'VOID':
+            variables[cont_par_name] = cont_par
+        filename = shot_filename(directory, start_time + index * cycle_time)
+        write_shot(filename, raw_image, calculation, cont_par_name, cont_par,
+                    tof, variables, full_imaging['image_rotation'],
+                    do_compression)
+        filenames.append(filename)
+    return filenames
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic ImagingGUI .mat files')
+    parser.add_argument('directory')
+    parser.add_argument('num_shots', type=int)
+    parser.add_argument('--camera', default='pixis', choices=sorted(CAMERAS.keys()))
+    parser.add_argument('--shape', type=int, nargs=2, default=None,
+                        metavar=('ROWS', 'COLS'))
+    parser.add_argument('--kind', default='gaussian',
+                        choices=['gaussian', 'bimodal', 'double'])
+    parser.add_argument('--saturation', type=float, default=DEFAULT_IMAGING['saturation'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_dataset(args.directory, args.num_shots, camera=args.camera,
+                 shape=args.shape, cloud={'kind': args.kind},
+                 imaging={'saturation': args.saturation}, seed=args.seed)
@@ -0,0 +1,106 @@
+'''temperature.py - temperatures of many time-of-flight series at once
+
+A cloud released from the trap expands as
+    sigma(t)**2 = sigma_0**2 + (KB T / M) t**2
+which is linear in (sigma_0**2, KB T / M) with regressors (1, t**2). All
+series and both axes are fitted together: the weighted sums of the normal
+equations are accumulated per series with np.bincount and every 2x2
+system is solved in closed form, so hundreds of series cost about as much
+as one.
+
+Weights default to 1 / (2 sigma)**2, i.e. the same uncertainty on every
+width, which makes the fit close to a least-squares fit of sigma itself
+(what fittemp does). Parameter uncertainties are scaled by the reduced
+chi-squared of each series.'''
+
+import numpy as np
+from BECphysics import M, KB
+
+MAX_GAP = 5.0       #a pause this many median shot spacings long starts a new series
+
+def sequence_groups(tofs, times=None, max_gap=MAX_GAP):
+    '''Label each shot with its time-of-flight series. Shots are taken in
+    time order (by times, in seconds, if given) and a new series starts
+    when the TOF decreases, or after a pause of more than max_gap median
+    shot spacings. Repeated TOFs, taken for averaging, stay in one series:
+
+    >>> list(sequence_groups([5, 5, 10, 10, 15, 15, 5, 5, 10, 10, 15, 15]))
+    [0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
+    '''
+    tofs = np.asarray(tofs, dtype=float)
+    if times is None:
+        order = np.arange(len(tofs))
+        new = np.diff(tofs) < 0
+    else:
+        times = np.asarray(times, dtype=float)
+        order = np.argsort(times, kind='mergesort')
+        gaps = np.diff(times[order])
+        new = np.diff(tofs[order]) < 0
+        if len(gaps):
+            new |= gaps > max_gap * np.median(gaps)
+    labels = np.empty(len(tofs), dtype=int)
+    labels[order] = np.concatenate([[0], np.cumsum(new)])
+    return labels
+
+def fit_temperatures(tofs, widths, groups, weights=None, mass=M):
+    '''Fit sigma**2 = sigma_0**2 + (KB T / mass) t**2 to every group.
+        Args:
+            tofs: time of flight of each shot, s
+            widths: cloud width of each shot, m; shape (shots,) or
+                    (shots, axes) to fit several axes at once
+            groups: series label of each shot, 0 to num_groups - 1
+            weights: weight of each sigma**2, same shape as widths
+        Returns a dictionary of arrays of shape (num_groups,) or
+        (num_groups, axes): temperature, temperature_err, sigma_0,
+        sigma_0_err and num (shots in each fit).'''
+    tofs = np.asarray(tofs, dtype=float)
+    widths = np.asarray(widths, dtype=float)
+    groups = np.asarray(groups, dtype=int)
+    single_axis = widths.ndim == 1
+    if single_axis:
+        widths = widths[:, None]
+    num_groups = groups.max() + 1 if len(groups) else 0
+    num_axes = widths.shape[1]
+    y = widths**2
+    x = np.repeat(tofs[:, None]**2, num_axes, axis=1)
+    if weights is None:
+        with np.errstate(divide='ignore'):
+            w = 1 / (4 * y)
+    else:
+        w = np.asarray(weights, dtype=float).reshape(y.shape)
+    valid = np.isfinite(y) & np.isfinite(w) & np.isfinite(x)
+    w = np.where(valid, w, 0)
+    y = np.where(valid, y, 0)
+    # one bin per (group, axis)
+    bins = (groups[:, None] * num_axes + np.arange(num_axes)[None, :]).ravel()
+    size = num_groups * num_axes
+    def total(values):
+        return np.bincount(bins, values.ravel(), size)
+    sw = total(w)
+    sx = total(w * x)
+    sxx = total(w * x * x)
+    sy = total(w * y)
+    sxy = total(w * x * y)
+    num = np.bincount(bins, valid.ravel().astype(float), size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = sw * sxx - sx**2
+        intercept = (sxx * sy - sx * sxy) / det
+        slope = (sw * sxy - sx * sy) / det
+        fitted = intercept[bins].reshape(y.shape) + slope[bins].reshape(y.shape) * x
+        chi2 = total(w * (y - fitted)**2)
+        scale = chi2 / (num - 2)
+        intercept_var = sxx / det * scale
+        slope_var = sw / det * scale
+        too_few = num < 3
+        slope[too_few] = intercept[too_few] = np.nan
+        sigma_0 = np.sqrt(intercept)
+        results = {'temperature': mass * slope / KB,
+                   'temperature_err': mass * np.sqrt(slope_var) / KB,
+                   'sigma_0': sigma_0,
+                   'sigma_0_err': np.sqrt(intercept_var) / (2 * sigma_0),
+                   'num': num.astype(int)}
+    for key in results:
+        results[key] = results[key].reshape(num_groups, num_axes)
+        if single_axis:
+            results[key] = results[key][:, 0]
+    return results